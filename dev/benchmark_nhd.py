@@ -0,0 +1,191 @@
+"""
+benchmark_nhd.py
+
+Time each stage of a Navigator build and common queries on synthetic NHD networks, and record the results as JSON so
+that they can be compared across commits. Results for each run are appended to the output file.
+
+Usage: python dev/benchmark_nhd.py --sizes 30000 150000 --queries 10000 --out benchmarks.json
+
+The batch upstream query is compared with the per-reach loop it replaces with --loop-queries, for example
+    python dev/benchmark_nhd.py --sizes 300000 --loop-queries 10000 1000000
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nhd'))
+import write_nhd
+from navigator import Navigator, process_nhd, unpack_nhd, rapid_trace, map_paths, upstream_index, downstream_index, \
+    reach_index
+from process_nhd import prepare_network
+from synthetic_nhd import synthetic_nhd
+
+
+class Timer(object):
+    def __init__(self):
+        self.results = {}
+
+    def __call__(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.results[name] = round(time.perf_counter() - start, 4)
+        return result
+
+
+def build(nhd_table, out_dir, timer=None):
+    """
+    Build a navigator from a synthetic table, timing each stage
+    :param nhd_table: Condensed NHD reach table (df)
+    :param out_dir: Directory for the navigator files (str)
+    :param timer: Timer to record stages, if any (Timer)
+    :return: Paths to the navigator directory and compressed file (str, str)
+    """
+    timer = Timer() if timer is None else timer
+    # The pandas preprocessing is timed for comparison with prepare_network, which replaces it
+    timer('process_nhd', process_nhd, nhd_table.copy())
+    timer('unpack_nhd', unpack_nhd, process_nhd(nhd_table.copy()))
+    nodes, times, dists, outlets, conversion = timer('prepare_network', prepare_network, nhd_table)
+    paths, times, dists, path_offsets, path_starts = \
+        timer('rapid_trace', rapid_trace, nodes, outlets, times, dists, conversion)
+    path_map = timer('map_paths', map_paths, paths, path_offsets, path_starts)
+    index = timer('upstream_index', upstream_index, paths, path_offsets, path_map)
+    parents = timer('downstream_index', downstream_index, paths, path_offsets, path_map)
+    sorted_reaches, reach_order = timer('reach_index', reach_index, conversion)
+    arrays = (paths, times, dists, path_offsets, path_map, index, parents, conversion, sorted_reaches, reach_order)
+    out_path = os.path.join(out_dir, 'nav{}')
+    timer('write_directory', write_nhd.navigator_file, 'bench', *arrays, out_path)
+    timer('write_compressed', write_nhd.navigator_file, 'bench', *arrays, out_path + '.npz', True)
+    return out_path.format('bench'), out_path.format('bench') + '.npz'
+
+
+def mainstem_queries(nav, timer, name, max_days, n_mainstem):
+    """
+    Time bounded queries on mainstem reaches, the reaches with the largest watersheds, against full queries filtered
+    afterward
+    :param nav: Navigator to query (Navigator)
+    :param timer: Timer to record queries (Timer)
+    :param name: Prefix for the recorded times (str)
+    :param max_days: Travel time limit for bounded queries (float)
+    :param n_mainstem: Number of mainstem reaches to query (int)
+    """
+    mainstem = nav.alias_to_reach[np.argsort(nav.index[:, 1] - nav.index[:, 0])[::-1][:n_mainstem]]
+    timer(name + '_filtered', lambda: [reaches[times <= max_days] for reaches, times in
+                                       (nav.upstream_watershed(q, return_times=True) for q in mainstem)])
+    timer(name + '_bounded', lambda: [nav.upstream_watershed(q, return_times=True, max_days=max_days)
+                                      for q in mainstem])
+    timer(name + '_batch_full', nav.upstream_watersheds, mainstem, return_times=True)
+    timer(name + '_batch_bounded', nav.upstream_watersheds, mainstem, return_times=True, max_days=max_days)
+    timer(name + '_batch_depth', nav.upstream_watersheds, mainstem, max_depth=100)
+
+
+def loop_queries(nav, queries, timer):
+    """
+    Time the per-reach loop that the batch upstream query replaces against upstream_watersheds. The union loop is
+    the original batch_upstream, which collected every watershed into a set.
+    :param nav: Navigator to query (Navigator)
+    :param queries: Reach IDs to query (np.array)
+    :param timer: Timer to record queries (Timer)
+    """
+    name = '_{}'.format(queries.size)
+    timer('loop_paths' + name, lambda: [nav.upstream_watershed(q, return_times=True) for q in queries])
+    timer('batch_paths' + name, nav.upstream_watersheds, queries, return_times=True)
+    timer('loop_union' + name, lambda: pd.Series(sorted({r for q in queries for r in nav.upstream_watershed(q)}),
+                                                 name='comid'))
+    timer('batch_union' + name, nav.batch_upstream, queries)
+
+
+def benchmark(n_reaches, n_queries, seed=0, max_days=1., n_mainstem=100, loop_counts=()):
+    """
+    Time the build, loading and queries for a synthetic network. Bounded queries are also timed on a network of the
+    same size that drains to a single outlet along a long main stem, where upstream blocks are large enough for
+    the limits to skip most of each block.
+    :param n_reaches: Number of reaches in the network (int)
+    :param n_queries: Number of reaches to query (int)
+    :param seed: Random seed (int)
+    :param max_days: Travel time limit for bounded queries (float)
+    :param n_mainstem: Number of mainstem reaches to query (int)
+    :param loop_counts: Numbers of queries for which to time the per-reach loop against the batch query (list)
+    :return: Run parameters and times in seconds (dict)
+    """
+    timer = Timer()
+    nhd_table = timer('synthetic_nhd', synthetic_nhd, n_reaches, seed=seed)
+    with tempfile.TemporaryDirectory() as out_dir:
+        directory_path, compressed_path = build(nhd_table, out_dir, timer)
+        timer('load_compressed', Navigator, 'bench', compressed_path)
+        nav = timer('load_directory', Navigator, 'bench', directory_path)
+        queries = np.random.default_rng(seed).choice(nav.alias_to_reach, n_queries)
+        sites = pd.DataFrame({'site_id': np.arange(n_queries), 'comid': queries})
+        timer('upstream_single', lambda: [nav.upstream_watershed(q, return_times=True) for q in queries])
+        timer('upstream_batch', nav.upstream_watersheds, queries, return_times=True)
+        timer('upstream_union', nav.upstream_watersheds, queries, output='union')
+        timer('upstream_count', nav.upstream_watersheds, queries, output='count')
+        timer('partition', nav.partition_watersheds, queries, return_times=True)
+        timer('downstream_single', lambda: [nav.downstream_watershed(q) for q in queries[:1000]])
+        timer('downstream_batch', nav.downstream_watersheds, queries)
+        timer('outlets', nav.outlets, queries)
+        timer('pair_sites', nav.pair_sites, sites.iloc[::2], sites.iloc[1::2])
+        timer('extents', lambda: nav.extents)
+        mainstem_queries(nav, timer, 'mainstem', max_days, n_mainstem)
+        for n_loop in loop_counts:
+            loop_queries(nav, np.random.default_rng(seed + 1).choice(nav.alias_to_reach, n_loop), timer)
+        n_paths = int(nav.offsets.size - 1)
+        path_length = int(nav.paths.size)
+        del nav
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        long_table = synthetic_nhd(n_reaches, n_outlets=1, extend_probability=0.9, seed=seed)
+        nav = Navigator('bench', build(long_table, out_dir)[0])
+        timer('long_extents', lambda: nav.extents)
+        mainstem_queries(nav, timer, 'long_mainstem', max_days, n_mainstem)
+        del nav
+    return {'n_reaches': n_reaches, 'n_queries': n_queries, 'n_paths': n_paths, 'path_length': path_length,
+            'seed': seed, 'seconds': timer.results}
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Navigator build and queries on synthetic networks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[30000, 150000], help="Numbers of reaches")
+    parser.add_argument('--queries', type=int, default=10000, help="Number of reaches to query")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--max-days', type=float, default=1., help="Travel time limit for bounded queries")
+    parser.add_argument('--loop-queries', type=int, nargs='*', default=[],
+                        help="Numbers of queries for which to time the per-reach loop against the batch query")
+    parser.add_argument('--out', default=None, help="JSON file to append results to")
+    args = parser.parse_args()
+
+    run = {'commit': commit_id(), 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+           'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+           'machine': platform.machine(), 'results': []}
+    for n_reaches in args.sizes:
+        result = benchmark(n_reaches, args.queries, args.seed, args.max_days, loop_counts=args.loop_queries)
+        run['results'].append(result)
+        print(json.dumps(result))
+
+    if args.out is not None:
+        runs = []
+        if os.path.isfile(args.out):
+            with open(args.out) as f:
+                runs = json.load(f)
+        runs.append(run)
+        with open(args.out, 'w') as f:
+            json.dump(runs, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+from navigator import adjacency_index, expand_ranges
+from process_nhd import prepare_network
+
+
+def topological_levels(nodes, n_nodes):
+    """
+    Sort nodes into levels, starting at the headwaters, so that all of a node's upstream neighbours are in earlier
+    levels. A node is released into the next level once all of its upstream neighbours have been released. Nodes on
+    (or downstream of) a loop are never released and are left out of the order.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Nodes in topological order, and the position in the order where each level begins (np.array, np.array)
+    """
+    up_offsets, _ = adjacency_index(nodes, n_nodes)
+    down_offsets, downstream = adjacency_index(nodes[:, ::-1], n_nodes)
+    remaining = np.diff(up_offsets)
+
+    levels = []
+    frontier = np.flatnonzero(remaining == 0)
+    while frontier.size:
+        levels.append(frontier)
+        starts = down_offsets[frontier]
+        positions, _ = expand_ranges(starts, down_offsets[frontier + 1] - starts)
+        targets = downstream[positions]
+        np.subtract.at(remaining, targets, 1)
+        frontier = np.unique(targets[remaining[targets] == 0])
+
+    level_bounds = np.zeros(len(levels) + 1, dtype=np.int64)
+    np.cumsum([level.size for level in levels], out=level_bounds[1:])
+    order = np.concatenate(levels) if levels else np.zeros(0, dtype=np.int64)
+    return order, level_bounds
+
+
+def accumulate(nodes, values, how='sum', weights=None):
+    """
+    Accumulate attributes down the network in a single topological sweep, so that each node holds the total,
+    maximum, or weighted mean of itself and everything upstream. The network is expected to be processed so that each
+    node drains to no more than one node (see process_nhd.prepare_network).
+    :param nodes: Array of to-from node pairs (np.array)
+    :param values: Attributes indexed by node, with one column per attribute (e.g. daily values) (np.array)
+    :param how: 'sum', 'max' or 'mean' (str)
+    :param weights: Weights indexed by node for a weighted mean, such as catchment area (np.array)
+    :return: Accumulated attributes, in the shape of the input values (np.array)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    out_shape = values.shape
+    values = values.reshape(out_shape[0], -1)
+    if how == 'mean':
+        # Accumulate the weighted values alongside the weights, then divide
+        weights = np.ones(out_shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+        totals = sweep(nodes, np.hstack((values * weights[:, None], weights[:, None])), np.add)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            accumulated = totals[:, :-1] / totals[:, -1:]
+    elif how == 'sum':
+        accumulated = sweep(nodes, values, np.add)
+    elif how == 'max':
+        accumulated = sweep(nodes, values, np.maximum)
+    else:
+        raise ValueError("Invalid accumulation {}. Must be 'sum', 'max' or 'mean'".format(how))
+    return accumulated.reshape(out_shape)
+
+
+def sweep(nodes, values, combine):
+    """
+    Combine each node's values into its downstream neighbours, one topological level at a time
+    :param nodes: Array of to-from node pairs (np.array)
+    :param values: Attributes indexed by node, one column per attribute (np.array)
+    :param combine: Function used to combine values (np.ufunc)
+    :return: Accumulated attributes (np.array)
+    """
+    n_nodes = values.shape[0]
+    order, level_bounds = topological_levels(nodes, n_nodes)
+    down_offsets, downstream = adjacency_index(nodes[:, ::-1], n_nodes)
+    accumulated = values.copy()
+
+    # Each level is complete once the levels above it have been combined in, so it can be passed downstream
+    for i in range(level_bounds.size - 1):
+        level = order[level_bounds[i]:level_bounds[i + 1]]
+        starts = down_offsets[level]
+        counts = down_offsets[level + 1] - starts
+        positions, _ = expand_ranges(starts, counts)
+        combine.at(accumulated, downstream[positions], accumulated[np.repeat(level, counts)])
+    return accumulated
+
+
+def accumulate_upstream(nhd_table, fields, how='sum', weight_field=None):
+    """
+    Accumulate fields from a condensed NHD table for every reach at once. Reaches with more than one row, such as
+    reaches above a divergence, take their values from their first row.
+    :param nhd_table: Table of stream reach parameters from NHD Plus (df)
+    :param fields: Fields to accumulate, such as drainage area, cropped area or loading (list)
+    :param how: 'sum', 'max' or 'mean' (str)
+    :param weight_field: Field to weight by for an area-weighted mean (str)
+    :return: Table of accumulated fields, indexed by comid (df)
+    """
+    nodes, _, _, _, conversion = prepare_network(nhd_table)
+    nodes = np.unique(nodes, axis=0)  # Repeated rows would be counted more than once
+
+    # Values are indexed by alias, taken from the first row of each reach
+    reach_ids, first = np.unique(nhd_table.comid.values, return_index=True)
+    rows = first[np.searchsorted(reach_ids, conversion)]
+    weights = None if weight_field is None else nhd_table[weight_field].values[rows]
+    accumulated = accumulate(nodes, nhd_table[fields].values[rows], how, weights)
+    return pd.DataFrame(accumulated, columns=fields, index=pd.Index(conversion, name='comid'))
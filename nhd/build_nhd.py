@@ -0,0 +1,330 @@
+"""
+build_nhd.py
+
+Build Navigator files for NHD Plus regions. Regions are built in a pool of processes, largest first, and a region is
+only started when its estimated memory fits within the budget alongside the regions already running. Each stage of a
+build is saved as it completes, so a failed or interrupted build resumes from the last completed stage. When the source
+data of an existing navigator change, only the networks affected by the changes are traced again. Flow and lake files
+for SAM are built from a navigator, in the same alias order, and the catchment and flowline indexes used to snap site
+coordinates to reaches are built from the NHD Plus shapefiles.
+
+Usage: python build_nhd.py --regions 07 10U 10L --workers 4 --memory 32
+"""
+import argparse
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import read_nhd
+import write_nhd
+import spatial_nhd
+import update_nhd
+import validate_nhd
+from navigator import Navigator, NetworkError, rapid_trace, map_paths, upstream_index, downstream_index, reach_index, \
+    PathWriter
+from process_nhd import condense_nhd, condense_key, source_tables, prepare_network, flow_arrays, lake_arrays
+from params_nhd import nhd_regions, erom_months
+from paths_nhd import navigator_path, navigator_map_path, condensed_nhd_path, navigator_stage_path, build_report_path, \
+    validation_report_path, hydro_map_path, flow_file_path, lake_file_path
+from profile_nhd import BuildProfile, Progress
+from tools_hydro.efed_lib import report
+
+# Approximate peak memory per reach for processing and indexing, not including the traced paths held in memory
+bytes_per_reach = 1000
+
+
+def checkpoint(path, cache_key):
+    """
+    Check whether a stage has been completed for the current source data
+    :param path: Directory written by the stage (str)
+    :param cache_key: Key identifying the source data (str)
+    :return: True if the stage is complete (bool)
+    """
+    header = read_nhd.columnar_header(path)
+    return header is not None and header.get('cache_key') == cache_key
+
+
+def validate(region, nodes, outlets, conversion, on_error='raise'):
+    """
+    Validate the reach network before tracing and write the validation report
+    :param region: NHD Hydroregion id (str)
+    :param nodes: Array of to-from node pairs (np.array)
+    :param outlets: Array of outlet nodes (np.array)
+    :param conversion: Array to interpret node aliases (np.array)
+    :param on_error: 'raise', 'skip' or 'repair' (see validate_nhd.check_network) (str)
+    :return: Nodes and outlets to trace (np.array, np.array)
+    """
+    try:
+        nodes, outlets, validation = validate_nhd.check_network(nodes, outlets, conversion, on_error)
+    except NetworkError as e:
+        validate_nhd.write_report(e.validation, validation_report_path.format(region))
+        raise
+    validate_nhd.write_report(validation, validation_report_path.format(region))
+    return nodes, outlets
+
+
+def update_navigator(region, cache_key, profile, on_error='raise', memory_budget=2 ** 30, spill_dir=None):
+    """
+    Update an existing navigator after its source data have changed. The condensed table the navigator was built
+    from is compared with a newly condensed table, and only the networks containing changed reaches are traced.
+    :param region: NHD Hydroregion id (str)
+    :param cache_key: Key identifying the new source data (str)
+    :param profile: Build profile (BuildProfile)
+    :param on_error: 'raise', 'skip' or 'repair' (see validate_nhd.check_network) (str)
+    :param memory_budget: Bytes of traced paths to hold in memory before spilling to disk (int)
+    :param spill_dir: Directory for traced paths spilled to disk (str)
+    :return: Number of reaches in the updated navigator (int)
+    """
+    old_table = pd.DataFrame(read_nhd.columnar_arrays(condensed_nhd_path.format('nav', region, 'reach'),
+                                                      mmap_mode=None))
+    with profile.stage('condense_nhd') as stage:
+        reach_table, _ = condense_nhd(region, navigator_map_path, 'internal_name', processes=1)
+        write_nhd.condensed_nhd('nav', region, reach_table, cache_key=cache_key)
+        stage['items'] = len(reach_table)
+    new_table = read_nhd.condensed_nhd('nav', region, 'reach')
+    with profile.stage('update_navigator', len(new_table)):
+        nav = Navigator(region)
+        arrays, exits, validation = update_nhd.update_navigator(nav, old_table, new_table, on_error, memory_budget,
+                                                                spill_dir)
+        validate_nhd.write_report(validation, validation_report_path.format(region))
+        del nav
+    with profile.stage('navigator_file', arrays[7].size):
+        write_nhd.navigator_file(region, *arrays, cache_key=cache_key, exits=exits)
+    return arrays[7].size
+
+
+def build_navigator(region, memory_budget=2 ** 30, spill_dir=None, overwrite=False, incremental=True,
+                    on_error='raise'):
+    """
+    Build the Navigator for a region in stages: condense the NHD Plus tables, unpack the network, trace upstream
+    paths, index the paths and write the navigator. The output of each stage is saved with a key identifying the
+    source data, and stages with current output are skipped. Saved stages are removed once the navigator is written.
+    If a navigator already exists and the condensed table it was built from is still saved, the navigator is updated
+    instead, tracing only the networks that changed.
+    :param region: NHD Hydroregion id (str)
+    :param memory_budget: Bytes of traced paths to hold in memory before spilling to disk (int)
+    :param spill_dir: Directory for traced paths spilled to disk (str)
+    :param overwrite: Rebuild every stage (bool)
+    :param incremental: Update an existing navigator when possible instead of rebuilding it (bool)
+    :param on_error: What to do with problems in the reach network: 'raise', 'skip' or 'repair' (str)
+    """
+    start_time = time.time()
+    profile = BuildProfile("Region {}".format(region))
+    cache_key = condense_key(region, navigator_map_path)
+    nhd_path = condensed_nhd_path.format('nav', region, 'reach')
+    unpack_path, trace_path, map_path = \
+        (navigator_stage_path.format(region, stage) for stage in ('unpack', 'trace', 'map'))
+    attributes = {'region': region, 'cache_key': cache_key}
+    if overwrite:
+        for path in (nhd_path, unpack_path, trace_path, map_path):
+            shutil.rmtree(path, ignore_errors=True)
+    elif checkpoint(navigator_path.format(region), cache_key):
+        report("Navigator for region {} is up to date".format(region), 1)
+        return
+
+    navigator_header = read_nhd.columnar_header(navigator_path.format(region))
+    if incremental and not overwrite and navigator_header is not None and \
+            checkpoint(nhd_path, navigator_header.get('cache_key')):
+        n_reaches = update_navigator(region, cache_key, profile, on_error, memory_budget, spill_dir)
+        profile.write(build_report_path.format(region), region=region, reaches=n_reaches, cache_key=cache_key,
+                      incremental=True)
+        report("Updated navigator for region {} in {:.1f} seconds".format(region, time.time() - start_time), 2)
+        return
+
+    if checkpoint(nhd_path, cache_key):
+        profile.skip('condense_nhd')
+    else:
+        with profile.stage('condense_nhd') as stage:
+            reach_table, _ = condense_nhd(region, navigator_map_path, 'internal_name', processes=1)
+            write_nhd.condensed_nhd('nav', region, reach_table, cache_key=cache_key)
+            stage['items'] = len(reach_table)
+
+    if checkpoint(unpack_path, cache_key):
+        profile.skip('prepare_network')
+        profile.skip('validate_nhd')
+    else:
+        nhd_table = read_nhd.condensed_nhd('nav', region, 'reach')
+        with profile.stage('prepare_network', len(nhd_table)):
+            nodes, times, dists, outlets, conversion, (exit_from, exit_to) = prepare_network(nhd_table, True)
+        with profile.stage('validate_nhd', conversion.size):
+            nodes, outlets = validate(region, nodes, outlets, conversion, on_error)
+        write_nhd.array_directory(unpack_path, {'nodes': nodes, 'times': times, 'dists': dists, 'outlets': outlets,
+                                                'conversion': conversion, 'exit_from': exit_from,
+                                                'exit_to': exit_to}, attributes)
+    unpacked = read_nhd.columnar_arrays(unpack_path, mmap_mode=None)
+    n_reaches = unpacked['conversion'].size
+
+    if checkpoint(trace_path, cache_key):
+        profile.skip('rapid_trace')
+    else:
+        with profile.stage('rapid_trace', n_reaches) as stage:
+            writer = PathWriter(memory_budget=memory_budget, spill_dir=spill_dir)
+            progress = Progress(n_reaches, "Region {}: traced reaches".format(region))
+            paths, times, dists, path_offsets, path_starts = \
+                rapid_trace(unpacked['nodes'], unpacked['outlets'], unpacked['times'], unpacked['dists'],
+                            unpacked['conversion'], writer, progress)
+            write_nhd.array_directory(trace_path, {'paths': paths, 'times': times, 'dists': dists,
+                                                   'path_offsets': path_offsets, 'path_starts': path_starts},
+                                      attributes)
+            stage['paths'] = int(path_offsets.size - 1)
+            stage['spilled'] = writer.spilled
+            del paths, times, dists, path_offsets, path_starts
+            writer.cleanup()
+    traced = read_nhd.columnar_arrays(trace_path)
+
+    if checkpoint(map_path, cache_key):
+        profile.skip('map_paths')
+        profile.skip('index_paths')
+    else:
+        with profile.stage('map_paths', traced['path_offsets'].size - 1):
+            path_map = map_paths(traced['paths'], traced['path_offsets'], traced['path_starts'])
+        with profile.stage('index_paths', n_reaches):
+            index = upstream_index(traced['paths'], traced['path_offsets'], path_map)
+            parents = downstream_index(traced['paths'], traced['path_offsets'], path_map)
+            sorted_reaches, reach_order = reach_index(unpacked['conversion'])
+            write_nhd.array_directory(map_path, {'path_map': path_map, 'index': index, 'parents': parents,
+                                                 'sorted_reaches': sorted_reaches, 'reach_order': reach_order},
+                                      attributes)
+    mapped = read_nhd.columnar_arrays(map_path)
+
+    with profile.stage('navigator_file', n_reaches):
+        write_nhd.navigator_file(region, traced['paths'], traced['times'], traced['dists'], traced['path_offsets'],
+                                 mapped['path_map'], mapped['index'], mapped['parents'], unpacked['conversion'],
+                                 mapped['sorted_reaches'], mapped['reach_order'], cache_key=cache_key,
+                                 exits=(unpacked['exit_from'], unpacked['exit_to']))
+    del unpacked, traced, mapped
+    for path in (unpack_path, trace_path, map_path):
+        shutil.rmtree(path, ignore_errors=True)
+    profile.write(build_report_path.format(region), region=region, reaches=n_reaches, cache_key=cache_key)
+    report("Built navigator for region {} in {:.1f} seconds".format(region, time.time() - start_time), 2)
+
+
+def build_hydro_files(region, overwrite=False):
+    """
+    Build the flow and lake files for a region from EROM flows and waterbody morphology. Values are arranged in the
+    alias order of the region's navigator, which must be built first, and the files are rebuilt if the navigator or
+    the source data change.
+    :param region: NHD Hydroregion id (str)
+    :param overwrite: Rebuild even if the files are current (bool)
+    """
+    navigator_header = read_nhd.columnar_header(navigator_path.format(region))
+    if navigator_header is None:
+        raise FileNotFoundError("No navigator for region {}. Build the navigator first".format(region))
+    cache_key = condense_key(region, hydro_map_path)
+    attributes = {'region': region, 'cache_key': cache_key, 'navigator_key': navigator_header.get('cache_key')}
+    flow_path, lake_path = flow_file_path.format(region), lake_file_path.format(region)
+    current = [read_nhd.columnar_header(path) for path in (flow_path, lake_path)]
+    if not overwrite and all(header is not None and all(header.get(key) == value for key, value in attributes.items())
+                             for header in current):
+        report("Hydro files for region {} are up to date".format(region), 1)
+        return
+
+    reach_path, lake_table_path = (condensed_nhd_path.format('hydro', region, feature_type)
+                                   for feature_type in ('reach', 'waterbody'))
+    if overwrite or not (checkpoint(reach_path, cache_key) and checkpoint(lake_table_path, cache_key)):
+        report("Condensing NHD Plus for region {} hydro files...".format(region), 2)
+        reach_table, lake_table = condense_nhd(region, hydro_map_path, 'internal_name')
+        write_nhd.condensed_nhd('hydro', region, reach_table, lake_table, cache_key=cache_key)
+    reach_table = read_nhd.condensed_nhd('hydro', region, 'reach')
+    lake_table = read_nhd.condensed_nhd('hydro', region, 'waterbody')
+
+    conversion = np.asarray(Navigator(region).alias_to_reach)
+    report("Writing flow file...", 2)
+    write_nhd.array_directory(flow_path, flow_arrays(reach_table, conversion), dict(attributes, months=erom_months))
+    report("Writing lake file...", 2)
+    write_nhd.array_directory(lake_path, lake_arrays(lake_table, reach_table, conversion), attributes)
+
+
+def estimate_memory(region, memory_budget):
+    """
+    Estimate the peak memory needed to build a region from the number of reaches, which is read from the condensed
+    NHD table if it exists or from the headers of the NHD Plus tables
+    :param region: NHD Hydroregion id (str)
+    :param memory_budget: Bytes of traced paths to hold in memory before spilling to disk (int)
+    :return: Estimated bytes (int)
+    """
+    header = read_nhd.columnar_header(condensed_nhd_path.format('nav', region, 'reach'))
+    if header is not None:
+        n_reaches = header['n_rows']
+    else:
+        field_map = read_nhd.nhd_map(navigator_map_path, rename_field='internal_name')
+        counts = [read_nhd.dbf_record_count(path) for path in source_tables(region, field_map) if os.path.isfile(path)]
+        n_reaches = max(counts, default=0)
+    return n_reaches * bytes_per_reach + memory_budget
+
+
+def build_navigators(regions=None, workers=None, total_memory=2 ** 34, memory_budget=2 ** 30, spill_dir=None,
+                     overwrite=False, incremental=True, on_error='raise'):
+    """
+    Build navigators for several regions in parallel. Regions are started largest first, as long as the estimated
+    memory of the running regions stays within the total. A region that doesn't fit alongside others runs alone.
+    :param regions: NHD Hydroregion ids. All regions are built if not provided (list)
+    :param workers: Maximum number of regions to build at once (int)
+    :param total_memory: Bytes of memory available for all running builds (int)
+    :param memory_budget: Bytes of traced paths each build holds in memory before spilling to disk (int)
+    :param spill_dir: Directory for traced paths spilled to disk (str)
+    :param overwrite: Rebuild every stage (bool)
+    :param incremental: Update existing navigators when possible instead of rebuilding them (bool)
+    :param on_error: What to do with problems in the reach network: 'raise', 'skip' or 'repair' (str)
+    :return: Regions that failed to build (list)
+    """
+    regions = nhd_regions if regions is None else regions
+    workers = os.cpu_count() if workers is None else workers
+    estimates = {region: estimate_memory(region, memory_budget) for region in regions}
+    pending = sorted(regions, key=estimates.get, reverse=True)
+    running, failed = {}, []
+    with ProcessPoolExecutor(workers) as pool:
+        while pending or running:
+            in_use = sum(estimates[region] for region in running.values())
+            for region in list(pending):
+                if len(running) >= workers:
+                    break
+                if running and in_use + estimates[region] > total_memory:
+                    continue
+                pending.remove(region)
+                running[pool.submit(build_navigator, region, memory_budget, spill_dir, overwrite, incremental,
+                                    on_error)] = region
+                in_use += estimates[region]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                region = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    report("Failed to build region {}: {}".format(region, e), warn=2)
+                    failed.append(region)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build Navigator files for NHD Plus regions")
+    parser.add_argument('--regions', nargs='+', choices=nhd_regions, default=nhd_regions, help="Regions to build")
+    parser.add_argument('--workers', type=int, default=None, help="Maximum number of regions to build at once")
+    parser.add_argument('--memory', type=float, default=16., help="Memory available for all builds (GB)")
+    parser.add_argument('--path-memory', type=float, default=1., help="Memory for traced paths in each build (GB)")
+    parser.add_argument('--spill-dir', default=None, help="Directory for traced paths spilled to disk")
+    parser.add_argument('--overwrite', action='store_true', help="Rebuild every stage")
+    parser.add_argument('--full', action='store_true', help="Rebuild changed navigators instead of updating them")
+    parser.add_argument('--on-error', choices=['raise', 'skip', 'repair'], default='raise',
+                        help="What to do with problems in the reach network")
+    parser.add_argument('--hydro-files', action='store_true', help="Also build flow and lake files")
+    parser.add_argument('--spatial-index', action='store_true', help="Also build catchment and flowline indexes")
+    args = parser.parse_args()
+    failed = build_navigators(args.regions, args.workers, int(args.memory * 2 ** 30), int(args.path_memory * 2 ** 30),
+                              args.spill_dir, args.overwrite, not args.full, args.on_error)
+    if args.hydro_files:
+        for region in args.regions:
+            if region not in failed:
+                build_hydro_files(region, args.overwrite)
+    if args.spatial_index:
+        for region in args.regions:
+            spatial_nhd.build_indexes(region, args.overwrite)
+    if failed:
+        raise SystemExit("Failed to build regions {}".format(", ".join(failed)))
+
+
+if __name__ == '__main__':
+    main()
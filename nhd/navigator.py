@@ -1,74 +1,418 @@
 import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 import read_nhd
 import write_nhd
-from paths_nhd import navigator_path, navigator_map_path, condensed_nhd_path
+from paths_nhd import navigator_path, navigator_archive_path
 from tools_hydro.efed_lib import report
-from process_nhd import identify_outlet_reaches, process_divergence, condense_nhd
+from profile_nhd import Progress
+from process_nhd import identify_outlet_reaches, identify_region_exits, process_divergence
 from params_nhd import nhd_regions
 
 
+class NetworkError(ValueError):
+    """
+    Raised when the reach network can't be traced, for example because of a loop. The validation report, if any, is
+    attached (see validate_nhd.validate_network)
+    """
+
+    def __init__(self, message, validation=None):
+        super().__init__(message)
+        self.validation = validation
+
+
 class Navigator(object):
-    def __init__(self, region_id, upstream_path=None):
+    def __init__(self, region_id, upstream_path=None, arrays=None):
         if upstream_path is None:
             upstream_path = navigator_path.format(region_id)
+            if not os.path.isdir(upstream_path):
+                upstream_path = navigator_archive_path.format(region_id)
         self.file = upstream_path.format(region_id, 'nav', 'npz')
-        self.paths, self.times, self.lengths, \
-        self.map, self.alias_to_reach, self.reach_to_alias = self.load()
-        self.reach_ids = set(self.reach_to_alias.keys())
+        self.paths, self.times, self.lengths, self.offsets, self.map, self.index, self.parents, \
+        self.alias_to_reach, self.sorted_reaches, self.reach_order = self.load(arrays)
+        self._ancestors = None
+        self._extents = None
+        self._outlet_positions = None
 
-    def load(self):
-        assert os.path.isfile(self.file), "Upstream file {} not found".format(self.file)
-        data = np.load(self.file, mmap_mode='r', allow_pickle=True)
+        # Lookup tables built by another process, such as tables in shared memory, are used instead of building them
+        if arrays is not None and 'ancestors' in arrays:
+            self._ancestors = arrays['ancestors']
+        if arrays is not None and 'extent_time' in arrays:
+            self._extents = [arrays['extent_time'], arrays['extent_length'], arrays['extent_depth']]
+
+    def load(self, data=None):
+        # Navigator directories are memory-mapped. Compressed .npz files are read in full. Arrays that are already
+        # loaded, such as arrays in shared memory, can be passed in directly
+        if data is None and os.path.isdir(self.file):
+            data = read_nhd.columnar_arrays(self.file)
+        elif data is None:
+            assert os.path.isfile(self.file), "Upstream file {} not found".format(self.file)
+            data = np.load(self.file, allow_pickle=True)
         conversion_array = data['alias_index']
-        reverse_conversion = dict(zip(conversion_array, np.arange(conversion_array.size)))
-        return data['paths'], data['time'], data['length'], data['path_map'], conversion_array, reverse_conversion
+        paths, times, lengths, path_map = data['paths'], data['time'], data['length'], data['path_map']
 
-    def upstream_watershed(self, reach_id, mode='reach', return_times=False, return_lengths=False, return_warning=False,
-                           verbose=False):
+        # Older files store padded paths as an object array of rows, and have no upstream index
+        if 'path_offsets' in data:
+            path_offsets = data['path_offsets']
+        else:
+            path_offsets = np.append(0, np.cumsum([row.size for row in paths]))
+            paths, times, lengths = (np.concatenate(list(rows)) for rows in (paths, times, lengths))
+        if 'upstream_index' in data:
+            index = data['upstream_index']
+        else:
+            index = upstream_index(paths, path_offsets, path_map)
+        if 'parents' in data:
+            parents = data['parents']
+        else:
+            parents = downstream_index(paths, path_offsets, path_map)
+        if 'reach_order' in data:
+            sorted_reaches, reach_order = data['sorted_reaches'], data['reach_order']
+        else:
+            sorted_reaches, reach_order = reach_index(conversion_array)
+        return paths, times, lengths, path_offsets, path_map, index, parents, conversion_array, sorted_reaches, \
+               reach_order
 
-        def unpack(array):
-            first_row = [array[start_row][start_col:]]
-            remaining_rows = list(array[start_row + 1:end_row])
-            return np.concatenate(first_row + remaining_rows)
+    def arrays(self):
+        """
+        Get the navigator's arrays, named as in a navigator file
+        :return: Arrays indexed by name (dict)
+        """
+        return {'paths': self.paths, 'time': self.times, 'length': self.lengths, 'path_offsets': self.offsets,
+                'path_map': self.map, 'upstream_index': self.index, 'parents': self.parents,
+                'alias_index': self.alias_to_reach, 'sorted_reaches': self.sorted_reaches,
+                'reach_order': self.reach_order}
 
-        # Look up reach ID and fetch address from pstream object
-        reach = reach_id if mode == 'alias' else self.reach_to_alias.get(reach_id)
-        reaches, adjusted_times, warning = np.array([]), np.array([]), None
-        try:
-            start_row, end_row, col = map(int, self.map[reach])
-            start_col = list(self.paths[start_row]).index(reach)
-        except TypeError:
-            warning = "Reach {} not found in region".format(reach)
-        except ValueError:
+    def lookup_arrays(self):
+        """
+        Get the lookup tables that are otherwise built on first use (see ancestors and extents), building them now.
+        These can be passed to another Navigator with the arrays from arrays()
+        :return: Arrays indexed by name (dict)
+        """
+        extent_time, extent_length, extent_depth = self.extents
+        return {'ancestors': self.ancestors, 'extent_time': extent_time, 'extent_length': extent_length,
+                'extent_depth': extent_depth}
+
+    def aliases(self, reach_ids, mode='reach'):
+        """
+        Convert an array of reach IDs to aliases by binary search of the sorted reach IDs. Reaches that aren't in the
+        navigator are -1
+        :param reach_ids: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :return: Aliases (np.array)
+        """
+        reach_ids = np.asarray(reach_ids)
+        if mode == 'alias':
+            return np.where((reach_ids >= 0) & (reach_ids < self.index.shape[0]), reach_ids, -1)
+        positions = np.minimum(np.searchsorted(self.sorted_reaches, reach_ids), self.sorted_reaches.size - 1)
+        found = self.sorted_reaches[positions] == reach_ids
+        return np.where(found, self.reach_order[positions], -1)
+
+    def contains(self, reach_ids):
+        """
+        Test whether reaches are in the navigator
+        :param reach_ids: Reach IDs (np.array)
+        :return: Boolean array (np.array)
+        """
+        return self.aliases(reach_ids) >= 0
+
+    @property
+    def ancestors(self):
+        """
+        Binary lifting table, built on first use. Row k holds the reach 2 ** k steps downstream of each reach.
+        Outlets and untraced reaches point to themselves.
+        """
+        if self._ancestors is None:
+            ancestors = [np.where(self.parents >= 0, self.parents, np.arange(self.parents.size))]
+            for _ in range(max(1, int(self.map[:, 2].max()).bit_length()) - 1):
+                ancestors.append(ancestors[-1][ancestors[-1]])
+            self._ancestors = np.array(ancestors, dtype=np.int32)
+        return self._ancestors
+
+    @property
+    def extents(self):
+        """
+        Largest cumulative travel time, flow length and depth in the upstream block of each position in the path
+        array, built on first use. Each position passes its values to the position of the reach downstream of it,
+        one depth level at a time from the headwaters down.
+        """
+        if self._extents is None:
+            depths = self.map[self.paths, 2]
+            parents = self.parents[self.paths]
+            extents = [np.array(self.times), np.array(self.lengths), np.array(depths)]
+            order = np.argsort(depths, kind='stable')
+            levels = np.searchsorted(depths[order], np.arange(depths.max() + 2 if depths.size else 1))
+            for depth in range(levels.size - 2, 0, -1):
+                positions = order[levels[depth]:levels[depth + 1]]
+                positions = positions[parents[positions] >= 0]
+                downstream = self.index[parents[positions], 0]
+                for extent in extents:
+                    np.maximum.at(extent, downstream, extent[positions])
+            self._extents = extents
+        return self._extents
+
+    def is_upstream(self, upstream, downstream):
+        """
+        Test whether reaches are upstream of (or the same as) other reaches, by checking whether they fall within the
+        upstream block of the downstream reach
+        :param upstream: Aliases of upstream reaches (np.array)
+        :param downstream: Aliases of downstream reaches (np.array)
+        :return: Boolean array (np.array)
+        """
+        position, end = self.index[upstream, 0], self.index[downstream]
+        return (position >= 0) & (end[..., 0] >= 0) & (end[..., 0] <= position) & (position < end[..., 1])
+
+    def downstream_watershed(self, reach_id, mode='reach', return_times=False, return_lengths=False,
+                             return_warning=False, verbose=False):
+        """
+        Trace the flow path from a reach down to its outlet
+        :param reach_id: Reach ID, or alias if mode is 'alias' (int)
+        :param mode: 'reach' or 'alias' (str)
+        :param return_times: Also return travel times from the reach (bool)
+        :param return_lengths: Also return flow lengths from the reach (bool)
+        :param return_warning: Also return a warning if the reach isn't found (bool)
+        :param verbose: Report warnings (bool)
+        :return: Reaches along the flow path, starting with the reach itself (np.array)
+        """
+        reach = self.aliases([reach_id], mode)[0]
+        warning = None
+        if reach < 0:
+            warning = "Reach {} not found in region".format(reach_id)
+        elif self.index[reach, 0] < 0:
             warning = "{} not in upstream lookup".format(reach)
+        output = self.downstream_watersheds([reach], 'alias', return_times, return_lengths)
+        output[0] = output[0] if mode == 'alias' else np.int32(self.alias_to_reach[output[0]])
+        del output[1]
+        if return_warning:
+            output.append(warning)
+        if verbose and warning is not None:
+            report(warning, warn=1)
+        return output[0] if len(output) == 1 else output
+
+    def downstream_watersheds(self, reach_ids, mode='reach', return_times=False, return_lengths=False):
+        """
+        Trace the flow paths from many reaches down to their outlets at once. The depth of a reach gives the number of
+        reaches on its flow path, and the reach k steps down is found by lifting the reach through the rows of the
+        binary lifting table that match the bits of k, for every step of every path together. Results are returned
+        in compressed form, so that the flow path of query i is reaches[offsets[i]:offsets[i + 1]], starting with the
+        reach itself. Reaches that aren't found have empty flow paths.
+        :param reach_ids: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :param return_times: Also return travel times from each query reach (bool)
+        :param return_lengths: Also return flow lengths from each query reach (bool)
+        :return: Flat reach array and offsets (np.array, np.array), with times and lengths if requested
+        """
+        aliases = self.aliases(reach_ids, mode).astype(np.int64)
+        traced = aliases >= 0
+        traced[traced] = self.index[aliases[traced], 0] >= 0
+        counts = np.where(traced, self.map[np.maximum(aliases, 0), 2].astype(np.int64) + 1, 0)
+        steps, offsets = expand_ranges(np.zeros(counts.size, dtype=np.int64), counts)
+        rows = np.repeat(np.arange(counts.size), counts)
+        downstream = aliases[rows]
+        for bit, ancestors in enumerate(self.ancestors):
+            lift = (steps >> bit) & 1 == 1
+            downstream[lift] = ancestors[downstream[lift]]
+
+        result = [downstream if mode == 'alias' else np.int32(self.alias_to_reach[downstream]), offsets]
+        positions = self.index[downstream, 0]
+        origins = positions[offsets[rows]]
+        if return_times:
+            result.append(self.times[origins] - self.times[positions])
+        if return_lengths:
+            result.append(self.lengths[origins] - self.lengths[positions])
+        return result
+
+    def travel_times(self, from_ids, to_ids, mode='reach'):
+        """
+        Get the travel time and flow length between pairs of reaches. Values are positive when the 'to' reach is
+        downstream of the 'from' reach, negative when it is upstream, and NaN when the reaches aren't on the same flow
+        path. Travel time includes the 'from' reach and excludes the 'to' reach, as in upstream_watershed.
+        :param from_ids: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param to_ids: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :return: Travel times and flow lengths (np.array, np.array)
+        """
+        from_aliases, to_aliases = self.aliases(from_ids, mode), self.aliases(to_ids, mode)
+        from_positions, to_positions = self.index[from_aliases, 0], self.index[to_aliases, 0]
+        connected = (from_aliases >= 0) & (to_aliases >= 0) & \
+                    (self.is_upstream(from_aliases, to_aliases) | self.is_upstream(to_aliases, from_aliases))
+        times = np.where(connected, self.times[from_positions] - self.times[to_positions], np.nan)
+        lengths = np.where(connected, self.lengths[from_positions] - self.lengths[to_positions], np.nan)
+        return times, lengths
+
+    def outlets(self, reach_ids, mode='reach'):
+        """
+        Find the outlet that each reach drains to. Outlets begin the upstream blocks of their networks, so the outlet
+        is the nearest outlet at or before the reach in the path array.
+        :param reach_ids: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :return: Outlet reach IDs, or aliases if mode is 'alias'. Reaches that aren't found are -1 (np.array)
+        """
+        if self._outlet_positions is None:
+            self._outlet_positions = np.flatnonzero(self.parents[self.paths] < 0)
+        aliases = self.aliases(reach_ids, mode)
+        positions = self.index[aliases, 0]
+        outlets = self.paths[self._outlet_positions[np.searchsorted(self._outlet_positions, positions, 'right') - 1]]
+        outlets = np.where((aliases >= 0) & (positions >= 0), outlets, -1)
+        return outlets if mode == 'alias' else np.where(outlets >= 0, self.alias_to_reach[outlets], -1)
+
+    def confluences(self, reach_ids_a, reach_ids_b, mode='reach'):
+        """
+        Find the first reach downstream of both reaches in each pair (the lowest common ancestor), by lifting one
+        reach downstream in powers of two until the next step would take it below the confluence
+        :param reach_ids_a: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param reach_ids_b: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :return: Confluence reach IDs, or aliases if mode is 'alias'. Pairs that don't share an outlet are -1 (np.array)
+        """
+        a, b = self.aliases(reach_ids_a, mode), self.aliases(reach_ids_b, mode)
+        valid = (a >= 0) & (b >= 0)
+        a, b = np.where(valid, a, 0), np.where(valid, b, 0)
+        lifted = a.copy()
+        done = self.is_upstream(b, a)
+        for ancestors in self.ancestors[::-1]:
+            step = ancestors[lifted]
+            move = ~done & ~self.is_upstream(b, step)
+            lifted[move] = step[move]
+        confluence = np.where(done, a, self.ancestors[0][lifted])
+        confluence = np.where(valid & self.is_upstream(b, confluence), confluence, -1)
+        return confluence if mode == 'alias' else np.where(confluence >= 0, self.alias_to_reach[confluence], -1)
+
+    def upstream_watershed(self, reach_id, mode='reach', return_times=False, return_lengths=False, return_warning=False,
+                           verbose=False, max_days=None, max_length=None, max_depth=None, direct_size=2 ** 18):
+        """
+        Delineate the upstream watershed of a reach. The watershed can be limited to reaches within a travel time,
+        flow length or flow path depth of the queried reach, in which case very large upstream blocks are scanned so
+        that only the part within the limits is read (see bounded_blocks). Travel times (days) and flow lengths (m)
+        are measured from the queried reach, so the reach itself has zero time and length.
+        :param reach_id: Reach ID, or alias if mode is 'alias' (int)
+        :param mode: 'reach' or 'alias' (str)
+        :param return_times: Also return travel times to the reach (bool)
+        :param return_lengths: Also return flow lengths to the reach (bool)
+        :param return_warning: Also return a warning if the reach isn't found (bool)
+        :param verbose: Report warnings (bool)
+        :param max_days: Maximum travel time to the reach in days (float)
+        :param max_length: Maximum flow length to the reach in m (float)
+        :param max_depth: Maximum number of reaches on the flow path from an upstream reach to the reach, not
+        counting the reach itself (int)
+        :param direct_size: Number of positions up to which a limited block is read whole and filtered instead of
+        scanned (int)
+        :return: Upstream reaches, starting with the reach itself (np.array)
+        """
+        # Look up reach ID and fetch address from upstream index
+        reach = self.aliases([reach_id], mode)[0]
+        start = end = 0
+        warning = None
+        if reach < 0:
+            warning = "Reach {} not found in region".format(reach_id)
         else:
-            # Fetch upstream reaches and times
-            aliases = unpack(self.paths)
-            reaches = aliases if mode == 'alias' else np.int32(self.alias_to_reach[aliases])
+            start, end = self.index[reach]
+            if start < 0:
+                start = end = 0
+                warning = "{} not in upstream lookup".format(reach)
+
+        # Upstream reaches occupy a contiguous block of the path array. With limits, the block is only searched if
+        # its extents are past one of them. Filtering a whole block is cheaper than scanning it unless it's very large
+        positions = slice(start, end)
+        limits = (max_days, max_length, max_depth)
+        if end > start and any(limit is not None for limit in limits):
+            values = (lambda p: self.times[p], lambda p: self.lengths[p], lambda p: self.map[self.paths[p], 2])
+            origins = [value(start) for value in values]
+            if any(limit is not None and extent[start] - origin > limit
+                   for extent, origin, limit in zip(self.extents, origins, limits)):
+                if end - start <= direct_size:
+                    within = np.ones(end - start, dtype=bool)
+                    for value, origin, limit in zip(values, origins, limits):
+                        if limit is not None:
+                            within &= value(positions) - origin <= limit
+                    positions = start + np.flatnonzero(within)
+                else:
+                    positions, _ = self.bounded_blocks(np.array([start]), np.array([end]), *limits)
+        aliases = self.paths[positions]
+        reaches = aliases if mode == 'alias' else np.int32(self.alias_to_reach[aliases])
 
         # Determine which output to deliver
         output = [reaches]
         if return_times:
-            times = unpack(self.times)
-            adjusted_times = np.int32(times - self.times[start_row][start_col])
-            output.append(adjusted_times)
+            output.append(self.times[positions] - self.times[start] if end > start else self.times[:0])
         if return_lengths:
-            lengths = unpack(self.lengths)
-            output.append(lengths)
+            output.append(self.lengths[positions] - self.lengths[start] if end > start else self.lengths[:0])
         if return_warning:
             output.append(warning)
         if verbose and warning is not None:
             report(warning, warn=1)
         return output[0] if len(output) == 1 else output
 
+    def partition_watersheds(self, reach_ids, mode='reach', return_times=False, return_lengths=False):
+        """
+        Split the combined upstream watershed of a set of sites so that each upstream reach is assigned to its nearest
+        downstream site, and nest each site under its nearest downstream site. Upstream blocks are nested or disjoint,
+        so the nearest downstream site of a reach is the innermost block containing it, and the innermost block is
+        the last block to start at the same nesting depth. Every reach is assigned in one pass over the union of
+        the blocks, instead of one watershed query per site. Sites that aren't found have empty partitions, and a
+        site that repeats an earlier site has an empty partition nested under it.
+        :param reach_ids: Site reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :param return_times: Also return the travel time from each reach to its site (bool)
+        :param return_lengths: Also return the flow length from each reach to its site (bool)
+        :return: Flat reach array and offsets, so that the reaches assigned to site i are
+        reaches[offsets[i]:offsets[i + 1]], and the index of the nearest downstream site of each site, or -1
+        (np.array, np.array, np.array), with times and lengths if requested
+        """
+        aliases = self.aliases(reach_ids, mode).astype(np.int64)
+        bounds = np.full((aliases.size, 2), -1, dtype=np.int64)
+        bounds[aliases >= 0] = self.index[aliases[aliases >= 0]]
+        starts, ends = bounds.T
+        sites = np.flatnonzero(starts >= 0)
+        _, first = np.unique(starts[sites], return_index=True)
+        duplicates, sites = np.setdiff1d(sites, sites[first]), sites[first]
+
+        # Nesting depth of each position in the path array
+        coverage = np.zeros(self.paths.size + 1, dtype=np.int32)
+        np.add.at(coverage, starts[sites], 1)
+        np.add.at(coverage, ends[sites], -1)
+        depths = np.cumsum(coverage[:-1])
+
+        # Sort the blocks by depth and then start, so that the innermost block containing a position is found by
+        # binary search for the last block at the position's depth that starts at or before it
+        site_depths = depths[starts[sites]].astype(np.int64)
+        keys = site_depths * (self.paths.size + 1) + starts[sites]
+        key_order = np.argsort(keys)
+        sorted_keys, sorted_sites = keys[key_order], sites[key_order]
+        positions = np.flatnonzero(depths > 0)
+        labels = sorted_sites[np.searchsorted(sorted_keys, depths[positions] * (self.paths.size + 1) + positions,
+                                              'right') - 1]
+
+        # Each site is nested under the innermost block one level up that contains it
+        nesting = np.full(aliases.size, -1, dtype=np.int64)
+        nested = site_depths > 1
+        nesting[sites[nested]] = sorted_sites[np.searchsorted(
+            sorted_keys, (site_depths[nested] - 1) * (self.paths.size + 1) + starts[sites[nested]], 'right') - 1]
+        if duplicates.size:
+            site_index = np.full(self.paths.size, -1, dtype=np.int64)
+            site_index[starts[sites]] = sites
+            nesting[duplicates] = site_index[starts[duplicates]]
+
+        # Group the positions by site, keeping them in path order within each site
+        order = np.argsort(labels, kind='stable')
+        positions, labels = positions[order], labels[order]
+        offsets = np.zeros(aliases.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=aliases.size), out=offsets[1:])
+        upstream = self.paths[positions]
+        result = [upstream if mode == 'alias' else np.int32(self.alias_to_reach[upstream]), offsets, nesting]
+        if return_times:
+            result.append(self.times[positions] - self.times[starts[labels]])
+        if return_lengths:
+            result.append(self.lengths[positions] - self.lengths[starts[labels]])
+        return result
+
     def find_upstream(self, source_name, comid, join_table, direction='up'):
         try:
-            upstream = np.array(self.upstream_watershed(int(comid), return_times=True))
+            reaches, times = self.upstream_watershed(int(comid), return_times=True)
         except NameError:
             return None
-        upstream = pd.DataFrame(upstream.T, columns=['comid', 'days'])
+        upstream = pd.DataFrame({'comid': reaches, 'days': np.int32(times)})
         upstream_sites = upstream.merge(join_table, on='comid', how='inner')
         upstream_sites['direction'] = direction
         if direction == 'up':
@@ -80,69 +424,637 @@ class Navigator(object):
             upstream_sites['days'] = 0 - upstream_sites.days
         return upstream_sites
 
+    def pair_sites(self, stations, intakes, out_file=None, chunk_size=100000):
+        """
+        Pair every monitoring station with every drinking water intake on the same flow path in a single pass.
+        Intakes upstream of a station are paired in the 'up' direction, and stations upstream of an intake are
+        paired in the 'down' direction with negative travel times, as in find_upstream.
+        :param stations: Table of stations with 'site_id' and 'comid' fields (df)
+        :param intakes: Table of intakes with 'site_id' and 'comid' fields (df)
+        :param out_file: Path to a csv file. If provided, pairs are appended to the file in chunks (str)
+        :param chunk_size: Number of sites to pair in each chunk (int)
+        :return: Table of station_id, intake_id, direction, days, and distance, if no out_file is provided (df)
+        """
+        chunks = []
+        header = True
+        for direction, sources, targets in (('up', stations, intakes), ('down', intakes, stations)):
+            for source_index, target_index, days, distance in self.join_upstream(sources.comid.values,
+                                                                                 targets.comid.values, chunk_size):
+                sign = 1 if direction == 'up' else -1
+                station_index, intake_index = (source_index, target_index) if direction == 'up' else \
+                    (target_index, source_index)
+                chunk = pd.DataFrame({'station_id': stations.site_id.values[station_index],
+                                      'intake_id': intakes.site_id.values[intake_index],
+                                      'direction': direction, 'days': sign * days, 'distance': sign * distance})
+                if out_file is None:
+                    chunks.append(chunk)
+                else:
+                    chunk.to_csv(out_file, mode='w' if header else 'a', header=header, index=None)
+                    header = False
+
+        # Without any sites on one side there are no chunks, but the table (or file) still gets its columns
+        empty = pd.DataFrame({'station_id': stations.site_id.values[:0], 'intake_id': intakes.site_id.values[:0],
+                              'direction': np.zeros(0, dtype=object), 'days': np.zeros(0, dtype=np.int32),
+                              'distance': np.zeros(0, dtype=self.lengths.dtype)})
+        if out_file is None:
+            return pd.concat(chunks, ignore_index=True) if chunks else empty
+        if header:
+            empty.to_csv(out_file, index=None)
+
+    def join_upstream(self, sources, targets, chunk_size=100000):
+        """
+        Find every target reach upstream of each source reach with one sorted-index join. Targets are sorted by
+        their position in the path array, so the targets upstream of a source are the ones within its upstream block.
+        :param sources: Source reach IDs (np.array)
+        :param targets: Target reach IDs (np.array)
+        :param chunk_size: Number of sources to join in each chunk (int)
+        :return: Generator of source indices, target indices, travel times (days), and flow lengths for each chunk
+        """
+        target_aliases = self.aliases(targets)
+        target_index = np.flatnonzero(target_aliases >= 0)
+        target_positions = self.index[target_aliases[target_index], 0]
+        target_index = target_index[target_positions >= 0]
+        target_positions = target_positions[target_positions >= 0]
+        order = np.argsort(target_positions, kind='stable')
+        target_index, target_positions = target_index[order], target_positions[order]
+
+        source_aliases = self.aliases(sources)
+        for first in range(0, source_aliases.size, chunk_size):
+            chunk_aliases = source_aliases[first:first + chunk_size]
+            source_index = np.flatnonzero(chunk_aliases >= 0)
+            bounds = self.index[chunk_aliases[source_index]]
+            source_index, bounds = source_index[bounds[:, 0] >= 0], bounds[bounds[:, 0] >= 0]
+            lower = np.searchsorted(target_positions, bounds[:, 0])
+            upper = np.searchsorted(target_positions, bounds[:, 1])
+            matches, offsets = expand_ranges(lower, upper - lower)
+            source_positions = np.repeat(bounds[:, 0], upper - lower)
+            days = np.int32(self.times[target_positions[matches]] - self.times[source_positions])
+            distance = self.lengths[target_positions[matches]] - self.lengths[source_positions]
+            yield np.repeat(source_index, upper - lower) + first, target_index[matches], days, distance
+
     def batch_upstream(self, reaches):
-        all_upstream = {upstream for reach in reaches for upstream in self.upstream_watershed(reach)}
-        return pd.Series(sorted(all_upstream), name='comid')
+        return pd.Series(np.sort(self.upstream_watersheds(reaches, output='union')), name='comid')
+
+    def upstream_watersheds(self, reach_ids, mode='reach', output='paths', return_times=False, return_lengths=False,
+                            max_days=None, max_length=None, max_depth=None):
+        """
+        Delineate the upstream watersheds of many reaches at once. Results are returned in compressed form: a flat
+        array of upstream reaches and an array of offsets, so that the watershed of query i is
+        reaches[offsets[i]:offsets[i + 1]]. Reaches that aren't found have empty watersheds. Watersheds can be limited
+        to reaches within a travel time, flow length or flow path depth of each query (see bounded_blocks). Travel
+        times (days) and flow lengths (m) are measured from each query reach, as in upstream_watershed.
+        :param reach_ids: Reach IDs, or aliases if mode is 'alias' (np.array)
+        :param mode: 'reach' or 'alias' (str)
+        :param output: 'paths' for every watershed, 'union' for the unique reaches upstream of any query,
+        or 'count' for the number of upstream reaches of each query (str)
+        :param return_times: Also return travel times to each query reach, for 'paths' output (bool)
+        :param return_lengths: Also return flow lengths to each query reach, for 'paths' output (bool)
+        :param max_days: Maximum travel time to each query reach in days (float)
+        :param max_length: Maximum flow length to each query reach in m (float)
+        :param max_depth: Maximum number of reaches on the flow path from an upstream reach to each query reach, not
+        counting the query reach (int)
+        :return: Flat reach array and offsets (np.array, np.array), with times and lengths if requested
+        """
+        if output not in ('paths', 'union', 'count'):
+            raise ValueError("Invalid output {}. Must be 'paths', 'union', or 'count'".format(output))
+        aliases = self.aliases(reach_ids, mode)
+        found = aliases >= 0
+        bounds = np.zeros((aliases.size, 2), dtype=np.int64)
+        bounds[found] = self.index[aliases[found]]
+        bounds[bounds[:, 0] < 0] = 0
+        starts, ends = bounds.T
+        counts = ends - starts
+        bounded = not (max_days is None and max_length is None and max_depth is None)
+        if bounded:
+            positions, offsets = self.bounded_blocks(starts, ends, max_days, max_length, max_depth)
+            counts = np.diff(offsets)
+        if output == 'count':
+            return counts
+        elif output == 'union' and bounded:
+            aliases = self.paths[np.unique(positions)]
+            return aliases if mode == 'alias' else self.alias_to_reach[aliases]
+        elif output == 'union':
+            # Upstream blocks are nested or disjoint, so their union can be marked with a running count
+            coverage = np.zeros(self.paths.size + 1, dtype=np.int32)
+            np.add.at(coverage, starts, 1)
+            np.add.at(coverage, ends, -1)
+            aliases = self.paths[np.cumsum(coverage[:-1]) > 0]
+            return aliases if mode == 'alias' else self.alias_to_reach[aliases]
+
+        # Expand each query's block of the path array into one flat array of positions
+        if not bounded:
+            positions, offsets = expand_ranges(starts, counts)
+        upstream = self.paths[positions]
+        result = [upstream if mode == 'alias' else np.int32(self.alias_to_reach[upstream]), offsets]
+        if return_times:
+            result.append(self.times[positions] - np.repeat(self.times[starts], counts))
+        if return_lengths:
+            result.append(self.lengths[positions] - np.repeat(self.lengths[starts], counts))
+        return result
+
+    def bounded_blocks(self, starts, ends, max_days=None, max_length=None, max_depth=None, window=64,
+                       direct_size=2 ** 14, batch_size=2 ** 22):
+        """
+        Find the positions in blocks of the path array that are within a travel time, flow length or flow path depth
+        of the start of each block. Cumulative times, lengths and depths never decrease going upstream, so the value
+        at a reach is a lower bound for its whole upstream block, and the block's extent (see extents) is an upper
+        bound. Blocks whose extents are within the limits are taken as they are. Other blocks up to direct_size
+        positions are read whole and filtered, which is cheaper than skipping through them. Larger blocks are
+        scanned: when a reach is past a limit, the scan jumps to the end of the reach's upstream block instead of
+        reading it, and when the reach's whole upstream block is within the limits, the block is taken as one slice.
+        Large blocks are scanned together, in windows that double in size each pass.
+        :param starts: Start of each block (np.array)
+        :param ends: End of each block (np.array)
+        :param max_days: Maximum travel time in days (float)
+        :param max_length: Maximum flow length in m (float)
+        :param max_depth: Maximum number of reaches on the flow path from a position to the start, not counting the
+        start (int)
+        :param window: Number of positions to read from each large block in the first pass (int)
+        :param direct_size: Number of positions up to which a block, or the rest of a scanned block, is read whole (int)
+        :param batch_size: Maximum number of positions to read in one pass over all blocks (int)
+        :return: Flat positions and offsets, so that the positions in block i are positions[offsets[i]:offsets[i + 1]],
+        in path order (np.array, np.array)
+        """
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        limits = [(values, extent, limit) for values, extent, limit in
+                  zip((lambda p: self.times[p], lambda p: self.lengths[p], lambda p: self.map[self.paths[p], 2]),
+                      self.extents, (max_days, max_length, max_depth)) if limit is not None]
+        sizes = ends - starts
+
+        # Take blocks whose extents are within the limits as they are
+        nonempty = np.flatnonzero(sizes > 0)
+        inside = np.ones(nonempty.size, dtype=bool)
+        for values, extent, limit in limits:
+            inside &= extent[starts[nonempty]] - values(starts[nonempty]) <= limit
+        whole = nonempty[inside]
+        blocks = [np.repeat(whole, sizes[whole])]
+        found = [expand_ranges(starts[whole], sizes[whole])[0]]
+
+        # Read other small blocks whole and keep the positions within the limits
+        small = nonempty[~inside & (sizes[nonempty] <= direct_size)]
+        n_chunks = -(-int(sizes[small].sum()) // batch_size)
+        for chunk in (np.array_split(small, n_chunks) if n_chunks > 1 else [small]):
+            positions, _ = expand_ranges(starts[chunk], sizes[chunk])
+            rows = np.repeat(chunk, sizes[chunk])
+            within = np.ones(positions.size, dtype=bool)
+            for values, _, limit in limits:
+                within &= values(positions) - values(starts)[rows] <= limit
+            blocks.append(rows[within])
+            found.append(positions[within])
+
+        # Scan large blocks
+        stride = self.paths.size + 1
+        position = starts.copy()
+        active = nonempty[~inside & (sizes[nonempty] > direct_size)]
+        merge = active.size > 0 or (whole.size > 0 and small.size > 0)
+        while active.size:
+            share = max(batch_size // active.size, 1)
+            remaining = ends[active] - position[active]
+            counts = np.minimum(min(window, share), remaining)
+            counts[remaining <= min(direct_size, share)] = remaining[remaining <= min(direct_size, share)]
+            positions, _ = expand_ranges(position[active], counts)
+            rows = np.repeat(np.arange(active.size), counts)
+            past = np.zeros(positions.size, dtype=bool)
+            inside = np.ones(positions.size, dtype=bool)
+            for values, extent, limit in limits:
+                origin = np.repeat(values(starts[active]), counts)
+                past |= values(positions) - origin > limit
+                inside &= extent[positions] - origin <= limit
+            block_ends = self.index[self.paths[positions], 1].astype(np.int64)
+
+            # Skip positions in the upstream block of an earlier position in the window that was taken whole
+            taken = np.maximum.accumulate(rows * stride + np.where(inside, block_ends, 0)) - rows * stride
+            covered = np.zeros(positions.size, dtype=bool)
+            covered[1:] = (taken[:-1] > positions[1:]) & (rows[:-1] == rows[1:])
+            keep = ~covered & ~past
+            range_counts = np.where(inside[keep], block_ends[keep] - positions[keep], 1)
+            blocks.append(np.repeat(active[rows[keep]], range_counts))
+            found.append(expand_ranges(positions[keep], range_counts)[0])
+
+            # Continue after the window, or after the end of the last upstream block that's past or within the limits
+            next_position = position[active] + counts
+            jump = past | inside
+            np.maximum.at(next_position, rows[jump], block_ends[jump])
+            position[active] = next_position
+            active = active[next_position < ends[active]]
+            window *= 2
+
+        # Whole and small blocks are each in order, and scanned blocks are read over several passes
+        blocks, positions = np.concatenate(blocks), np.concatenate(found)
+        if merge:
+            order = np.argsort(blocks, kind='stable')
+            blocks, positions = blocks[order], positions[order]
+        offsets = np.zeros(starts.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(blocks, minlength=starts.size), out=offsets[1:])
+        return positions, offsets
+
+
+class NationalNavigator(object):
+    """
+    Navigate across NHD Plus regions. Each region is built separately, with reaches that drain into another region
+    recorded as exits. Region navigators are loaded when a query first reaches them, and results are combined with
+    travel times and flow lengths measured from the queried reach. Requires navigators in the directory format.
+    """
+
+    def __init__(self, regions=None, upstream_path=None):
+        self.path = navigator_path if upstream_path is None else upstream_path
+        regions = nhd_regions if regions is None else regions
+        self.regions = [region for region in regions if read_nhd.columnar_header(self.path.format(region))]
+        self.navigators = {}
+
+        # The sorted reach IDs of each region are memory-mapped to find the region of a reach
+        self.sorted_reaches = {region: read_nhd.columnar_arrays(self.path.format(region), ['sorted_reaches'])
+                               ['sorted_reaches'] for region in self.regions}
+
+        # Link each exit to the reach it drains to in the downstream region
+        self.exits, self.entries = {}, {}
+        for region in self.regions:
+            exits = read_nhd.columnar_arrays(self.path.format(region), ['exit_from', 'exit_to'], mmap_mode=None)
+            down_regions = self.region_of(exits['exit_to'])
+            linked = down_regions != ''
+            self.exits[region] = pd.DataFrame({'exit_from': exits['exit_from'][linked],
+                                               'exit_to': exits['exit_to'][linked], 'region': down_regions[linked]})
+        if self.exits:
+            links = pd.concat([exits.assign(up_region=region) for region, exits in self.exits.items()])
+            self.entries = {region: entries for region, entries in links.groupby('region')}
+
+    def navigator(self, region):
+        if region not in self.navigators:
+            self.navigators[region] = Navigator(region, self.path.format(region))
+        return self.navigators[region]
+
+    def region_of(self, reach_ids):
+        """
+        Find the region containing each reach
+        :param reach_ids: Reach IDs (np.array)
+        :return: Region ids, blank for reaches that aren't found (np.array)
+        """
+        reach_ids = np.asarray(reach_ids)
+        regions = np.full(reach_ids.shape, '', dtype=object)
+        for region, sorted_reaches in self.sorted_reaches.items():
+            positions = np.minimum(np.searchsorted(sorted_reaches, reach_ids), sorted_reaches.size - 1)
+            regions[sorted_reaches[positions] == reach_ids] = region
+        return regions
+
+    def upstream_watershed(self, reach_id, region=None, return_times=False, return_lengths=False):
+        """
+        Delineate the upstream watershed of a reach, following exits from upstream regions into the watershed. Travel
+        times and flow lengths include each upstream reach and exclude the queried reach.
+        :param reach_id: Reach ID (int)
+        :param region: Region of the reach, found from the reach ID if not provided (str)
+        :param return_times: Also return travel times to the reach (bool)
+        :param return_lengths: Also return flow lengths to the reach (bool)
+        :return: Upstream reach IDs (np.array)
+        """
+        region = self.region_of([reach_id])[0] if region is None else region
+        reaches, times, lengths = [], [], []
+        queue = [(region, reach_id, 0., 0., False)] if region else []
+        while queue:
+            region, reach_id, time_offset, length_offset, entering = queue.pop()
+            nav = self.navigator(region)
+            alias = nav.aliases([reach_id])[0]
+            if alias < 0 or nav.index[alias, 0] < 0:
+                continue
+            start, end = nav.index[alias]
+
+            # Cumulative times and lengths are measured from the region outlet and include the outlet itself, so an
+            # exit entering the watershed carries its full cumulative values
+            origin_time, origin_length = (0., 0.) if entering else (nav.times[start], nav.lengths[start])
+            reaches.append(nav.alias_to_reach[nav.paths[start:end]])
+            times.append(nav.times[start:end] - origin_time + time_offset)
+            lengths.append(nav.lengths[start:end] - origin_length + length_offset)
+            entries = self.entries.get(region)
+            if entries is not None:
+                positions = nav.index[nav.aliases(entries.exit_to.values), 0]
+                inside = (positions >= start) & (positions < end)
+                for up_region, exit_from, position in \
+                        zip(entries.up_region.values[inside], entries.exit_from.values[inside], positions[inside]):
+                    queue.append((up_region, exit_from, nav.times[position] - origin_time + time_offset,
+                                  nav.lengths[position] - origin_length + length_offset, True))
+
+        reaches = np.concatenate(reaches) if reaches else np.zeros(0, dtype=np.int32)
+        output = [reaches]
+        if return_times:
+            output.append(np.concatenate(times) if times else np.zeros(0, dtype=np.float32))
+        if return_lengths:
+            output.append(np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.float32))
+        return output[0] if len(output) == 1 else output
+
+    def downstream_watershed(self, reach_id, region=None, return_times=False, return_lengths=False):
+        """
+        Trace the flow path from a reach down to its outlet, following exits into downstream regions
+        :param reach_id: Reach ID (int)
+        :param region: Region of the reach, found from the reach ID if not provided (str)
+        :param return_times: Also return travel times from the reach (bool)
+        :param return_lengths: Also return flow lengths from the reach (bool)
+        :return: Reaches along the flow path, starting with the reach itself (np.array)
+        """
+        region = self.region_of([reach_id])[0] if region is None else region
+        reaches, times, lengths = [], [], []
+        time_offset = length_offset = 0.
+        while region:
+            nav = self.navigator(region)
+            path, path_times, path_lengths = \
+                nav.downstream_watershed(reach_id, return_times=True, return_lengths=True)
+            if not path.size:
+                break
+            reaches.append(path)
+            times.append(path_times + time_offset)
+            lengths.append(path_lengths + length_offset)
 
+            # An exit's downstream reach is reached after the full cumulative time and length of the reach
+            exits = self.exits[region]
+            exit_to = exits.exit_to.values[exits.exit_from.values == path[-1]]
+            if not exit_to.size:
+                break
+            position = nav.index[nav.aliases([reach_id])[0], 0]
+            time_offset += nav.times[position]
+            length_offset += nav.lengths[position]
+            reach_id, region = exit_to[0], exits.region.values[exits.exit_from.values == path[-1]][0]
 
-def collapse_array(paths, times, lengths):
+        reaches = np.concatenate(reaches) if reaches else np.zeros(0, dtype=np.int32)
+        output = [reaches]
+        if return_times:
+            output.append(np.concatenate(times) if times else np.zeros(0, dtype=np.float32))
+        if return_lengths:
+            output.append(np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.float32))
+        return output[0] if len(output) == 1 else output
+
+
+def reach_index(conversion):
     """
-    Reduce the size of input arrays by truncating at the path length
-    :param paths: Array with node IDs (np.array)
-    :param times: Array with reach travel times (np.array)
-    :param lengths: Array with reach lengths (np.array)
-    :return:
+    Sort reach IDs for lookup by binary search
+    :param conversion: Reach ID for each alias (np.array)
+    :return: Sorted reach IDs, and the alias of each sorted reach ID (np.array, np.array)
     """
-    out_paths = []
-    out_times = []
-    out_lengths = []
-    path_starts = []
-    for i, row in enumerate(paths):
-        active_path = (row > 0)
-        path_starts.append(np.argmax(active_path))
-        out_paths.append(row[active_path])
-        out_times.append(times[i][active_path])
-        out_lengths.append(lengths[i][active_path])
-    return map(np.array, (out_paths, out_times, out_lengths, path_starts))
-
-
-def map_paths(paths):
+    reach_order = np.argsort(conversion, kind='stable').astype(np.int32)
+    return conversion[reach_order], reach_order
+
+
+def expand_ranges(starts, counts):
     """
-    Get the starting row and column for each path in the path array
-    :param paths: Path array (np.array)
-    :return:
+    Expand a set of ranges into one flat array of positions, so that range i is
+    positions[offsets[i]:offsets[i + 1]]
+    :param starts: First position in each range (np.array)
+    :param counts: Number of positions in each range (np.array)
+    :return: Flat positions and offsets of each range (np.array, np.array)
     """
+    offsets = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    positions = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+    return positions, offsets
 
-    column_numbers = np.tile(np.arange(paths.shape[1]) + 1, (paths.shape[0], 1)) * (paths > 0)
-    path_begins = np.argmax(column_numbers > 0, axis=1)
-    max_reach = np.max(paths)
-    path_map = np.zeros((max_reach + 1, 3))
-    n_paths = paths.shape[0]
-    for i, path in enumerate(paths):
-        for j, val in enumerate(path):
-            if val:
-                if i == n_paths:
-                    end_row = 0
-                else:
-                    next_row = (path_begins[i + 1:] <= j)
-                    if next_row.any():
-                        end_row = np.argmax(next_row)
-                    else:
-                        end_row = n_paths - i - 1
-                values = np.array([i, i + end_row + 1, j])
-                path_map[val] = values
 
+def path_depths(path_offsets, path_starts):
+    """
+    Get the distance from the outlet, in reaches, of each node in a flat path array
+    :param path_offsets: Position of the start of each path in the flat array (np.array)
+    :param path_starts: Distance from the outlet to the first node of each path (np.array)
+    :return: Depth of each node (np.array)
+    """
+    rows = np.repeat(np.arange(path_starts.size), np.diff(path_offsets))
+    return (path_starts[rows] + np.arange(rows.size) - path_offsets[rows]).astype(np.int32)
+
+
+def path_parents(depths, path_offsets):
+    """
+    Get the position in a flat path array of the node immediately downstream of each node. Nodes are stored in
+    the order they were traced, so each node follows its parent except at the start of a path, where the parent is
+    the most recent node one step closer to the outlet.
+    :param depths: Distance from the outlet of each node (np.array)
+    :param path_offsets: Position of the start of each path in the flat array (np.array)
+    :return: Position of each node's parent, or -1 for outlets (np.array)
+    """
+    n_nodes = depths.size
+    parents = np.arange(-1, n_nodes - 1, dtype=np.int64)
+
+    # Sort nodes by depth, then position, and search for the last node one level down from each path start
+    order = np.lexsort((np.arange(n_nodes), depths))
+    keys = depths[order].astype(np.int64) * (n_nodes + 1) + order
+    row_starts = path_offsets[:-1]
+    parents[row_starts] = -1
+    branches = row_starts[depths[row_starts] > 0]
+    queries = (depths[branches].astype(np.int64) - 1) * (n_nodes + 1) + branches
+    parents[branches] = order[np.searchsorted(keys, queries) - 1]
+    return parents
+
+
+def subtree_sizes(depths, parents):
+    """
+    Count the nodes upstream of each node, including itself, by adding each level of the network into the next
+    level downstream, starting from the headwaters
+    :param depths: Distance from the outlet of each node (np.array)
+    :param parents: Position of each node's parent (np.array)
+    :return: Number of nodes in the upstream subtree of each node (np.array)
+    """
+    sizes = np.ones(depths.size, dtype=np.int64)
+    if not depths.size:
+        return sizes
+    order = np.argsort(depths, kind='stable')
+    level_bounds = np.searchsorted(depths[order], np.arange(depths.max() + 2))
+    for level in range(depths.max(), 0, -1):
+        level_nodes = order[level_bounds[level]:level_bounds[level + 1]]
+        np.add.at(sizes, parents[level_nodes], sizes[level_nodes])
+    return sizes
+
+
+def map_paths(paths, path_offsets, path_starts):
+    """
+    Get the starting row, ending row and starting column of the upstream paths for each node. The upstream
+    paths for a node begin at its own row and continue until the next row that branches off at or below the node.
+    Because the paths are stored in traversal order, that's where the node's upstream subtree ends.
+    :param paths: Flat array of traced node IDs (np.array)
+    :param path_offsets: Position of the start of each path in the flat array (np.array)
+    :param path_starts: Distance from the outlet to the first node of each path (np.array)
+    :return: Array of start row, end row, and start column, indexed by node ID (np.array)
+    """
+    depths = path_depths(path_offsets, path_starts)
+    sizes = subtree_sizes(depths, path_parents(depths, path_offsets))
+    start_rows = np.repeat(np.arange(path_starts.size), np.diff(path_offsets))
+    end_rows = np.searchsorted(path_offsets, np.arange(paths.size) + sizes)
+    path_map = np.zeros((np.max(paths) + 1, 3), dtype=np.int32)
+    path_map[paths] = np.column_stack((start_rows, end_rows, depths))
     return path_map
 
 
+def upstream_index(paths, path_offsets, path_map):
+    """
+    Build a nested-interval index of the path array. Paths are stored in the order they were traced, which is a
+    depth-first preorder of the network, so everything upstream of a node sits in one contiguous block that starts
+    at the node itself and ends where the node's last upstream path ends.
+    :param paths: Flat array of traced node IDs (np.array)
+    :param path_offsets: Position of the start of each path in the flat array (np.array)
+    :param path_map: Array of start row, end row, and start column, indexed by node ID (np.array)
+    :return: Array of the start and end of the upstream block, indexed by node ID. Untraced nodes are -1 (np.array)
+    """
+    index = np.full((path_map.shape[0], 2), -1, dtype=np.int32)
+    index[paths, 0] = np.arange(paths.size)
+    index[paths, 1] = path_offsets[path_map[paths, 1].astype(np.int64)]
+    return index
+
+
+def downstream_index(paths, path_offsets, path_map):
+    """
+    Get the reach immediately downstream of each traced reach
+    :param paths: Flat array of traced node IDs (np.array)
+    :param path_offsets: Position of the start of each path in the flat array (np.array)
+    :param path_map: Array of start row, end row, and start column, indexed by node ID (np.array)
+    :return: Parent of each node, indexed by node ID. Outlets and untraced nodes are -1 (np.array)
+    """
+    positions = path_parents(path_map[paths, 2].astype(np.int32), path_offsets)
+    parents = np.full(path_map.shape[0], -1, dtype=np.int32)
+    parents[paths] = np.where(positions >= 0, paths[positions], -1)
+    return parents
+
+
 def process_nhd(nhd_table):
     nhd_table = process_divergence(nhd_table)
+    nhd_table = identify_region_exits(nhd_table)
     nhd_table = identify_outlet_reaches(nhd_table)
     nhd_table = nhd_table[nhd_table.comid != 0]
     return nhd_table
 
 
-def rapid_trace(nodes, outlets, times, dists, conversion, max_length=3000, max_paths=500000):
+def adjacency_index(nodes, n_nodes):
+    """
+    Build a compressed (CSR) index of the reaches immediately upstream of each node. The upstream neighbours of
+    node i are neighbours[offsets[i]:offsets[i + 1]], in the same order as they appear in the node table.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Offsets into the neighbour array and the neighbour array (np.array, np.array)
+    """
+    to_nodes, from_nodes = nodes[:, 0], nodes[:, 1]
+    linked = (to_nodes >= 0) & (from_nodes >= 0)
+    to_nodes, from_nodes = to_nodes[linked], from_nodes[linked]
+
+    # A stable sort preserves table order among the upstream neighbours of each node
+    neighbours = from_nodes[np.argsort(to_nodes, kind='stable')].astype(np.int32)
+    offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(to_nodes, minlength=n_nodes), out=offsets[1:])
+    return offsets, neighbours
+
+
+class PathWriter(object):
+    """
+    Streams traced flow paths into chunked flat buffers. Paths are written end to end and located with an offsets
+    array, so there is no limit on the number or length of paths. Completed chunks are spilled to memory-mapped files
+    on disk once the chunks held in memory exceed the memory budget.
+    """
+    fields = (('paths', np.int32), ('times', np.float32), ('lengths', np.float32))
+
+    def __init__(self, chunk_size=2 ** 20, memory_budget=2 ** 31, spill_dir=None):
+        """
+        :param chunk_size: Number of path nodes held in each buffer chunk (int)
+        :param memory_budget: Bytes of completed chunks to hold in memory before spilling to disk (int)
+        :param spill_dir: Directory for spilled chunks. A temporary directory is created if not provided (str)
+        """
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.temp_dir = None
+        self.chunks = []
+        self.in_memory = 0
+        self.spilled = False
+
+        # Cursors
+        self.active = self.new_chunk()
+        self.chunk_cursor = 0
+        self.n_paths = 0
+        self.size = 0
+
+        # Growable arrays for the start of each path in the flat buffers and its distance from the outlet
+        self.offsets = np.zeros(1024, dtype=np.int64)
+        self.starts = np.zeros(1024, dtype=np.int32)
+
+    def new_chunk(self):
+        return [np.zeros(self.chunk_size, dtype=dtype) for _, dtype in self.fields]
+
+    def spill_path(self, name):
+        if self.temp_dir is None:
+            if self.spill_dir is not None and not os.path.exists(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            self.temp_dir = tempfile.mkdtemp(prefix='navigator_', dir=self.spill_dir)
+        return os.path.join(self.temp_dir, name)
+
+    def flush(self, size):
+        """ Move the active chunk to the completed chunks, spilling it to disk if over the memory budget """
+        chunk = [array[:size] for array in self.active]
+        chunk_bytes = sum(array.nbytes for array in chunk)
+        if self.in_memory + chunk_bytes > self.memory_budget:
+            spilled = []
+            for (field, dtype), array in zip(self.fields, chunk):
+                out_file = self.spill_path("{}_{}.dat".format(field, len(self.chunks)))
+                spill = np.memmap(out_file, dtype=dtype, mode='w+', shape=array.shape)
+                spill[:] = array
+                spill.flush()
+                spilled.append(spill)
+            chunk = spilled
+            self.spilled = True
+        else:
+            self.in_memory += chunk_bytes
+        self.chunks.append(chunk)
+        self.active = self.new_chunk()
+        self.chunk_cursor = 0
+
+    def append(self, path, times, lengths, start):
+        """
+        Add a completed path to the buffers
+        :param path: Node IDs in the path (np.array)
+        :param times: Cumulative travel times from the outlet to each node (np.array)
+        :param lengths: Cumulative flow lengths from the outlet to each node (np.array)
+        :param start: Distance from the outlet to the first node of the path (int)
+        """
+        if self.n_paths == self.offsets.size:
+            self.offsets = np.concatenate([self.offsets, np.zeros_like(self.offsets)])
+            self.starts = np.concatenate([self.starts, np.zeros_like(self.starts)])
+        self.offsets[self.n_paths] = self.size
+        self.starts[self.n_paths] = start
+        self.n_paths += 1
+
+        written = 0
+        while written < path.size:
+            n = min(self.chunk_size - self.chunk_cursor, path.size - written)
+            for buffer, values in zip(self.active, (path, times, lengths)):
+                buffer[self.chunk_cursor:self.chunk_cursor + n] = values[written:written + n]
+            self.chunk_cursor += n
+            written += n
+            if self.chunk_cursor == self.chunk_size:
+                self.flush(self.chunk_size)
+        self.size += path.size
+
+    def finish(self):
+        """
+        Assemble the buffered paths into flat arrays. If any chunks have been spilled to disk, the output arrays
+        are also memory-mapped.
+        :return: Flat arrays of path nodes, cumulative times and cumulative lengths, the offset of each path in the
+        flat arrays, and the distance from the outlet to the first node of each path (np.array)
+        """
+        if self.chunk_cursor:
+            self.flush(self.chunk_cursor)
+        out_arrays = []
+        for i, (field, dtype) in enumerate(self.fields):
+            if self.spilled:
+                out_array = np.memmap(self.spill_path("{}.dat".format(field)), dtype=dtype, mode='w+',
+                                      shape=(self.size,))
+            else:
+                out_array = np.zeros(self.size, dtype=dtype)
+            cursor = 0
+            for chunk in self.chunks:
+                out_array[cursor:cursor + chunk[i].size] = chunk[i]
+                cursor += chunk[i].size
+            out_arrays.append(out_array)
+        self.chunks = []
+        offsets = np.append(self.offsets[:self.n_paths], self.size)
+        return out_arrays + [offsets, self.starts[:self.n_paths].copy()]
+
+    def cleanup(self):
+        """ Remove the spilled chunks once the output arrays are no longer needed """
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+
+def rapid_trace(nodes, outlets, times, dists, conversion, writer=None, progress=None):
     """
     Trace upstream through the NHD Plus hydrography network and record paths,
     times, and lengths of traversals.
@@ -151,33 +1063,35 @@ def rapid_trace(nodes, outlets, times, dists, conversion, max_length=3000, max_p
     :param times: Array of travel times corresponding to nodes (np.array)
     :param dists: Array of flow lengths corresponding to nodes (np.array)
     :param conversion: Array to interpret node aliases (np.array)
-    :param max_length: Maximum length of flow path (int)
-    :param max_paths: Maximum number of flow paths (int)
-    :return:
+    :param writer: Buffer that receives completed paths. A default PathWriter is used if not provided (PathWriter)
+    :param progress: Progress reporter, given the number of reaches traced so far (Progress)
+    :return: Flat arrays of path nodes, cumulative times and cumulative lengths, the offset of each path in the flat
+    arrays, and the distance from the outlet to the first node of each path (np.array)
     """
-    # Output arrays
-    all_paths = np.zeros((max_paths, max_length), dtype=np.int32)
-    all_times = np.zeros((max_paths, max_length), dtype=np.float32)
-    all_dists = np.zeros((max_paths, max_length), dtype=np.float32)
+    writer = PathWriter() if writer is None else writer
+    progress = Progress(conversion.size, "Traced reaches") if progress is None else progress
+
+    # Index the upstream neighbours of each node once, rather than searching the node table at every step
+    offsets, neighbours = adjacency_index(nodes, conversion.size)
+    times = np.asarray(times, dtype=np.float32)
+    dists = np.asarray(dists, dtype=np.float32)
 
-    # Bounds
-    path_cursor = 0
-    longest_path = 0
+    n_traced = 0  # Master counter, counts how many reaches have been processed
+    visited = np.zeros(conversion.size, dtype=bool)  # The traversal shouldn't hit the same reach more than once
+    depth = np.zeros(conversion.size, dtype=np.int32)  # Position of each visited node on the active path
 
-    progress = 0  # Master counter, counts how many reaches have been processed
-    already = set()  # This is diagnostic - the traversal shouldn't hit the same reach more than once
+    # Working arrays are allocated once. Each node is queued at most once, so the queue can't overflow.
+    # The active path arrays hold cumulative times and lengths, and are extended if a path outgrows them
+    queue = np.zeros((nodes.shape[0] + 1, 2), dtype=np.int32)
+    active_reach = np.zeros(1024, dtype=np.int32)
+    active_times = np.zeros(1024, dtype=np.float32)
+    active_dists = np.zeros(1024, dtype=np.float32)
 
     # Iterate through each outlet
     for i in np.arange(outlets.size):
         start_node = outlets[i]
 
-        # Reset everything except the master. Trace is done separately for each outlet
-        queue = np.zeros((nodes.shape[0], 2), dtype=np.int32)
-        active_reach = np.zeros(max_length, dtype=np.int32)
-        active_times = np.zeros(max_length, dtype=np.float32)
-        active_dists = np.zeros(max_length, dtype=np.float32)
-
-        # Cursors
+        # Cursors. Trace is done separately for each outlet
         start_cursor = 0
         queue_cursor = 0
         active_reach_cursor = 0
@@ -186,57 +1100,53 @@ def rapid_trace(nodes, outlets, times, dists, conversion, max_length=3000, max_p
         # Traverse upstream from the outlet.
         while True:
             # Report progress
-            progress += 1
-            if not progress % 10000:
-                report(progress, 3)
-            upstream = nodes[nodes[:, 0] == active_node]
+            n_traced += 1
+            if not n_traced % 10000:
+                progress.update(n_traced)
 
             # Check to make sure active node hasn't already been passed
-            l1 = len(already)
-            already.add(conversion[active_node])
-            if len(already) == l1:
-                report("Loop at reach {}".format(conversion[active_node]))
-                exit()
+            if visited[active_node]:
+                raise NetworkError("Reach {} was reached twice while tracing from outlet {}. Check the network with "
+                                   "validate_nhd.validate_network".format(conversion[active_node],
+                                                                          conversion[start_node]))
+            visited[active_node] = True
+            depth[active_node] = active_reach_cursor
 
-            # Add the active node and time to the active path arrays
-            active_reach[active_reach_cursor] = active_node
-            active_times[active_reach_cursor] = times[active_node]
-            active_dists[active_reach_cursor] = dists[active_node]
+            if active_reach_cursor == active_reach.size:
+                active_reach, active_times, active_dists = \
+                    (np.concatenate([a, np.zeros_like(a)]) for a in (active_reach, active_times, active_dists))
 
-            # Advance the cursor and determine if a longest path has been set
+            # Add the active node and cumulative time and length to the active path arrays
+            active_reach[active_reach_cursor] = active_node
+            if active_reach_cursor:
+                active_times[active_reach_cursor] = active_times[active_reach_cursor - 1] + times[active_node]
+                active_dists[active_reach_cursor] = active_dists[active_reach_cursor - 1] + dists[active_node]
+            else:
+                active_times[0] = times[active_node]
+                active_dists[0] = dists[active_node]
             active_reach_cursor += 1
-            if active_reach_cursor > longest_path:
-                longest_path = active_reach_cursor
 
             # If there is another reach upstream, continue to advance upstream
-            if upstream.size:
-                active_node = upstream[0][1]
-                for j in range(1, upstream.shape[0]):
-                    queue[queue_cursor] = upstream[j]
+            first, last = offsets[active_node], offsets[active_node + 1]
+            if last > first:
+                for j in range(first + 1, last):
+                    queue[queue_cursor] = active_node, neighbours[j]
                     queue_cursor += 1
+                active_node = neighbours[first]
 
-            # If not, write the active path arrays into the output matrices
+            # If not, write the new part of the active path to the output buffers
             else:
-                all_paths[path_cursor, start_cursor:] = active_reach[start_cursor:]
-                all_times[path_cursor] = np.cumsum(active_times) * (all_paths[path_cursor] > 0)
-                all_dists[path_cursor] = np.cumsum(active_dists) * (all_paths[path_cursor] > 0)
+                writer.append(active_reach[start_cursor:active_reach_cursor],
+                              active_times[start_cursor:active_reach_cursor],
+                              active_dists[start_cursor:active_reach_cursor], start_cursor)
+                if queue_cursor == 0:
+                    break
                 queue_cursor -= 1
-                path_cursor += 1
                 last_node, active_node = queue[queue_cursor]
-                if last_node == 0 and active_node == 0:
-                    break
-                for j in range(active_reach.size):
-                    if active_reach[j] == last_node:
-                        active_reach_cursor = j + 1
-                        break
+                active_reach_cursor = depth[last_node] + 1
                 start_cursor = active_reach_cursor
-                active_reach[active_reach_cursor:] = 0.
-                active_times[active_reach_cursor:] = 0.
-                active_dists[active_reach_cursor:] = 0.
 
-    return all_paths[:path_cursor, :longest_path], \
-           all_times[:path_cursor, :longest_path], \
-           all_dists[:path_cursor, :longest_path]
+    return writer.finish()
 
 
 def unpack_nhd(nhd_table):
@@ -245,13 +1155,15 @@ def unpack_nhd(nhd_table):
     :param nhd_table: Table of NHD Plus parameters (df)
     :return: Modified NHD table with selected fields
     """
-    # Extract nodes and travel times
+    # Extract nodes and travel times. Reaches with more than one row take the times of the first row, and are
+    # reported by validate_nhd
+    first = ~nhd_table.comid.duplicated().values
     nodes = nhd_table[['tocomid', 'comid']]
-    times = nhd_table['travel_time'].values
-    dists = nhd_table['lengthkm'].values * 1000.  # km -> m
+    times = nhd_table['travel_time'].values[first]
+    dists = nhd_table['lengthkm'].values[first] * 1000.  # km -> m
 
     # Create an alias for nodes
-    convert = pd.Series(np.arange(nhd_table.comid.size), index=nhd_table.comid.drop_duplicates())
+    convert = pd.Series(np.arange(first.sum()), index=nhd_table.comid.values[first])
     nodes = nodes.apply(lambda row: row.map(convert)).fillna(-1).astype(np.int32)
 
     # Extract outlets from aliased nodes
@@ -264,46 +1176,16 @@ def unpack_nhd(nhd_table):
     return nodes.values, times, dists, outlets, conversion_array
 
 
-def build_navigator(region, nhd_table):
+def convert_navigator(region, in_path=None, out_path=None, compress=False):
     """
-    Initializes the creation of a Navigator object, which is used for rapid
-    delineation of watersheds using NHD Plus catchments.
-    :param nhd_table: Table of stream reach parameters from NHD Plus (df)
+    Convert a navigator file to the memory-mapped directory format, or to a compressed file for archiving. Older
+    files without flat paths or an upstream index are upgraded on the way.
+    :param region: NHD Hydroregion id (str)
+    :param in_path: Path to the existing navigator file or directory (str)
+    :param out_path: Output path, formatted with the region (str)
+    :param compress: Write a compressed .npz file instead of a directory (bool)
     """
-    report("Processing NHD...", 2)
-    nhd_table = process_nhd(nhd_table)
-
-    report("Unpacking NHD...", 2)
-    nodes, times, dists, outlets, conversion = unpack_nhd(nhd_table)
-
-    report("Tracing upstream...", 2)
-    # paths, times = self.upstream_trace(nodes, outlets, times)
-    # TODO - add clean capability to cumulatively trace any attribute (e.g time, distance)
-    paths, times, dists = rapid_trace(nodes, outlets, times, dists, conversion)
-
-    report("Mapping paths...", 2)
-    path_map = map_paths(paths)
-
-    report("Collapsing array...", 2)
-    paths, times, length, start_cols = collapse_array(paths, times, dists)
-
-    write_nhd.navigator_file(region, paths, times, length, path_map, conversion)
-
-
-def build_navigators():
-    nhd_regions = ['07']
-    overwrite = False
-    for region in nhd_regions:
-        nhd_path = condensed_nhd_path.format('nav', region, 'reach')
-        if overwrite or not os.path.exists(nhd_path):
-            reach_table, _ = \
-                condensed = condense_nhd(region, navigator_map_path, 'internal_name')
-            write_nhd.condensed_nhd('nav', region, reach_table)
-        else:
-            reach_table = read_nhd.condensed_nhd('nav', region, 'reach')
-
-        build_navigator(region, reach_table)
-
-
-if __name__ == '__main__':
-    build_navigators()
+    in_path = navigator_archive_path.format(region) if in_path is None else in_path
+    nav = Navigator(region, in_path)
+    write_nhd.navigator_file(region, nav.paths, nav.times, nav.lengths, nav.offsets, nav.map, nav.index, nav.parents,
+                             nav.alias_to_reach, nav.sorted_reaches, nav.reach_order, out_path, compress)
@@ -29,4 +29,6 @@ vpus_nhd = {'01': 'NE', '02': 'MA', '03N': 'SA', '03S': 'SA', '03W': 'SA', '04':
 
 nhd_regions = sorted(vpus_nhd.keys())
 
+erom_months = [str(m).zfill(2) for m in range(1, 13)] + ['ma']
+
 fields_hydro = FieldManager(fields_and_qc_path)
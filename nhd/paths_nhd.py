@@ -7,16 +7,26 @@ table_dir = r"A:\opp-efed\hydro\Tables"
 # Tables
 fields_and_qc_path = os.path.join(table_dir, "fields_and_qc.csv")
 nhd_map_path = os.path.join(table_dir, "nhd_map.csv")
+hydro_map_path = os.path.join(table_dir, "nhd_map_hydro.csv")
 
 # HydroFiles
 navigator_map_path = os.path.join(table_dir, "nhd_map_nav.csv")
-navigator_path = os.path.join(local_dir, "NavigatorFiles", "nav{}.npz")  # region
+navigator_path = os.path.join(local_dir, "NavigatorFiles", "nav{}")  # region
+navigator_archive_path = os.path.join(local_dir, "NavigatorFiles", "nav{}.npz")  # region
+navigator_stage_path = os.path.join(local_dir, "NavigatorFiles", "stages", "r{}_{}")  # region, stage
+build_report_path = os.path.join(local_dir, "NavigatorFiles", "nav{}_build.json")  # region
+validation_report_path = os.path.join(local_dir, "NavigatorFiles", "nav{}_validation.json")  # region
+flow_file_path = os.path.join(local_dir, "FlowFiles", "region_{}")  # region
+lake_file_path = os.path.join(local_dir, "LakeFiles", "region_{}")  # region
+catchment_index_path = os.path.join(local_dir, "NavigatorFiles", "catchments{}")  # region
+flowline_index_path = os.path.join(local_dir, "NavigatorFiles", "flowlines{}")  # region
 
 # Path containing NHD Plus dataset
 nhd_dir = os.path.join(global_dir, "NHDPlusV21")
 nhd_region_dir = os.path.join(nhd_dir, "NHDPlus{}", "NHDPlus{}")  # vpu, region
 catchment_path = os.path.join(nhd_region_dir, "NHDPlusCatchment", "Catchment.shp")
+flowline_path = os.path.join(nhd_region_dir, "NHDSnapshot", "Hydrography", "NHDFlowline.shp")
 
 # Intermediate
-condensed_nhd_path = os.path.join(local_dir, "CondensedNHD", 'nhd_{}_r{}_{}.csv')  # run_id, region, feature_type
+condensed_nhd_path = os.path.join(local_dir, "CondensedNHD", 'nhd_{}_r{}_{}')  # run_id, region, feature_type
 
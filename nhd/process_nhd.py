@@ -1,23 +1,30 @@
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
 import read_nhd
 import write_nhd
-from params_nhd import vpus_nhd, fields_hydro as fields
-from paths_nhd import nhd_region_dir
-from tools_hydro.read import dbf, report
+from params_nhd import vpus_nhd, erom_months, fields_hydro as fields
+from paths_nhd import nhd_region_dir, fields_and_qc_path
+from tools_hydro.read import report
 
+# Cubic feet per second to cubic metres per day
+cfs_to_m3_per_day = 0.0283168 * 86400.
 
-def condense_nhd(region, field_map_path, rename_field='internal_name'):
+
+def condense_nhd(region, field_map_path, rename_field='internal_name', processes=None):
     """
-    Pull data from NHD Plus dbf files and consolidate in a .csv file that is smaller to store and easier to read.
-    Tables and fields to be pulled are specified in an NHD map table. A template may be found in Tables/nhd_map.csv.
+    Pull data from NHD Plus dbf files into condensed reach and waterbody tables, which are written as directories of
+    typed columns (see write_nhd.condensed_nhd) that are smaller to store and faster to read. Tables and fields to be
+    pulled are specified in an NHD map table. A template may be found in Tables/nhd_map.csv. Tables are read
+    concurrently, and only the selected fields are decoded.
     :param region: NHD Hydroregion id (str)
     :param field_map_path: Path to the field map table (str)
-    :param run_id: Identifier appended to the output (str)
     :param rename_field: Field in the field map which contains new field names to conver to (str)
-    :return:
+    :param processes: Number of worker processes. Tables are read serially if 1 (int)
+    :return: Reach and waterbody tables, or None for a feature type with no tables in the map (df, df)
     """
     # TODO - too many rows from plusflow?
     # Read in the NHD map specifying which tables and fields to read
@@ -28,36 +35,111 @@ def condense_nhd(region, field_map_path, rename_field='internal_name'):
 
     # Path to NHDPlus files for the given region
     region_path = nhd_region_dir.format(vpus_nhd[region], region)
+    dtypes = read_nhd.field_dtypes()
 
-    # Initialize separate tables for waterbodies and reaches
-    reach_table = None
-    lake_table = None
-
-    # Loop through each NHD Plus table with fields selected in nhd_map.csv
+    # List each NHD Plus table with fields selected in nhd_map.csv
+    jobs, feature_types = [], []
     for (path, table_name, feature_type), subset in field_map.groupby(['path', 'table', 'feature_type']):
-        print(f"Reading {table_name}...")
-
-        # Read the table and select the fields in the field map
-        table_path = os.path.join(region_path, path, table_name + ".dbf")
-        table = dbf(table_path)[subset.field.values]
-
-        # Rename fields if specified
+        if feature_type not in ('reach', 'waterbody'):
+            raise ValueError(f"Invalid feature type {feature_type}. Must be 'reach' or 'waterbody'")
+        rename_dict = {}
         if rename_field is not None:
             rename_dict = dict(subset[~pd.isnull(subset[rename_field])][['field', rename_field]].values.tolist())
-            table = table.rename(columns=rename_dict)
-
-        # Append table to master
-        table = table.drop_duplicates()
-        if feature_type == 'reach':
-            reach_table = reach_table.merge(table, on='comid', how='outer') if reach_table is not None else table
-        elif feature_type == 'waterbody':
-            table = table.rename(columns={'comid': 'wb_comid'})
-            lake_table = lake_table.merge(table, on='wb_comid', how='outer') if lake_table is not None else table
-        else:
-            raise ValueError(f"Invalid feature type {feature_type}. Must be 'reach' or 'waterbody'")
+        table_path = os.path.join(region_path, path, table_name + ".dbf")
+        jobs.append((table_path, subset.field.values, rename_dict, dtypes))
+        feature_types.append(feature_type)
+
+    # Read the tables
+    if processes == 1:
+        tables = list(map(read_table, jobs))
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            tables = list(pool.map(read_table, jobs))
+
+    # Combine the tables for reaches and waterbodies
+    reach_tables = [table for table, feature_type in zip(tables, feature_types) if feature_type == 'reach']
+    lake_tables = [table.rename(columns={'comid': 'wb_comid'})
+                   for table, feature_type in zip(tables, feature_types) if feature_type == 'waterbody']
+    reach_table = align_tables(reach_tables, 'comid') if reach_tables else None
+    lake_table = align_tables(lake_tables, 'wb_comid') if lake_tables else None
     return reach_table, lake_table
 
 
+def condense_key(region, field_map_path, rename_field='internal_name'):
+    """
+    Fingerprint the inputs to condense_nhd, so that a condensed table can be rebuilt when they change. The key covers
+    the field map, the field data types, and the size and modification time of each source table.
+    :param region: NHD Hydroregion id (str)
+    :param field_map_path: Path to the field map table (str)
+    :param rename_field: Field in the field map which contains new field names to conver to (str)
+    :return: Cache key (str)
+    """
+    field_map = read_nhd.nhd_map(field_map_path, rename_field=rename_field)
+    key = hashlib.sha1(field_map.to_csv(index=None).encode())
+    with open(fields_and_qc_path, 'rb') as f:
+        key.update(f.read())
+    for table_path in source_tables(region, field_map):
+        if os.path.isfile(table_path):
+            stat = os.stat(table_path)
+            key.update("{}|{}|{}".format(table_path, stat.st_size, stat.st_mtime_ns).encode())
+        else:
+            key.update("{}|missing".format(table_path).encode())
+    return key.hexdigest()
+
+
+def source_tables(region, field_map):
+    """
+    List the NHD Plus tables that a field map reads from
+    :param region: NHD Hydroregion id (str)
+    :param field_map: Field map table (df)
+    :return: Paths to the .dbf files (list)
+    """
+    region_path = nhd_region_dir.format(vpus_nhd[region], region)
+    return [os.path.join(region_path, path, table_name + ".dbf")
+            for path, table_name in sorted(set(map(tuple, field_map[['path', 'table']].values)))]
+
+
+def read_table(job):
+    """
+    Read the selected fields from an NHD Plus table
+    :param job: Path to the table, fields to read, fields to rename, and field data types (tuple)
+    :return: Table with selected fields (df)
+    """
+    table_path, fields, rename_dict, dtypes = job
+    report(f"Reading {os.path.basename(table_path)}...")
+    table = pd.DataFrame(read_nhd.dbf_columns(table_path, fields, dtypes))
+    return table.rename(columns=rename_dict).drop_duplicates()
+
+
+def align_tables(tables, key):
+    """
+    Combine tables that share a key field, with the same result as a series of outer merges. Tables with repeated
+    keys (such as PlusFlow, with a row for each downstream reach) set the rows of the output. Tables with one row per
+    key are aligned to those rows with a single reindex each.
+    :param tables: Tables to combine (list)
+    :param key: Key field (str)
+    :return: Combined table, sorted by key (df)
+    """
+    repeated = [table for table in tables if table[key].duplicated().any()]
+    unique = [table.set_index(key) for table in tables if not table[key].duplicated().any()]
+
+    # Build the output rows from the tables with repeated keys, plus a row for any key that only appears elsewhere
+    all_keys = np.unique(np.concatenate([table[key].values for table in repeated] +
+                                        [table.index.values for table in unique]))
+    if repeated:
+        base = repeated[0]
+        for table in repeated[1:]:
+            base = base.merge(table, on=key, how='outer')
+        missing = all_keys[~np.isin(all_keys, base[key].values)]
+        base = pd.concat([base, pd.DataFrame({key: missing})], ignore_index=True)
+        base = base.sort_values(key, kind='stable').reset_index(drop=True)
+    else:
+        base = pd.DataFrame({key: all_keys})
+
+    aligned = [table.reindex(base[key].values).reset_index(drop=True) for table in unique]
+    return pd.concat([base] + aligned, axis=1)
+
+
 def process_divergence(nhd_table):
     # Add the divergence and streamcalc of downstream reaches to each row
     downstream = nhd_table[['comid', 'divergence', 'stream_calc', 'fcode']]
@@ -81,6 +163,18 @@ def calculate_surface_area(nhd_table):
     return stream_channel_a * np.power(cross_section, stream_channel_b)
 
 
+def identify_region_exits(nhd_table):
+    """
+    Record the downstream reach of reaches that drain into another region, before identify_outlet_reaches severs them
+    :param nhd_table: Table of stream reach parameters from NHD Plus, with one downstream reach per reach (df)
+    :return: Table with an 'exit_comid' field, which is 0 for reaches that don't leave the region (df)
+    """
+    leaves_region = (nhd_table.tocomid > 0) & ~nhd_table.tocomid.isin(nhd_table.comid) & \
+                    ((nhd_table.stream_calc > 0) | (nhd_table.divergence == 2)) & (nhd_table.fcode != 56600)
+    nhd_table['exit_comid'] = np.where(leaves_region, nhd_table.tocomid, 0)
+    return nhd_table
+
+
 def identify_outlet_reaches(nhd_table):
     # Indicate whether reaches are coastal
     nhd_table['coastal'] = np.int16(nhd_table.pop('fcode') == 56600)
@@ -91,8 +185,11 @@ def identify_outlet_reaches(nhd_table):
     # Identify all reaches that are a 'terminal path'. HydroSeq is used for Terminal Path ID in the NHD
     nhd_table.loc[nhd_table.hydroseq.isin(nhd_table.terminal_path), 'outlet'] = 1
 
-    # Identify all reaches that empty into a reach outside the region
-    nhd_table.loc[~nhd_table.tocomid.isin(nhd_table.comid) & (nhd_table.stream_calc > 0), 'outlet'] = 1
+    # Identify all reaches that empty into a reach outside the region, including minor divergence paths, which have
+    # no stream_calc. Nothing else in the region drains to a minor path, so it would otherwise go untraced
+    leaves_region = ~nhd_table.tocomid.isin(nhd_table.comid)
+    nhd_table.loc[leaves_region & (nhd_table.stream_calc > 0), 'outlet'] = 1
+    nhd_table.loc[leaves_region & (nhd_table.tocomid > 0) & (nhd_table.divergence == 2), 'outlet'] = 1
 
     # Designate coastal reaches as outlets. These don't need to be accumulated
     nhd_table.loc[nhd_table.coastal == 1, 'outlet'] = 1
@@ -103,6 +200,108 @@ def identify_outlet_reaches(nhd_table):
     return nhd_table
 
 
+def resolve_divergence(reach_codes, to_codes, in_table, divergence, stream_calc):
+    """
+    Array version of process_divergence. Where a reach has more than one downstream reach, keep the one with the
+    lowest divergence, then the highest stream_calc, then the first in the table. Downstream reaches that aren't in
+    the table come last.
+    :param reach_codes: Factorized reach ID of each row (np.array)
+    :param to_codes: Factorized downstream reach ID of each row, on the same codes as the reach IDs (np.array)
+    :param in_table: Whether the downstream reach of each row is in the table (np.array)
+    :param divergence: Divergence code of each row (np.array)
+    :param stream_calc: Stream calculator code of each row (np.array)
+    :return: Rows to keep (np.array)
+    """
+    n_codes = int(max(reach_codes.max(initial=-1), to_codes.max(initial=-1))) + 1
+    rows = np.arange(reach_codes.size)
+    best = np.zeros(n_codes, dtype=np.int64)
+    best[reach_codes] = rows
+
+    # Only reaches with more than one row need to be ranked
+    multiple = np.flatnonzero(np.bincount(reach_codes, minlength=n_codes)[reach_codes] > 1)
+    codes = reach_codes[multiple]
+
+    # Rank the rows of each reach by divergence, then stream_calc, with missing values last
+    divergence_key = np.where(np.isnan(divergence), np.inf, divergence)
+    stream_calc_key = np.where(np.isnan(stream_calc), np.inf, -stream_calc)
+    order = multiple[np.lexsort((stream_calc_key[multiple], divergence_key[multiple], codes))]
+    heads = order[np.flatnonzero(np.diff(reach_codes[order], prepend=-1))]
+    best[reach_codes[heads]] = heads
+
+    # Rank each distinct pair of reach and downstream reach by the best row of the downstream reach
+    pair_codes = codes.astype(np.int64) * (n_codes + 1) + to_codes[multiple]
+    _, first = np.unique(pair_codes, return_index=True)
+    first_rows = multiple[np.sort(first)]
+    pair_to = np.where(in_table[first_rows], best[to_codes[first_rows]], -1)
+    pair_divergence = np.where(pair_to >= 0, divergence_key[pair_to], np.inf)
+    pair_stream_calc = np.where(pair_to >= 0, stream_calc_key[pair_to], np.inf)
+
+    # Select one pair per reach, and keep every row with the selected pair
+    order = first_rows[np.lexsort((pair_stream_calc, pair_divergence, reach_codes[first_rows]))]
+    heads = order[np.flatnonzero(np.diff(reach_codes[order], prepend=-1))]
+    selected = np.full(n_codes, -1, dtype=np.int64)
+    selected[reach_codes[heads]] = to_codes[heads]
+    keep = np.ones(reach_codes.size, dtype=bool)
+    keep[multiple] = to_codes[multiple] == selected[codes]
+    return keep
+
+
+def prepare_network(nhd_table, return_exits=False):
+    """
+    Array version of navigator.process_nhd followed by navigator.unpack_nhd. Reach IDs are factorized once, and
+    divergences are resolved, outlets identified and reaches aliased with sorts on the factorized columns, without
+    merging or copying the table. The results are the same, except that ties between downstream reaches with the same
+    divergence and stream_calc, which process_divergence breaks in no particular order, go to the first in the table.
+    :param nhd_table: Condensed NHD reach table (df)
+    :param return_exits: Also return the reaches that drain into another region (bool)
+    :return: Array of to-from node pairs, travel times, flow lengths in metres, outlet nodes, and the reach ID of each
+    alias, and optionally the reach IDs of region exits and the reaches they drain to (np.array, ...)
+    """
+    comid = nhd_table.comid.values
+    tocomid = nhd_table.tocomid.values.astype(np.float64)
+    stream_calc = nhd_table.stream_calc.values.astype(np.float64)
+    fcode = nhd_table.fcode.values.astype(np.float64)
+    hydroseq = nhd_table.hydroseq.values.astype(np.float64)
+
+    # Factorize reach and downstream reach IDs together, so that codes match between them. Missing IDs share a code
+    _, codes = np.unique(np.concatenate((comid.astype(np.float64), tocomid)), return_inverse=True)
+    reach_codes, to_codes = codes[:comid.size], codes[comid.size:]
+    is_reach = np.zeros(codes.max(initial=-1) + 1, dtype=bool)
+    is_reach[reach_codes] = True
+    in_table = is_reach[to_codes] & ~np.isnan(tocomid)
+
+    divergence = nhd_table.divergence.values.astype(np.float64)
+    keep = resolve_divergence(reach_codes, to_codes, in_table, divergence, stream_calc)
+
+    # Region exits, then outlets: terminal paths, reaches draining out of the table, including minor divergence paths
+    # (see identify_outlet_reaches), and coastal reaches
+    terminal_paths = np.unique(nhd_table.terminal_path.values[keep].astype(np.float64))
+    positions = np.minimum(np.searchsorted(terminal_paths, hydroseq), max(terminal_paths.size - 1, 0))
+    terminal = terminal_paths[positions] == hydroseq if terminal_paths.size else np.zeros(keep.size, dtype=bool)
+    if np.isnan(terminal_paths).any():
+        terminal |= np.isnan(hydroseq)
+    minor_exit = (tocomid > 0) & ~in_table & (divergence == 2)
+    exits = keep & (tocomid > 0) & ~in_table & ((stream_calc > 0) | minor_exit) & (fcode != 56600)
+    outlet = terminal | (~in_table & (stream_calc > 0)) | minor_exit | (fcode == 56600)
+    keep &= comid != 0
+
+    # Alias reaches in order of their first row, taking the times and lengths of that row
+    rows = np.flatnonzero(keep)
+    _, first = np.unique(reach_codes[rows], return_index=True)
+    first = rows[np.sort(first)]
+    aliases = np.full(is_reach.size, -1, dtype=np.int32)
+    aliases[reach_codes[first]] = np.arange(first.size)
+    to_nodes = np.where(in_table[rows] & ~outlet[rows], aliases[to_codes[rows]], -1)
+    nodes = np.column_stack((to_nodes, aliases[reach_codes[rows]])).astype(np.int32)
+    times = nhd_table.travel_time.values[first]
+    dists = nhd_table.lengthkm.values[first] * 1000.  # km -> m
+    outlets = nodes[outlet[rows], 1]
+    conversion = comid[first]
+    if return_exits:
+        return nodes, times, dists, outlets, conversion, (comid[exits & keep], nhd_table.tocomid.values[exits & keep])
+    return nodes, times, dists, outlets, conversion
+
+
 def identify_waterbody_outlets(wb_table, reach_table):
     """
     Identifies stream outlets for each waterbody in the NHDPlus dataset. Fields to carry over are specified in the
@@ -112,7 +311,6 @@ def identify_waterbody_outlets(wb_table, reach_table):
     :return: Table with waterbody comids and associated reach outlet information
     """
     fields.refresh()
-    erom_months = [str(m).zfill(2) for m in range(1, 13)] + ['ma']
     fields.expand('monthly', erom_months)
 
     # Get a table of all lentic reaches, with the COMID of the reach and waterbody
@@ -127,3 +325,65 @@ def identify_waterbody_outlets(wb_table, reach_table):
     wb_table = wb_table.merge(lentic_table, how='left', on='wb_comid')
 
     return wb_table.rename(columns={'comid': 'outlet_comid'})
+
+
+def first_rows(column, keys):
+    """
+    Find the first row of a table column that holds each key, such as the row of each navigator alias's reach
+    :param column: Values of the column (np.array)
+    :param keys: Values to find (np.array)
+    :return: Row of each key, or -1 for keys that aren't in the column (np.array)
+    """
+    values, first = np.unique(column, return_index=True)
+    if not values.size:
+        return np.full(keys.size, -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(values, keys), values.size - 1)
+    return np.where(values[positions] == keys, first[positions], -1)
+
+
+def flow_arrays(reach_table, conversion):
+    """
+    Arrange monthly and mean annual EROM flows and velocities in navigator alias order. Each array has a row for
+    each alias and a column for each month in params_nhd.erom_months, so that the values for a set of reaches can be
+    gathered in one step.
+    :param reach_table: Condensed NHD reach table with q_01...q_ma and v_01...v_ma fields (df)
+    :param conversion: Reach ID of each alias (np.array)
+    :return: Flows (cfs) and velocities (fps), missing values as NaN (dict)
+    """
+    rows = first_rows(reach_table.comid.values, conversion)
+    found = rows >= 0
+    arrays = {}
+    for field in ('q', 'v'):
+        values = np.full((conversion.size, len(erom_months)), np.nan, dtype=np.float32)
+        for i, month in enumerate(erom_months):
+            column = "{}_{}".format(field, month)
+            if column in reach_table.columns:
+                values[found, i] = reach_table[column].values[rows[found]]
+        arrays[field] = values
+    return arrays
+
+
+def lake_arrays(wb_table, reach_table, conversion):
+    """
+    Arrange waterbody attributes in navigator alias order, at the outlet reach of each waterbody (see
+    identify_waterbody_outlets). Residence time is the volume divided by the mean annual flow at the outlet.
+    :param wb_table: Condensed NHD waterbody table with volume (m3) and area (m2) fields (df)
+    :param reach_table: Condensed NHD reach table (df)
+    :param conversion: Reach ID of each alias (np.array)
+    :return: Waterbody ID (0 where the reach isn't a waterbody outlet), volume, area, mean annual outlet flow (cfs)
+    and residence time (days), indexed by alias (dict)
+    """
+    lakes = identify_waterbody_outlets(wb_table, reach_table)
+    lakes = lakes[lakes.outlet_comid > 0]
+    outlets = first_rows(conversion, lakes.outlet_comid.values)
+    lakes, outlets = lakes[outlets >= 0], outlets[outlets >= 0]
+    arrays = {'wb_comid': np.zeros(conversion.size, dtype=np.int32)}
+    arrays['wb_comid'][outlets] = lakes.wb_comid.values
+    for field in ('volume', 'area', 'flow'):
+        arrays[field] = np.full(conversion.size, np.nan, dtype=np.float32)
+        if field in lakes.columns:
+            arrays[field][outlets] = lakes[field].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arrays['residence_time'] = arrays['volume'] / (arrays['flow'] * cfs_to_m3_per_day)
+    return arrays
+
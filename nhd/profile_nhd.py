@@ -0,0 +1,176 @@
+"""
+profile_nhd.py
+
+Instrumentation for long-running builds. BuildProfile records the wall time, CPU time, memory, item count and
+throughput of each stage and writes them to a JSON report. Memory is sampled on a background thread while each stage
+runs, because the peak memory reported by the operating system is the peak over the life of the process, and build
+workers are reused for several regions. Progress reports the percentage complete and estimated time remaining of a
+loop over a known number of items.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from tools_hydro.efed_lib import report
+
+# Memory use is read from psutil if it's installed, or from the resource module on Unix
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory():
+    """
+    Get the peak resident memory of this process over its lifetime so far. This is a high-water mark, so it doesn't
+    fall when memory is released, and it includes earlier work done by the same process.
+    :return: Peak memory in MB, or None if it can't be measured (float)
+    """
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        peak = getattr(info, 'peak_wset', None)  # Only available on Windows
+        if peak is not None:
+            return peak / 2 ** 20
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KB on Linux
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    return None
+
+
+def current_memory():
+    """
+    Get the current resident memory of this process, from psutil if it's installed or from /proc on Linux
+    :return: Resident memory in MB, or None if it can't be measured (float)
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class MemorySampler(object):
+    def __init__(self, interval=0.05):
+        """
+        Sample the resident memory of this process on a background thread, to find the peak within a block of work
+        :param interval: Seconds between samples (float)
+        """
+        self.interval = interval
+        self.start = self.end = self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        memory = current_memory()
+        if memory is not None:
+            self.peak = memory if self.peak is None else max(self.peak, memory)
+        return memory
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start = self.sample()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.end = self.sample()
+
+
+class BuildProfile(object):
+    def __init__(self, label):
+        self.label = label
+        self.stages = []
+        self.start_time = time.time()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """
+        Time a stage of the build and sample its memory use. The stage record can be updated inside the block, for
+        example with an item count that isn't known beforehand. Memory is recorded at the start and end of the stage,
+        with the peak sampled during the stage, and the process's lifetime peak for reference.
+        :param name: Stage name (str)
+        :param items: Number of items processed by the stage, such as reaches (int)
+        :return: Stage record (dict)
+        """
+        record = {'stage': name, 'items': items}
+        wall, cpu = time.perf_counter(), time.process_time()
+        report("{}: {}...".format(self.label, name), 2)
+        with MemorySampler() as memory:
+            yield record
+        record['wall_seconds'] = round(time.perf_counter() - wall, 3)
+        record['cpu_seconds'] = round(time.process_time() - cpu, 3)
+        record['start_memory_mb'], record['end_memory_mb'], record['peak_memory_mb'] = \
+            (None if value is None else round(value, 1) for value in (memory.start, memory.end, memory.peak))
+        if memory.start is not None and memory.peak is not None:
+            record['peak_increase_mb'] = round(memory.peak - memory.start, 1)
+        record['process_peak_memory_mb'] = peak_memory()
+        if record['items'] is not None and record['wall_seconds'] > 0:
+            record['items_per_second'] = round(record['items'] / record['wall_seconds'], 1)
+        self.stages.append(record)
+
+    def skip(self, name):
+        """
+        Record a stage that didn't need to run, such as a stage restored from a checkpoint
+        :param name: Stage name (str)
+        """
+        self.stages.append({'stage': name, 'skipped': True})
+
+    def write(self, out_path, **attributes):
+        """
+        Write the profile to a JSON file
+        :param out_path: Output path (str)
+        :param attributes: Additional values to include, such as the region (dict)
+        """
+        out_dir = os.path.dirname(out_path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        profile = {'label': self.label, 'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start_time)),
+                   'wall_seconds': round(time.time() - self.start_time, 3), 'process_peak_memory_mb': peak_memory(),
+                   'stages': self.stages}
+        profile.update(attributes)
+        with open(out_path, 'w') as f:
+            json.dump(profile, f, indent=1)
+
+
+class Progress(object):
+    def __init__(self, total, label, interval=30.):
+        """
+        Report progress through a known number of items, at most once per interval
+        :param total: Total number of items (int)
+        :param label: Description of the work, such as 'Traced reaches' (str)
+        :param interval: Minimum seconds between reports (float)
+        """
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.start_time = self.last_report = time.perf_counter()
+
+    def update(self, count):
+        now = time.perf_counter()
+        if now - self.last_report < self.interval or not self.total:
+            return
+        self.last_report = now
+        fraction = min(count / self.total, 1.)
+        elapsed = now - self.start_time
+        remaining = elapsed * (1 - fraction) / fraction if fraction else float('nan')
+        report("{} {} of {} ({:.1f}%), {:.0f}s elapsed, about {:.0f}s remaining".format(
+            self.label, count, self.total, fraction * 100, elapsed, remaining), 3)
@@ -1,10 +1,82 @@
+import json
+import os
+import struct
+import zlib
+import numpy as np
 import pandas as pd
-from paths_nhd import condensed_nhd_path
+from params_nhd import erom_months
+from paths_nhd import condensed_nhd_path, fields_and_qc_path, flow_file_path, lake_file_path
 
 
-def condensed_nhd(run_id=None, region=None, feature_type=None, path=None):
+def condensed_nhd(run_id=None, region=None, feature_type=None, path=None, columns=None):
     path = condensed_nhd_path if path is None else path
-    return pd.read_csv(path.format(run_id, region, feature_type))
+    return columnar_table(path.format(run_id, region, feature_type), columns)
+
+
+def columnar_header(table_dir):
+    """
+    Read the header of a directory of arrays, which lists the arrays and their data types
+    :param table_dir: Directory containing the arrays (str)
+    :return: Header, or None if the directory hasn't been completely written (dict)
+    """
+    header_path = os.path.join(table_dir, 'header.json')
+    if not os.path.isfile(header_path):
+        return None
+    with open(header_path) as f:
+        return json.load(f)
+
+
+def columnar_arrays(table_dir, columns=None, mmap_mode='r', verify=False):
+    """
+    Open selected arrays from a directory written by write_nhd.array_directory. Arrays are memory-mapped by default,
+    so only the data that's used is read from disk.
+    :param table_dir: Directory containing the arrays (str)
+    :param columns: Arrays to read. All arrays are read if not provided (list)
+    :param mmap_mode: Memory-mapping mode passed to np.load, or None to read into memory (str)
+    :param verify: Check the arrays against the checksums in the header. This reads each array in full (bool)
+    :return: Arrays indexed by name (dict)
+    """
+    header = columnar_header(table_dir)
+    assert header is not None, "Table {} not found".format(table_dir)
+    columns = list(header['arrays']) if columns is None else columns
+    arrays = {name: np.load(os.path.join(table_dir, name + '.npy'), mmap_mode=mmap_mode) for name in columns}
+    if verify:
+        for name, values in arrays.items():
+            dtype, shape, checksum = header['arrays'][name]
+            if list(values.shape) != shape or zlib.crc32(np.ascontiguousarray(values).data.cast('B')) != checksum:
+                raise ValueError("Array {} in {} does not match its checksum".format(name, table_dir))
+    return arrays
+
+
+def columnar_table(table_dir, columns=None):
+    """
+    Read selected columns of a columnar table into a data frame
+    :param table_dir: Directory containing the table (str)
+    :param columns: Columns to read. All columns are read if not provided (list)
+    :return: Table (df)
+    """
+    return pd.DataFrame(columnar_arrays(table_dir, columns))
+
+
+def flow_file(region, path=None):
+    """
+    Open the flow file for a region. Arrays have a row for each navigator alias and a column for each month in the
+    'months' attribute of the header, so that flows for an upstream watershed are flows['q'][aliases]
+    :param region: NHD Hydroregion id (str)
+    :param path: Path to flow files, formatted with the region (str)
+    :return: Memory-mapped flows ('q') and velocities ('v') (dict)
+    """
+    return columnar_arrays((flow_file_path if path is None else path).format(region))
+
+
+def lake_file(region, path=None):
+    """
+    Open the lake file for a region. Arrays are indexed by navigator alias, with values at waterbody outlets
+    :param region: NHD Hydroregion id (str)
+    :param path: Path to lake files, formatted with the region (str)
+    :return: Memory-mapped waterbody IDs, volumes, areas, outlet flows and residence times (dict)
+    """
+    return columnar_arrays((lake_file_path if path is None else path).format(region))
 
 
 def nhd_map(field_map_path, lower=True, all_cols=False, rename_field=None):
@@ -17,3 +89,91 @@ def nhd_map(field_map_path, lower=True, all_cols=False, rename_field=None):
             out_fields.append(rename_field)
         data = data[out_fields]
     return data
+
+
+def field_dtypes(fields_path=fields_and_qc_path, name_field='external_name'):
+    """
+    Read the data types for NHD Plus fields from the fields table. Fields typed as 'object' are left out, so that
+    they keep the type they have in the source table.
+    :param fields_path: Path to the fields table (str)
+    :param name_field: 'external_name' for the names in the NHD Plus tables, or 'internal_name' for the names in the
+    condensed tables, where monthly fields are expanded (e.g. q_01, q_ma) (str)
+    :return: Data types indexed by lower-case field name (dict)
+    """
+    fields = pd.read_csv(fields_path)
+    fields = fields[fields.data_type.str.startswith('np.')]
+    dtypes = {}
+    for name, data_type, monthly in fields[[name_field, 'data_type', 'monthly']].values:
+        dtype = np.dtype(getattr(np, data_type[3:]))
+        dtypes[name.lower()] = dtype
+        if monthly == 1 and name_field == 'internal_name':
+            dtypes.update({"{}_{}".format(name.lower(), month): dtype for month in erom_months})
+    return dtypes
+
+
+def dbf_record_count(dbf_path):
+    """
+    Read the number of records in a dBASE (.dbf) table from its header
+    :param dbf_path: Path to the .dbf file (str)
+    :return: Number of records, including deleted records (int)
+    """
+    with open(dbf_path, 'rb') as f:
+        return struct.unpack('<4xI', f.read(8))[0]
+
+
+def dbf_columns(dbf_path, fields=None, dtypes=None):
+    """
+    Read selected fields from a dBASE (.dbf) table straight into typed arrays. The records are memory-mapped, so only
+    the requested fields are copied and decoded.
+    :param dbf_path: Path to the .dbf file (str)
+    :param fields: Fields to read, case-insensitive. All fields are read if not provided (list)
+    :param dtypes: Output data types indexed by lower-case field name. By default, numeric fields are read as int64
+    or float64 and other fields as str (dict)
+    :return: Arrays indexed by lower-case field name (dict)
+    """
+    dtypes = {} if dtypes is None else dtypes
+
+    # Read the table header and the field descriptors that follow it
+    with open(dbf_path, 'rb') as f:
+        n_records, header_length, record_length = struct.unpack('<4xIHH20x', f.read(32))
+        descriptors = f.read(header_length - 32)
+    names, formats, offsets, field_types = ['deleted'], ['S1'], [0], {}
+    for i in range(0, len(descriptors) - 31, 32):
+        descriptor = descriptors[i:i + 32]
+        if descriptor[0] == 0x0D:
+            break
+        name = descriptor[:11].split(b'\x00')[0].decode('latin-1').lower()
+        names.append(name)
+        formats.append('S{}'.format(descriptor[16]))
+        offsets.append(offsets[-1] + int(formats[-2][1:]))
+        field_types[name] = (chr(descriptor[11]), descriptor[17])
+    record_dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': record_length})
+    records = np.memmap(dbf_path, dtype=record_dtype, mode='r', offset=header_length, shape=(n_records,))
+    live = records['deleted'] != b'*'
+
+    columns = {}
+    for field in (names[1:] if fields is None else [f.lower() for f in fields]):
+        raw = records[field][live]
+        field_type, decimals = field_types[field]
+        dtype = dtypes.get(field)
+        if field_type in 'NF':
+            try:
+                values = raw.astype(np.float64)
+                blank = None
+            except ValueError:
+                # Blank numeric fields are missing values
+                stripped = np.char.strip(raw)
+                blank = stripped == b''
+                stripped[blank] = b'nan'
+                values = stripped.astype(np.float64)
+            if dtype is None:
+                dtype = np.dtype(np.int64) if decimals == 0 and blank is None else np.dtype(np.float64)
+            if dtype.kind in 'iu' and blank is not None:
+                values[blank] = 0
+            columns[field] = values.astype(dtype)
+        elif field_type == 'L':
+            columns[field] = np.isin(np.char.upper(raw), [b'T', b'Y'])
+        else:
+            columns[field] = np.char.strip(np.char.decode(raw, 'latin-1')).astype(object)
+    del records
+    return columns
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+from accumulate_nhd import topological_levels
+
+
+def routing_network(nhd_table, lag=False):
+    """
+    Build a weighted routing network from a condensed NHD table, keeping every downstream connection in PlusFlow.
+    At a divergence, flow is split between the downstream reaches by the DivFrac field in NHD Plus. Downstream reaches
+    without a DivFrac share whatever fraction remains, and fractions are scaled to sum to 1.
+    :param nhd_table: Table of stream reach parameters from NHD Plus, with a row for each downstream reach (df)
+    :param lag: Also return travel time lags for each connection (bool)
+    :return: Array of to-from node pairs, fraction of flow along each pair, lags in days if requested, and the reach
+    ID of each node (np.array, np.array, [np.array], np.array)
+    """
+    reaches = nhd_table[nhd_table.comid != 0].drop_duplicates('comid')
+    conversion = reaches.comid.values
+    aliases = pd.Series(np.arange(conversion.size), index=conversion)
+
+    # Keep connections to reaches within the table
+    links = nhd_table[['comid', 'tocomid']].drop_duplicates()
+    links = links[links.comid.isin(aliases.index) & links.tocomid.isin(aliases.index)]
+    nodes = np.column_stack((aliases[links.tocomid].values, aliases[links.comid].values)).astype(np.int32)
+
+    # Fill in missing fractions at divergences, then normalize so each reach passes on all of its flow
+    if 'div_frac' in reaches.columns:
+        fractions = reaches.div_frac.values[nodes[:, 0]].astype(np.float64)
+    else:
+        fractions = np.full(nodes.shape[0], np.nan)
+    upstream = nodes[:, 1]
+    n_branches = np.bincount(upstream, minlength=conversion.size)[upstream]
+    fractions[n_branches == 1] = 1.
+    known = np.bincount(upstream, np.nan_to_num(fractions), minlength=conversion.size)
+    missing = np.bincount(upstream, np.isnan(fractions), minlength=conversion.size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        remainder = np.clip(1. - known, 0., None) / missing
+    fractions = np.where(np.isnan(fractions), remainder[upstream], fractions)
+    totals = np.bincount(upstream, fractions, minlength=conversion.size)[upstream]
+    weights = np.where(totals > 0, fractions / totals, 1. / n_branches).astype(np.float32)
+
+    if lag:
+        return nodes, weights, travel_lags(nodes, weights, reaches.travel_time.values), conversion
+    return nodes, weights, conversion
+
+
+def travel_lags(nodes, weights, times):
+    """
+    Convert reach travel times to whole-day lags for each connection. Travel times are accumulated down the main
+    (largest fraction) branch of each reach to the outlet, and each lag is the difference between the rounded
+    accumulated times at either end. Rounding the accumulated time rather than each reach keeps lags from
+    disappearing along chains of reaches that are each shorter than a day.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param weights: Fraction of flow along each pair (np.array)
+    :param times: Travel time through each reach in days (np.array)
+    :return: Lag in days for each pair (np.array)
+    """
+    n_nodes = times.size
+    main = np.full(n_nodes, -1, dtype=np.int64)
+    order = np.lexsort((weights, nodes[:, 1]))
+    largest = order[np.append(np.diff(nodes[order, 1]) != 0, True)]
+    main[nodes[largest, 1]] = nodes[largest, 0]
+
+    # Accumulate from the outlets upward, so that each reach's main downstream reach is finished first
+    cumulative = np.nan_to_num(times).astype(np.float64)
+    order, level_bounds = topological_levels(nodes, n_nodes)
+    for i in range(level_bounds.size - 2, -1, -1):
+        level = order[level_bounds[i]:level_bounds[i + 1]]
+        level = level[main[level] >= 0]
+        cumulative[level] += cumulative[main[level]]
+    arrival = np.round(cumulative).astype(np.int64)
+    return np.clip(arrival[nodes[:, 1]] - arrival[nodes[:, 0]], 0, None).astype(np.int32)
+
+
+def route_blocks(nodes, weights, values, lags=None, block_size=365):
+    """
+    Route daily values down the network. Each reach's routed value is its own value plus the routed values of
+    upstream reaches, multiplied by the fraction of flow along each connection and delayed by the lag. Days are
+    processed in blocks, and the last days of each block are carried into the next to supply lagged values.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param weights: Fraction of flow along each pair (np.array)
+    :param values: Daily values with a row for each node and a column for each day, such as loads or runoff.
+    May be memory-mapped (np.array)
+    :param lags: Lag in days for each pair (np.array)
+    :param block_size: Number of days to route at once (int)
+    :return: Generator of the first day and routed values of each block (int, np.array)
+    """
+    n_nodes, n_days = values.shape
+    lags = np.zeros(nodes.shape[0], dtype=np.int32) if lags is None else lags
+    max_lag = int(lags.max()) if lags.size else 0
+
+    # Group connections by level of the upstream reach, then by lag, so each group is added in one operation
+    order, level_bounds = topological_levels(nodes, n_nodes)
+    level_of = np.zeros(n_nodes, dtype=np.int64)
+    level_of[order] = np.repeat(np.arange(level_bounds.size - 1), np.diff(level_bounds))
+    edge_order = np.lexsort((lags, level_of[nodes[:, 1]]))
+    keys = np.column_stack((level_of[nodes[edge_order, 1]], lags[edge_order]))
+    groups = np.flatnonzero(np.diff(keys, axis=0).any(1))
+    group_bounds = np.concatenate(([0], groups + 1, [edge_order.size]))
+
+    carry = np.zeros((n_nodes, max_lag), dtype=np.float64)
+    for first in range(0, n_days, block_size):
+        last = min(first + block_size, n_days)
+        routed = np.hstack((carry, np.asarray(values[:, first:last], dtype=np.float64)))
+        block = routed[:, max_lag:]
+        for start, end in zip(group_bounds[:-1], group_bounds[1:]):
+            edges = edge_order[start:end]
+            if not edges.size:
+                continue
+            lag = lags[edges[0]]
+            upstream = routed[nodes[edges, 1], max_lag - lag:max_lag - lag + last - first]
+            np.add.at(block, nodes[edges, 0], upstream * weights[edges, None])
+        carry = routed[:, routed.shape[1] - max_lag:]
+        yield first, block
+
+
+def route(nodes, weights, values, lags=None, block_size=365, out=None):
+    """
+    Route daily values down the network. See route_blocks.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param weights: Fraction of flow along each pair (np.array)
+    :param values: Daily values with a row for each node and a column for each day (np.array)
+    :param lags: Lag in days for each pair (np.array)
+    :param block_size: Number of days to route at once (int)
+    :param out: Array to hold the routed values, such as a memory-mapped file (np.array)
+    :return: Routed values (np.array)
+    """
+    out = np.zeros(values.shape, dtype=np.float32) if out is None else out
+    for first, block in route_blocks(nodes, weights, values, lags, block_size):
+        out[:, first:first + block.shape[1]] = block
+    return out
@@ -0,0 +1,202 @@
+"""
+shared_nhd.py
+
+Share Navigator arrays between worker processes. A NavigatorRegistry loads each region once into shared memory, and
+workers attach read-only Navigator views to the shared arrays instead of loading their own copies. Each process
+also keeps a bounded cache of watershed results.
+
+Usage with a forked server:
+    registry = NavigatorRegistry()
+    registry.share(['07', '08'])
+    # fork workers, which call registry.upstream_watershed('07', comid)
+
+Usage with a process pool:
+    pool = ProcessPoolExecutor(initializer=attach_registry, initargs=(registry.specs,))
+"""
+import sys
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from navigator import Navigator
+from paths_nhd import navigator_path
+
+# Registry attached in a pool worker by attach_registry
+worker_registry = None
+
+
+class ResultCache(object):
+    """
+    Least-recently-used cache of query results, bounded by the total bytes of the cached arrays
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results.move_to_end(key)
+        return result[0]
+
+    def put(self, key, value):
+        """
+        Add a result to the cache, evicting the least recently used results until it fits. Cached arrays are made
+        read-only, since they're returned to every caller with the same query.
+        :param key: Query key (tuple)
+        :param value: Array or list of arrays (np.array, list)
+        """
+        arrays = value if isinstance(value, list) else [value]
+        for array in arrays:
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+        size = sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+        if size > self.max_bytes:
+            return
+        if key in self.results:
+            self.nbytes -= self.results.pop(key)[1]
+        while self.nbytes + size > self.max_bytes:
+            _, (_, evicted) = self.results.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+        self.results[key] = (value, size)
+        self.nbytes += size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.results), 'bytes': self.nbytes}
+
+
+class NavigatorRegistry(object):
+    """
+    Navigators for several regions, with arrays held in shared memory. The process that calls share owns the shared
+    memory and should call close when finished. Worker processes attach to it by name, and shouldn't call close.
+    """
+
+    def __init__(self, upstream_path=None, cache_bytes=2 ** 28, specs=None):
+        self.path = navigator_path if upstream_path is None else upstream_path
+        self.specs = {} if specs is None else specs
+        self.owner = specs is None
+        self.blocks = {}
+        self.navigators = {}
+        self.cache = ResultCache(cache_bytes)
+
+    def share(self, regions):
+        """
+        Load navigators into shared memory, along with the lookup tables that each worker would otherwise build for
+        itself on first use (see Navigator.lookup_arrays)
+        :param regions: NHD Hydroregion ids (list)
+        """
+        for region in regions:
+            if region in self.specs:
+                continue
+            navigator = Navigator(region, self.path.format(region))
+            arrays = dict(navigator.arrays(), **navigator.lookup_arrays())
+            spec = {}
+            for name, values in arrays.items():
+                values = np.ascontiguousarray(values)
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                np.ndarray(values.shape, values.dtype, buffer=block.buf)[...] = values
+                spec[name] = (block.name, values.dtype.str, values.shape)
+                self.blocks[block.name] = block
+            self.specs[region] = spec
+
+    def attach(self, region):
+        """
+        Map the shared arrays of a region into this process as read-only arrays
+        :param region: NHD Hydroregion id (str)
+        :return: Arrays indexed by name (dict)
+        """
+        arrays = {}
+        for name, (block_name, dtype, shape) in self.specs[region].items():
+            if block_name not in self.blocks:
+                self.blocks[block_name] = attach_block(block_name)
+            array = np.ndarray(shape, dtype, buffer=self.blocks[block_name].buf)
+            array.flags.writeable = False
+            arrays[name] = array
+        return arrays
+
+    def navigator(self, region):
+        """
+        Get a navigator for a region, backed by shared memory if the region has been shared
+        :param region: NHD Hydroregion id (str)
+        :return: Navigator
+        """
+        if region not in self.navigators:
+            arrays = self.attach(region) if region in self.specs else None
+            self.navigators[region] = Navigator(region, self.path.format(region), arrays)
+        return self.navigators[region]
+
+    def upstream_watershed(self, region, reach_id, mode='reach', return_times=False, return_lengths=False,
+                           max_days=None, max_length=None, max_depth=None):
+        """
+        Cached version of Navigator.upstream_watershed, including the travel time, flow length and depth limits.
+        Cached results are read-only.
+        """
+        key = ('upstream', region, reach_id, mode, return_times, return_lengths, max_days, max_length, max_depth)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.navigator(region).upstream_watershed(reach_id, mode, return_times, return_lengths,
+                                                               max_days=max_days, max_length=max_length,
+                                                               max_depth=max_depth)
+            self.cache.put(key, result)
+        return result
+
+    def downstream_watershed(self, region, reach_id, mode='reach', return_times=False, return_lengths=False):
+        """
+        Cached version of Navigator.downstream_watershed. Cached results are read-only.
+        """
+        key = ('downstream', region, reach_id, mode, return_times, return_lengths)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.navigator(region).downstream_watershed(reach_id, mode, return_times, return_lengths)
+            self.cache.put(key, result)
+        return result
+
+    def close(self):
+        """
+        Release shared memory. The owner also unlinks it, so call this only after workers have finished.
+        """
+        self.navigators = {}
+        self.cache = ResultCache(self.cache.max_bytes)
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                # Workers started from this process share its resource tracker, and unregistered the block when
+                # they attached. Register it again so that unlinking unregisters it cleanly
+                if sys.version_info < (3, 13):
+                    resource_tracker.register(block._name, 'shared_memory')
+                block.unlink()
+        self.blocks = {}
+
+
+def attach_block(block_name):
+    """
+    Attach to an existing shared memory block without registering it with this process's resource tracker. A
+    registered block is unlinked when the process exits, which would remove it for every other process.
+    :param block_name: Shared memory block name (str)
+    :return: Shared memory block (SharedMemory)
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=block_name, track=False)
+    block = shared_memory.SharedMemory(name=block_name)
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+def attach_registry(specs, upstream_path=None, cache_bytes=2 ** 28):
+    """
+    Initializer for pool workers, which attaches a registry to shared navigators
+    :param specs: Shared array specifications from NavigatorRegistry.specs (dict)
+    :param upstream_path: Path to navigator files, for regions that aren't shared (str)
+    :param cache_bytes: Size of the worker's result cache in bytes (int)
+    """
+    global worker_registry
+    worker_registry = NavigatorRegistry(upstream_path, cache_bytes, specs)
@@ -0,0 +1,344 @@
+"""
+spatial_nhd.py
+
+Resolve site coordinates to reach IDs (comids) using the NHD Plus catchments. Catchment outlines are read straight
+from the shapefile into flat vertex arrays, and their bounding boxes are binned into a uniform grid. A batch of points
+is matched to the catchments whose boxes cover each point's grid cell, and each match is confirmed by counting the
+crossings of the catchment outline, with every step vectorized over the batch. Points outside every catchment can be
+snapped to the nearest flowline instead, using an index of the same form over the flowlines. Indexes are written next
+to the navigator files and memory-mapped when opened.
+
+Coordinates are longitude and latitude in the datum of NHD Plus (NAD83).
+"""
+import hashlib
+import os
+import struct
+import numpy as np
+
+import read_nhd
+import write_nhd
+from navigator import expand_ranges
+from params_nhd import vpus_nhd
+from paths_nhd import catchment_path, flowline_path, catchment_index_path, flowline_index_path
+
+# Shapefile shape types made of parts and points: polylines, polygons, and their Z and M variants
+part_shape_types = (3, 5, 13, 15, 23, 25)
+
+# Approximate kilometres per degree of latitude
+km_per_degree = 111.32
+
+
+def read_shapes(shp_path):
+    """
+    Read the outlines of polygons or polylines from a shapefile into flat arrays. The vertices of all shapes are
+    stored end to end, and each edge is identified by the position of its first vertex, so that the edges of shape i
+    are edges[edge_offsets[i]:edge_offsets[i + 1]]. Z and M values are ignored.
+    :param shp_path: Path to the .shp file (str)
+    :return: Vertex longitudes and latitudes, first vertex of each edge, offsets of each shape's edges, and the
+    bounding box of each shape as [xmin, ymin, xmax, ymax] (np.array, np.array, np.array, np.array, np.array)
+    """
+    data = np.memmap(shp_path, dtype=np.uint8, mode='r')
+    shape_type = struct.unpack_from('<i', data, 32)[0]
+    if shape_type not in part_shape_types:
+        raise ValueError("Shapefile {} has shape type {}. Only polylines and polygons can be read".format(
+            shp_path, shape_type))
+
+    # Each record is a header with the content length in 16-bit words, followed by the shape type, bounding box,
+    # number of parts and points, the first point of each part, and the points
+    points, part_starts, n_points, boxes = [], [], [], []
+    position, n_vertices = 100, 0
+    while position + 8 <= data.size:
+        length = struct.unpack_from('>i', data, position + 4)[0] * 2
+        start, position = position + 8, position + 8 + length
+        if struct.unpack_from('<i', data, start)[0] == 0:  # Null shape
+            n_points.append(0)
+            boxes.append((np.inf, np.inf, -np.inf, -np.inf))
+            continue
+        boxes.append(struct.unpack_from('<4d', data, start + 4))
+        parts, count = struct.unpack_from('<2i', data, start + 36)
+        part_starts.append(np.frombuffer(data, np.int32, parts, start + 44) + n_vertices)
+        points.append(np.frombuffer(data, np.float64, count * 2, start + 44 + 4 * parts))
+        n_points.append(count)
+        n_vertices += count
+    points = np.concatenate(points).reshape(-1, 2) if points else np.zeros((0, 2))
+    part_starts = np.concatenate(part_starts) if part_starts else np.zeros(0, dtype=np.int32)
+
+    # Every vertex starts an edge except the last vertex of each part
+    is_edge = np.ones(n_vertices, dtype=bool)
+    is_edge[part_starts[part_starts > 0] - 1] = False
+    if n_vertices:
+        is_edge[-1] = False
+    edges = np.flatnonzero(is_edge)
+    vertex_shapes = np.repeat(np.arange(len(n_points)), n_points)
+    edge_offsets = np.zeros(len(n_points) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(vertex_shapes[edges], minlength=len(n_points)), out=edge_offsets[1:])
+    return points[:, 0].copy(), points[:, 1].copy(), edges.astype(np.int64), edge_offsets, np.array(boxes)
+
+
+def grid_index(boxes, edge_offsets, cells_per_shape=1.):
+    """
+    Bin the bounding boxes of shapes into a uniform grid, with about one cell per shape by default. Shapes are listed
+    under every cell that their box overlaps, in ascending order, so that the shapes in cell i are
+    cell_shapes[cell_offsets[i]:cell_offsets[i + 1]]. Shapes without edges are left out.
+    :param boxes: Bounding box of each shape as [xmin, ymin, xmax, ymax] (np.array)
+    :param edge_offsets: Offsets of each shape's edges (np.array)
+    :param cells_per_shape: Number of grid cells per shape (float)
+    :return: Grid origin, cell size and number of columns and rows as [x0, y0, dx, dy, nx, ny], offsets of each
+    cell's shapes, and the shapes in each cell (list, np.array, np.array)
+    """
+    shapes = np.flatnonzero(np.diff(edge_offsets) > 0)
+    if not shapes.size:
+        return [0., 0., 1., 1., 1, 1], np.zeros(2, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    x0, y0 = boxes[shapes, 0].min(), boxes[shapes, 1].min()
+    width = max(boxes[shapes, 2].max() - x0, 1e-9)
+    height = max(boxes[shapes, 3].max() - y0, 1e-9)
+    n_cells = shapes.size * cells_per_shape
+    nx = int(max(1, round(np.sqrt(n_cells * width / height))))
+    ny = int(max(1, np.ceil(n_cells / nx)))
+    grid = [float(x0), float(y0), width / nx, height / ny, nx, ny]
+
+    # List each shape under each cell of each grid row that its box spans
+    cols, rows = grid_cells(grid, boxes[shapes, ::2].T, boxes[shapes, 1::2].T)
+    row_positions, row_offsets = expand_ranges(rows[0], rows[1] - rows[0] + 1)
+    row_shapes = np.repeat(np.arange(shapes.size), np.diff(row_offsets))
+    cells, cell_offsets = expand_ranges(row_positions * nx + cols[0, row_shapes], (cols[1] - cols[0] + 1)[row_shapes])
+    cell_shapes = shapes[np.repeat(row_shapes, np.diff(cell_offsets))]
+    order = np.argsort(cells, kind='stable')
+    cell_offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=nx * ny), out=cell_offsets[1:])
+    return grid, cell_offsets, cell_shapes[order].astype(np.int32)
+
+
+def grid_cells(grid, x_limits, y_limits):
+    """
+    Find the range of grid columns and rows covered by a set of boxes. Ranges are clipped to the grid, so that a box
+    outside the grid has a range that ends before it starts. Boxes that start on the far edge of the grid, such as a
+    flat box along the top of the region, go in the last column or row.
+    :param grid: Grid as [x0, y0, dx, dy, nx, ny] (list)
+    :param x_limits: Lower and upper x of each box (np.array)
+    :param y_limits: Lower and upper y of each box (np.array)
+    :return: First and last column, and first and last row, of each box (np.array, np.array)
+    """
+    x0, y0, dx, dy, nx, ny = grid
+    cols = np.floor((np.asarray(x_limits, dtype=np.float64) - x0) / dx)
+    rows = np.floor((np.asarray(y_limits, dtype=np.float64) - y0) / dy)
+    outside = (cols[1] < 0) | (cols[0] > nx) | (rows[1] < 0) | (rows[0] > ny) | np.isnan(cols).any(0) | \
+        np.isnan(rows).any(0)
+    cols, rows = np.clip(np.nan_to_num(cols), 0, nx - 1), np.clip(np.nan_to_num(rows), 0, ny - 1)
+    cols[1, outside], rows[1, outside] = -1, -1
+    cols[0, outside], rows[0, outside] = 0, 0
+    return cols.astype(np.int64), rows.astype(np.int64)
+
+
+def batches(counts, batch_size):
+    """
+    Split items into consecutive batches with a total count of about batch_size each. Items with a count larger
+    than batch_size get a batch of their own.
+    :param counts: Count for each item, such as the number of edges to test (np.array)
+    :param batch_size: Total count per batch (int)
+    :return: Start and end of each batch (generator)
+    """
+    totals = np.cumsum(counts)
+    start = 0
+    while start < counts.size:
+        before = totals[start - 1] if start else 0
+        end = max(int(np.searchsorted(totals, before + batch_size, 'right')), start + 1)
+        yield start, end
+        start = end
+
+
+class SpatialIndex(object):
+    def __init__(self, path):
+        """
+        Open a spatial index written by build_index. Arrays are memory-mapped.
+        :param path: Directory containing the index (str)
+        """
+        header = read_nhd.columnar_header(path)
+        assert header is not None, "Spatial index {} not found".format(path)
+        self.path = path
+        self.grid = header['grid']
+        arrays = read_nhd.columnar_arrays(path)
+        self.ids, self.x, self.y, self.edges, self.edge_offsets, self.boxes, self.cell_offsets, self.cell_shapes = \
+            (arrays[name] for name in ('ids', 'x', 'y', 'edges', 'edge_offsets', 'boxes', 'cell_offsets',
+                                       'cell_shapes'))
+
+    def candidates(self, lon, lat, x_radius=0., y_radius=0.):
+        """
+        Find shapes whose bounding boxes are within a distance of each point
+        :param lon: Point longitudes (np.array)
+        :param lat: Point latitudes (np.array)
+        :param x_radius: Distance in degrees of longitude, for each point or for all points (np.array, float)
+        :param y_radius: Distance in degrees of latitude (float)
+        :return: Point and shape of each candidate pair, ordered by point and then shape (np.array, np.array)
+        """
+        x_radius = np.broadcast_to(x_radius, lon.shape)
+        cols, rows = grid_cells(self.grid, (lon - x_radius, lon + x_radius), (lat - y_radius, lat + y_radius))
+        nx = self.grid[4]
+
+        # The cells on each row of the search box are consecutive, so their shapes are one range of cell_shapes
+        row_positions, row_offsets = expand_ranges(rows[0], np.maximum(rows[1] - rows[0] + 1, 0))
+        row_points = np.repeat(np.arange(lon.size), np.diff(row_offsets))
+        starts = self.cell_offsets[row_positions * nx + cols[0, row_points]]
+        counts = self.cell_offsets[row_positions * nx + cols[1, row_points] + 1] - starts
+        positions, offsets = expand_ranges(starts, counts)
+        points, shapes = np.repeat(row_points, counts), np.asarray(self.cell_shapes[positions], dtype=np.int64)
+
+        # Drop shapes listed in more than one cell, and shapes whose boxes don't reach the point
+        pairs = np.unique(points * self.ids.size + shapes)
+        points, shapes = pairs // self.ids.size, pairs % self.ids.size
+        boxes = self.boxes[shapes]
+        near = (boxes[:, 0] - x_radius[points] <= lon[points]) & (lon[points] <= boxes[:, 2] + x_radius[points]) & \
+               (boxes[:, 1] - y_radius <= lat[points]) & (lat[points] <= boxes[:, 3] + y_radius)
+        return points[near], shapes[near]
+
+    def pair_edges(self, shapes):
+        """
+        List the edges of a set of shapes
+        :param shapes: Shapes (np.array)
+        :return: Pair of each edge, edge start and end vertices, and offsets of each pair's edges
+        (np.array, np.array, np.array, np.array)
+        """
+        starts = self.edge_offsets[shapes]
+        counts = self.edge_offsets[shapes + 1] - starts
+        positions, offsets = expand_ranges(starts, counts)
+        first = np.asarray(self.edges[positions])
+        return np.repeat(np.arange(shapes.size), counts), first, first + 1, offsets
+
+    def within(self, lon, lat, batch_size=2 ** 20):
+        """
+        Find the shape containing each point by counting the crossings of a ray from the point with the shape's
+        outline, which also handles holes. A point on a shared boundary is assigned to the first shape.
+        :param lon: Point longitudes (np.array)
+        :param lat: Point latitudes (np.array)
+        :param batch_size: Number of edges to test at once, which limits memory use (int)
+        :return: Shape containing each point, or -1 (np.array)
+        """
+        lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        points, shapes = self.candidates(lon, lat)
+        inside = np.zeros(points.size, dtype=bool)
+        counts = self.edge_offsets[shapes + 1] - self.edge_offsets[shapes]
+        for start, end in batches(counts, batch_size):
+            pairs, first, last, _ = self.pair_edges(shapes[start:end])
+            px, py = lon[points[start:end]][pairs], lat[points[start:end]][pairs]
+            xa, ya, xb, yb = self.x[first], self.y[first], self.x[last], self.y[last]
+            crossing = np.flatnonzero((ya > py) != (yb > py))
+            at_y = xa[crossing] + (py[crossing] - ya[crossing]) * (xb[crossing] - xa[crossing]) / \
+                (yb[crossing] - ya[crossing])
+            crossing = crossing[px[crossing] < at_y]
+            inside[start:end] = np.bincount(pairs[crossing], minlength=end - start) % 2 == 1
+
+        # Candidates are ordered by point and then shape, so the first match for each point is its lowest shape
+        found = np.full(lon.size, -1, dtype=np.int64)
+        matched_points, first = np.unique(points[inside], return_index=True)
+        found[matched_points] = shapes[inside][first]
+        return found
+
+    def nearest(self, lon, lat, max_distance=1., batch_size=2 ** 20):
+        """
+        Find the nearest shape outline to each point, within a maximum distance. Distances are measured on a plane
+        with longitude scaled by the cosine of each point's latitude, which is accurate to well under 1% at the
+        distances used for snapping.
+        :param lon: Point longitudes (np.array)
+        :param lat: Point latitudes (np.array)
+        :param max_distance: Maximum distance in km (float)
+        :param batch_size: Number of edges to test at once, which limits memory use (int)
+        :return: Nearest shape to each point or -1, and the distance in km or nan (np.array, np.array)
+        """
+        lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        scale = np.cos(np.radians(lat))
+        y_radius = max_distance / km_per_degree
+        points, shapes = self.candidates(lon, lat, y_radius / np.maximum(scale, 1e-6), y_radius)
+        distances = np.zeros(points.size)
+        counts = self.edge_offsets[shapes + 1] - self.edge_offsets[shapes]
+        for start, end in batches(counts, batch_size):
+            pairs, first, last, offsets = self.pair_edges(shapes[start:end])
+            batch_points = points[start:end][pairs]
+            px, py, kx = lon[batch_points], lat[batch_points], scale[batch_points]
+            ax, ay = (self.x[first] - px) * kx, self.y[first] - py
+            dx, dy = (self.x[last] - px) * kx - ax, self.y[last] - py - ay
+            length = dx * dx + dy * dy
+            t = np.clip(-(ax * dx + ay * dy) / np.where(length > 0, length, 1.), 0., 1.)
+            squared = (ax + t * dx) ** 2 + (ay + t * dy) ** 2
+            distances[start:end] = np.sqrt(np.minimum.reduceat(squared, offsets[:-1])) * km_per_degree
+
+        found = np.full(lon.size, -1, dtype=np.int64)
+        found_distance = np.full(lon.size, np.nan)
+        close = distances <= max_distance
+        order = np.lexsort((distances[close], points[close]))
+        matched_points, first = np.unique(points[close][order], return_index=True)
+        found[matched_points] = shapes[close][order][first]
+        found_distance[matched_points] = distances[close][order][first]
+        return found, found_distance
+
+
+def source_key(shp_path):
+    """
+    Fingerprint a shapefile from the size and modification time of its .shp and .dbf files
+    :param shp_path: Path to the .shp file (str)
+    :return: Cache key (str)
+    """
+    key = hashlib.sha1()
+    for path in (shp_path, os.path.splitext(shp_path)[0] + '.dbf'):
+        stat = os.stat(path)
+        key.update("{}|{}|{}".format(path, stat.st_size, stat.st_mtime_ns).encode())
+    return key.hexdigest()
+
+
+def build_index(shp_path, out_path, id_field, cache_key=None):
+    """
+    Build a spatial index from a polygon or polyline shapefile and write it as a directory of arrays
+    :param shp_path: Path to the .shp file (str)
+    :param out_path: Output directory (str)
+    :param id_field: Field in the .dbf file with the ID of each shape, such as 'featureid' (str)
+    :param cache_key: Key identifying the source data (str)
+    """
+    x, y, edges, edge_offsets, boxes = read_shapes(shp_path)
+    dbf_path = os.path.splitext(shp_path)[0] + '.dbf'
+    ids = read_nhd.dbf_columns(dbf_path, [id_field], {id_field.lower(): np.dtype(np.int64)})[id_field.lower()]
+    if ids.size != boxes.shape[0]:
+        raise ValueError("{} has {} shapes but {} has {} records".format(shp_path, boxes.shape[0], dbf_path, ids.size))
+    grid, cell_offsets, cell_shapes = grid_index(boxes, edge_offsets)
+    arrays = {'ids': ids, 'x': x, 'y': y, 'edges': edges, 'edge_offsets': edge_offsets, 'boxes': boxes,
+              'cell_offsets': cell_offsets, 'cell_shapes': cell_shapes}
+    write_nhd.array_directory(out_path, arrays, {'cache_key': cache_key, 'grid': grid, 'source': shp_path})
+
+
+def build_indexes(region, overwrite=False):
+    """
+    Build the catchment and flowline indexes for a region, unless they're current
+    :param region: NHD Hydroregion id (str)
+    :param overwrite: Rebuild even if the indexes are current (bool)
+    """
+    for shp_path, out_path, id_field in ((catchment_path, catchment_index_path, 'featureid'),
+                                         (flowline_path, flowline_index_path, 'comid')):
+        shp_path, out_path = shp_path.format(vpus_nhd[region], region), out_path.format(region)
+        cache_key = source_key(shp_path)
+        header = read_nhd.columnar_header(out_path)
+        if overwrite or header is None or header.get('cache_key') != cache_key:
+            build_index(shp_path, out_path, id_field, cache_key)
+
+
+def snap_points(region, lat, lon, fallback=False, max_distance=1., return_distance=False):
+    """
+    Find the comid of the catchment containing each point. Points outside every catchment are given a comid of 0,
+    or with fallback, the comid of the nearest flowline within max_distance.
+    :param region: NHD Hydroregion id (str)
+    :param lat: Point latitudes (np.array)
+    :param lon: Point longitudes (np.array)
+    :param fallback: Snap points outside catchments to the nearest flowline (bool)
+    :param max_distance: Maximum distance to a flowline in km (float)
+    :param return_distance: Also return the distance to the flowline in km, which is 0 for points inside catchments
+    and nan for points that weren't matched (bool)
+    :return: Comid of each point, and the distances if requested (np.array, np.array)
+    """
+    lat, lon = np.atleast_1d(np.asarray(lat, dtype=np.float64)), np.atleast_1d(np.asarray(lon, dtype=np.float64))
+    catchments = SpatialIndex(catchment_index_path.format(region))
+    shapes = catchments.within(lon, lat)
+    comids = np.where(shapes >= 0, catchments.ids[np.maximum(shapes, 0)], 0)
+    distances = np.where(shapes >= 0, 0., np.nan)
+    outside = np.flatnonzero(shapes < 0)
+    if fallback and outside.size:
+        flowlines = SpatialIndex(flowline_index_path.format(region))
+        shapes, distances[outside] = flowlines.nearest(lon[outside], lat[outside], max_distance)
+        comids[outside] = np.where(shapes >= 0, flowlines.ids[np.maximum(shapes, 0)], 0)
+    return (comids, distances) if return_distance else comids
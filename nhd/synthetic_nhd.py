@@ -0,0 +1,82 @@
+"""
+synthetic_nhd.py
+
+Generate synthetic condensed NHD reach tables for testing and benchmarking without NHD Plus data. Each outlet drains
+its own network, and network sizes follow a lognormal distribution, so that a region has a few large river basins
+and many small coastal networks. Networks are grown from their outlets: each new reach usually extends a recent flow
+path and otherwise joins an earlier reach of the same network as a tributary, which gives long main stems with many
+short tributaries. A small share of reaches split at a divergence, with the minor branch rejoining the network further
+downstream.
+"""
+import numpy as np
+import pandas as pd
+
+# Approximate number of flowlines in small, typical and large NHD Plus regions
+region_sizes = {'small': 30000, 'medium': 150000, 'large': 400000}
+
+
+def synthetic_nhd(n_reaches, n_outlets=None, extend_probability=0.6, tributary_window=200, divergence_fraction=0.01,
+                  size_sigma=1.5, seed=0):
+    """
+    Generate a synthetic condensed NHD reach table with the fields used to build a Navigator
+    :param n_reaches: Number of reaches, not including minor divergence branches (int)
+    :param n_outlets: Number of outlets, each with its own network. Defaults to one per thousand reaches (int)
+    :param extend_probability: Probability that a reach extends the flow path of the previous reach (float)
+    :param tributary_window: Typical number of reaches back from the newest reach where a tributary joins. Larger
+    windows give shallower networks (int)
+    :param divergence_fraction: Fraction of reaches with a minor divergence branch (float)
+    :param size_sigma: Standard deviation of the log of network sizes (float)
+    :param seed: Random seed (int)
+    :return: Table with comid, tocomid, divergence, stream_calc, fcode, hydroseq, terminal_path, travel_time and
+    lengthkm fields, with a row for each downstream reach (df)
+    """
+    rng = np.random.default_rng(seed)
+    n_outlets = min(max(1, n_reaches // 1000) if n_outlets is None else n_outlets, n_reaches)
+
+    # Each network is a contiguous range of reaches starting with its outlet, with at least one reach per network
+    weights = rng.lognormal(0., size_sigma, n_outlets)
+    sizes = 1 + np.floor((n_reaches - n_outlets) * weights / weights.sum()).astype(np.int64)
+    sizes[np.argmax(sizes)] += n_reaches - sizes.sum()
+    network_starts = np.cumsum(sizes) - sizes
+    root = np.repeat(network_starts, sizes)
+
+    # Reaches are created after the reach they drain to, which is in the same network
+    reaches = np.arange(n_reaches)
+    downstream = np.where(rng.random(n_reaches) < extend_probability, reaches - 1,
+                          np.maximum(reaches - rng.geometric(1. / tributary_window, n_reaches), root)).astype(np.int64)
+    downstream[network_starts] = -1
+
+    # Minor divergence branches leave a reach and rejoin two reaches further down
+    diverging = reaches[(rng.random(n_reaches) < divergence_fraction) & (downstream >= 0)]
+    diverging = diverging[downstream[downstream[diverging]] >= 0]
+    n_branches = diverging.size
+    branches = np.arange(n_reaches, n_reaches + n_branches)
+    total = n_reaches + n_branches
+
+    # Hydrologic sequence decreases downstream. Branches are numbered just above the reach they rejoin
+    order = np.concatenate((reaches, downstream[downstream[diverging]] + 0.5))
+    hydroseq = np.empty(total)
+    hydroseq[np.argsort(order, kind='stable')] = np.arange(1, total + 1)
+    roots = np.concatenate((root, root[diverging]))
+
+    comids = rng.choice(np.arange(1000000, 1000000 + total * 20), total, replace=False)
+    lengthkm = np.round(rng.lognormal(0.5, 0.8, total), 3)
+    velocity = rng.uniform(0.2, 1.0, total)  # m/s
+    travel_time = lengthkm * 1000. / (velocity * 86400.)  # days
+
+    # The main path below a divergence is 1 and the minor path is 2, as in NHD Plus
+    divergence = np.zeros(total, dtype=np.int32)
+    divergence[downstream[diverging]] = 1
+    divergence[branches] = 2
+    stream_calc = np.where(divergence == 2, 0, 1 + rng.integers(0, 4, total)).astype(np.int32)
+
+    # One row per downstream connection: main paths, reaches splitting into branches, and branches rejoining
+    from_reach = np.concatenate((reaches, diverging, branches))
+    to_reach = np.concatenate((downstream, branches, downstream[downstream[diverging]]))
+    table = pd.DataFrame({'comid': comids[from_reach],
+                          'tocomid': np.where(to_reach >= 0, comids[np.maximum(to_reach, 0)], 0),
+                          'divergence': divergence[from_reach], 'stream_calc': stream_calc[from_reach],
+                          'fcode': 46006, 'hydroseq': hydroseq[from_reach],
+                          'terminal_path': hydroseq[roots[from_reach]],
+                          'travel_time': travel_time[from_reach], 'lengthkm': lengthkm[from_reach]})
+    return table.sample(frac=1, random_state=seed).reset_index(drop=True)
@@ -0,0 +1,141 @@
+"""
+update_nhd.py
+
+Update a Navigator after edits to the NHD reach table without rebuilding the whole region. Each outlet's network
+occupies its own contiguous block of the path arrays, so networks untouched by the edits are carried over as they
+are, and only the networks containing edited reaches are traced again and appended. The table processing and the
+splice are vectorized over the region, while the slow upstream trace only covers the affected networks.
+"""
+import numpy as np
+
+from navigator import rapid_trace, map_paths, upstream_index, downstream_index, reach_index, PathWriter
+from process_nhd import prepare_network
+from profile_nhd import Progress
+from validate_nhd import check_network
+from tools_hydro.efed_lib import report
+
+# Fields that determine the traced network
+network_fields = ['comid', 'tocomid', 'divergence', 'stream_calc', 'fcode', 'hydroseq', 'terminal_path',
+                  'travel_time', 'lengthkm']
+
+
+def changed_reaches(old_table, new_table):
+    """
+    Find reaches that were added, removed, or had any network field changed
+    :param old_table: Condensed NHD reach table that the navigator was built from (df)
+    :param new_table: Edited condensed NHD reach table (df)
+    :return: Reach IDs (np.array)
+    """
+    old_rows = old_table[network_fields].drop_duplicates()
+    new_rows = new_table[network_fields].drop_duplicates()
+    merged = old_rows.merge(new_rows, how='outer', indicator=True)
+    return np.unique(merged.comid.values[merged['_merge'].values != 'both'])
+
+
+def network_outlets(nodes, n_nodes):
+    """
+    Find the most downstream reach of every reach by repeatedly jumping to the reach downstream of the current one,
+    doubling the distance each time
+    :param nodes: Array of to-from node pairs, with no more than one downstream node per node (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Most downstream node of each node (np.array)
+    """
+    jump = np.arange(n_nodes)
+    connected = nodes[:, 0] >= 0
+    jump[nodes[connected, 1]] = nodes[connected, 0]
+    for _ in range(64):
+        next_jump = jump[jump]
+        if np.array_equal(next_jump, jump):
+            break
+        jump = next_jump
+    return jump
+
+
+def update_navigator(nav, old_table, new_table, on_error='raise', memory_budget=2 ** 30, spill_dir=None):
+    """
+    Update a navigator for an edited reach table. Networks are affected if they contain a changed reach in either
+    version of the table, and affected networks are expanded until no reach moves between an affected and an
+    unaffected network.
+    :param nav: Navigator built from the old table (Navigator)
+    :param old_table: Condensed NHD reach table that the navigator was built from (df)
+    :param new_table: Edited condensed NHD reach table (df)
+    :param on_error: What to do with problems in the edited network: 'raise', 'skip' or 'repair' (str)
+    :param memory_budget: Bytes of traced paths to hold in memory before spilling to disk (int)
+    :param spill_dir: Directory for traced paths spilled to disk (str)
+    :return: Navigator arrays in the order taken by write_nhd.navigator_file, the region exits, and the validation
+    report for the edited network (tuple, tuple, dict)
+    """
+    nodes, times, dists, outlets, conversion, exits = prepare_network(new_table, True)
+    nodes, outlets, validation = check_network(nodes, outlets, conversion, on_error)
+    sorted_reaches, reach_order = reach_index(conversion)
+    n_new, n_old = conversion.size, nav.alias_to_reach.size
+
+    # Match aliases between the old and new tables, and find the outlet of every reach in each
+    old_to_new = reach_order[np.minimum(np.searchsorted(sorted_reaches, nav.alias_to_reach), n_new - 1)]
+    old_to_new = np.where(conversion[old_to_new] == nav.alias_to_reach, old_to_new, -1)
+    new_to_old = nav.aliases(conversion)
+    old_outlets = nav.outlets(np.arange(n_old), 'alias')
+    new_outlets = network_outlets(nodes, n_new)
+
+    # Expand the affected networks until no reach moves between an affected and unaffected network
+    changed = changed_reaches(old_table, new_table)
+    affected_old = np.unique(old_outlets[nav.aliases(changed)[nav.aliases(changed) >= 0]])
+    new_changed = reach_order[np.minimum(np.searchsorted(sorted_reaches, changed), n_new - 1)]
+    affected_new = np.unique(new_outlets[new_changed[conversion[new_changed] == changed]])
+    while True:
+        old_members = np.flatnonzero(np.isin(old_outlets, affected_old))
+        new_members = np.flatnonzero(np.isin(new_outlets, affected_new))
+        moved_new = old_to_new[old_members]
+        moved_old = new_to_old[new_members]
+        grown_new = np.union1d(affected_new, new_outlets[moved_new[moved_new >= 0]])
+        grown_old = np.union1d(affected_old, old_outlets[moved_old[moved_old >= 0]])
+        if grown_new.size == affected_new.size and grown_old.size == affected_old.size:
+            break
+        affected_new, affected_old = grown_new, grown_old
+    affected_old = affected_old[affected_old >= 0]
+
+    # Carry over the unaffected blocks, shifting positions and rows past the removed blocks
+    keep = ~np.isin(old_outlets[nav.paths], affected_old)
+    keep_rows = keep[nav.offsets[:-1]]
+    positions_before = np.append(0, np.cumsum(keep))
+    rows_before = np.append(0, np.cumsum(keep_rows))
+    kept_old = np.asarray(nav.paths)[keep]
+    kept = old_to_new[kept_old]
+    kept_map = np.asarray(nav.map)[kept_old].astype(np.int64)
+    kept_map[:, :2] = rows_before[kept_map[:, :2]]
+    kept_index = positions_before[np.asarray(nav.index)[kept_old].astype(np.int64)]
+    kept_parents = np.asarray(nav.parents)[kept_old]
+    kept_parents = np.where(kept_parents >= 0, old_to_new[kept_parents], -1)
+    kept_offsets = positions_before[np.asarray(nav.offsets)[:-1][keep_rows]]
+
+    # Trace the affected networks. Spilled paths are removed once they've been copied into the output arrays
+    report("Retracing {} of {} reaches in {} networks".format(new_members.size, n_new, affected_new.size), 3)
+    trace_outlets = outlets[np.isin(new_outlets[outlets], affected_new)]
+    progress = Progress(new_members.size, "Retraced reaches")
+    writer = PathWriter(memory_budget=memory_budget, spill_dir=spill_dir)
+    try:
+        paths, path_times, path_dists, path_offsets, path_starts = \
+            rapid_trace(nodes, trace_outlets, times, dists, conversion, writer, progress)
+        n_positions, n_rows = kept.size, kept_offsets.size
+
+        path_map = np.zeros((n_new, 3), dtype=np.int32)
+        index = np.full((n_new, 2), -1, dtype=np.int32)
+        parents = np.full(n_new, -1, dtype=np.int32)
+        path_map[kept], index[kept], parents[kept] = kept_map, kept_index, kept_parents
+        if paths.size:
+            traced_map = map_paths(paths, path_offsets, path_starts)
+            traced_index = upstream_index(paths, path_offsets, traced_map)
+            traced_parents = downstream_index(paths, path_offsets, traced_map)
+            path_map[paths] = traced_map[paths] + np.array([n_rows, n_rows, 0], dtype=np.int32)
+            index[paths] = traced_index[paths] + n_positions
+            parents[paths] = traced_parents[paths]
+
+        arrays = (np.concatenate((kept, paths)).astype(np.int32),
+                  np.concatenate((np.asarray(nav.times)[keep], path_times)),
+                  np.concatenate((np.asarray(nav.lengths)[keep], path_dists)),
+                  np.concatenate((kept_offsets, np.asarray(path_offsets) + n_positions)),
+                  path_map, index, parents, conversion, sorted_reaches, reach_order)
+        del paths, path_times, path_dists, path_offsets, path_starts
+    finally:
+        writer.cleanup()
+    return arrays, exits, validation
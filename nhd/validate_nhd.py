@@ -0,0 +1,251 @@
+"""
+validate_nhd.py
+
+Check the reach network for problems that would stop it from being traced, using the node arrays from
+navigator.unpack_nhd. Every check is a vectorized pass over the links, so validating a region takes about as long as
+unpacking it. The result is a report of the reaches involved in each problem, and problems can be raised as an error,
+skipped by leaving the affected networks out of the trace, or repaired.
+"""
+import json
+import os
+import numpy as np
+
+from accumulate_nhd import topological_levels
+from navigator import NetworkError, adjacency_index, expand_ranges
+from tools_hydro.efed_lib import report
+
+# Problems that are reported, in the order they're checked
+issue_types = ('duplicate_links', 'multiple_downstream', 'duplicate_outlets', 'cycles', 'dangling', 'uncovered')
+
+
+def upstream_labels(nodes, seeds, labels, n_nodes):
+    """
+    Spread labels upstream from a set of seed nodes, one level at a time. Each node keeps the first label to reach it.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param seeds: Nodes to start from (np.array)
+    :param labels: Label of each seed (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Label of each node, or -1 for nodes that aren't upstream of a seed (np.array)
+    """
+    offsets, neighbours = adjacency_index(nodes, n_nodes)
+    node_labels = np.full(n_nodes, -1, dtype=np.int64)
+    seeds, first = np.unique(seeds, return_index=True)
+    node_labels[seeds] = np.asarray(labels)[first]
+    frontier = seeds
+    while frontier.size:
+        starts = offsets[frontier]
+        counts = offsets[frontier + 1] - starts
+        positions, _ = expand_ranges(starts, counts)
+        upstream, sources = neighbours[positions], np.repeat(frontier, counts)
+        new = node_labels[upstream] < 0
+        frontier, first = np.unique(upstream[new], return_index=True)
+        node_labels[frontier] = node_labels[sources[new][first]]
+    return node_labels
+
+
+def cycle_members(nodes, n_nodes):
+    """
+    Find nodes on loops. Nodes that can be sorted from the headwaters down are removed first, which leaves loops and
+    everything downstream of them, and then nodes that can be sorted from the outlets up are removed. Nodes on a path
+    between two loops are also left.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Nodes on loops (np.array)
+    """
+    order, _ = topological_levels(nodes, n_nodes)
+    remaining = np.ones(n_nodes, dtype=bool)
+    remaining[order] = False
+    links = nodes[(nodes[:, 0] >= 0) & (nodes[:, 1] >= 0)]
+    links = links[remaining[links[:, 0]] & remaining[links[:, 1]]]
+    order, _ = topological_levels(links[:, ::-1], n_nodes)
+    remaining[order] = False
+    return np.flatnonzero(remaining)
+
+
+def cycle_groups(nodes, members, n_nodes):
+    """
+    Group loop nodes that are linked to each other, labelling each group by its lowest alias
+    :param nodes: Array of to-from node pairs (np.array)
+    :param members: Nodes on loops (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Label of each member (np.array)
+    """
+    on_cycle = np.zeros(n_nodes, dtype=bool)
+    on_cycle[members] = True
+    links = nodes[(nodes[:, 0] >= 0) & (nodes[:, 1] >= 0)]
+    links = links[on_cycle[links[:, 0]] & on_cycle[links[:, 1]]]
+    labels = np.arange(n_nodes)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, links[:, 0], labels[links[:, 1]])
+        np.minimum.at(new_labels, links[:, 1], labels[links[:, 0]])
+        if np.array_equal(new_labels, labels):
+            return labels[members]
+        labels = new_labels
+
+
+def network_issues(nodes, outlets, n_nodes):
+    """
+    Find the nodes involved in each type of problem
+    :param nodes: Array of to-from node pairs (np.array)
+    :param outlets: Array of outlet nodes (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Nodes with each type of problem, and the outlet that each node drains to or -1 (dict, np.array)
+    """
+    from_nodes = nodes[:, 1]
+    linked = nodes[:, 0] >= 0
+    is_outlet = np.zeros(n_nodes, dtype=bool)
+    is_outlet[outlets] = True
+
+    # Reaches with the same link listed more than once, or more than one distinct downstream reach
+    link_keys = from_nodes.astype(np.int64) * (n_nodes + 1) + nodes[:, 0] + 1
+    keys, counts = np.unique(link_keys, return_counts=True)
+    duplicate_links = np.unique(keys[counts > 1] // (n_nodes + 1))
+    multiple_downstream = np.flatnonzero(np.bincount(keys // (n_nodes + 1), minlength=n_nodes) > 1)
+    outlet_nodes, counts = np.unique(outlets, return_counts=True)
+    duplicate_outlets = outlet_nodes[counts > 1]
+
+    # Reaches that drain nowhere without being outlets, and reaches that don't drain to an outlet
+    has_downstream = np.bincount(from_nodes[linked], minlength=n_nodes) > 0
+    dangling = np.flatnonzero(~has_downstream & ~is_outlet)
+    labels = upstream_labels(nodes, outlets, outlets, n_nodes)
+    uncovered = np.flatnonzero(labels < 0)
+
+    issues = {'duplicate_links': duplicate_links, 'multiple_downstream': multiple_downstream,
+              'duplicate_outlets': duplicate_outlets, 'cycles': cycle_members(nodes, n_nodes), 'dangling': dangling,
+              'uncovered': uncovered}
+    return issues, labels
+
+
+def validate_network(nodes, outlets, conversion):
+    """
+    Check a reach network for problems that would stop it from being traced: reaches with more than one downstream
+    link or duplicated links, outlets listed twice, loops, reaches that end without being outlets, and reaches that
+    don't drain to an outlet. Unconnected reaches are grouped into components by the reach or loop they drain to.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param outlets: Array of outlet nodes (np.array)
+    :param conversion: Array to interpret node aliases (np.array)
+    :return: Report with the reach IDs involved in each problem (dict)
+    """
+    issues, _ = network_issues(nodes, outlets, conversion.size)
+    return issue_report(nodes, outlets, conversion, issues)
+
+
+def issue_report(nodes, outlets, conversion, issues):
+    """
+    Summarize network problems in a form that can be written to JSON
+    :param nodes: Array of to-from node pairs (np.array)
+    :param outlets: Array of outlet nodes (np.array)
+    :param conversion: Array to interpret node aliases (np.array)
+    :param issues: Nodes with each type of problem, from network_issues (dict)
+    :return: Report (dict)
+    """
+    n_nodes = conversion.size
+    sinks = np.concatenate((issues['dangling'], issues['cycles']))
+    sink_labels = np.concatenate((issues['dangling'], cycle_groups(nodes, issues['cycles'], n_nodes)))
+    components = upstream_labels(nodes, sinks, sink_labels, n_nodes)[issues['uncovered']]
+    validation = {'reaches': int(n_nodes), 'links': int((nodes[:, 0] >= 0).sum()),
+                  'outlets': int(np.unique(outlets).size),
+                  'valid': not any(issues[issue].size for issue in issue_types),
+                  'components': int(np.unique(components[components >= 0]).size)}
+    for issue in issue_types:
+        validation[issue] = conversion[issues[issue]].tolist()
+    return validation
+
+
+def repair_network(nodes, outlets, n_nodes):
+    """
+    Repair the network so that it can be traced. Outlets lose their downstream links, other reaches keep only their
+    first downstream link, loops are cut at their lowest alias, and reaches that end without being outlets become
+    outlets.
+    :param nodes: Array of to-from node pairs (np.array)
+    :param outlets: Array of outlet nodes (np.array)
+    :param n_nodes: Number of node aliases (int)
+    :return: Repaired nodes and outlets, links that were cut to break loops, and new outlets
+    (np.array, np.array, np.array, np.array)
+    """
+    _, first = np.unique(outlets, return_index=True)
+    outlets = outlets[np.sort(first)]
+    is_outlet = np.zeros(n_nodes, dtype=bool)
+    is_outlet[outlets] = True
+
+    # Keep one row for each reach, preferring the first row with a downstream link
+    rows = np.arange(nodes.shape[0])
+    keep_link = (nodes[:, 0] >= 0) & ~is_outlet[nodes[:, 1]]
+    order = np.lexsort((rows, ~keep_link, nodes[:, 1]))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = nodes[order[1:], 1] != nodes[order[:-1], 1]
+    chosen = np.sort(order[first])
+    nodes = np.column_stack((np.where(keep_link[chosen], nodes[chosen, 0], -1), nodes[chosen, 1])).astype(np.int32)
+
+    # Cut one link in each group of loops until none are left
+    cut = []
+    while True:
+        members = cycle_members(nodes, n_nodes)
+        if not members.size:
+            break
+        heads = members[cycle_groups(nodes, members, n_nodes) == members]
+        nodes[np.isin(nodes[:, 1], heads), 0] = -1
+        cut.append(heads)
+
+    # Reaches without a downstream link become outlets
+    roots = nodes[(nodes[:, 0] < 0) & ~is_outlet[nodes[:, 1]], 1]
+    cut = np.concatenate(cut) if cut else np.zeros(0, dtype=np.int32)
+    return nodes, np.concatenate((outlets, roots)).astype(outlets.dtype), cut, roots
+
+
+def check_network(nodes, outlets, conversion, on_error='raise'):
+    """
+    Validate the network before tracing and deal with any problems
+    :param nodes: Array of to-from node pairs (np.array)
+    :param outlets: Array of outlet nodes (np.array)
+    :param conversion: Array to interpret node aliases (np.array)
+    :param on_error: 'raise' to raise a NetworkError, 'skip' to leave networks with reaches that drain more than one
+    way or have duplicated links out of the trace, or 'repair' to repair the network (see repair_network) (str)
+    :return: Nodes and outlets to trace, and the validation report (np.array, np.array, dict)
+    """
+    if on_error not in ('raise', 'skip', 'repair'):
+        raise ValueError("Invalid on_error {}. Must be 'raise', 'skip' or 'repair'".format(on_error))
+    issues, labels = network_issues(nodes, outlets, conversion.size)
+    validation = issue_report(nodes, outlets, conversion, issues)
+    validation['action'] = on_error
+    if validation['valid']:
+        return nodes, outlets, validation
+
+    summary = ", ".join("{} {}".format(len(validation[issue]), issue.replace('_', ' '))
+                        for issue in issue_types if validation[issue])
+    if on_error == 'raise':
+        raise NetworkError("Invalid reach network: {}".format(summary), validation)
+    report("Invalid reach network: {}".format(summary), warn=1)
+
+    if on_error == 'skip':
+        # A reach with several downstream links, or the same link listed twice, would be traced more than once
+        repeated = np.union1d(issues['multiple_downstream'], issues['duplicate_links'])
+        branching = np.isin(nodes[:, 1], repeated) & (nodes[:, 0] >= 0)
+        skipped = np.unique(np.concatenate((labels[nodes[branching, 0]], labels[repeated])))
+        skipped = skipped[skipped >= 0]
+        _, first = np.unique(outlets, return_index=True)
+        outlets = outlets[np.sort(first)]
+        outlets = outlets[~np.isin(outlets, skipped)]
+        validation['skipped_outlets'] = conversion[skipped].tolist()
+        validation['skipped_reaches'] = int(np.isin(labels, skipped).sum())
+    else:
+        n_links = int((nodes[:, 0] >= 0).sum())
+        nodes, outlets, cut, roots = repair_network(nodes, outlets, conversion.size)
+        validation['removed_links'] = n_links - int((nodes[:, 0] >= 0).sum())
+        validation['cut_links'] = conversion[cut].tolist()
+        validation['new_outlets'] = conversion[roots].tolist()
+    return nodes, outlets, validation
+
+
+def write_report(validation, out_path):
+    """
+    Write a validation report to a JSON file
+    :param validation: Report from validate_network or check_network (dict)
+    :param out_path: Output path (str)
+    """
+    out_dir = os.path.dirname(out_path)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(out_path, 'w') as f:
+        json.dump(validation, f, indent=1)
@@ -1,6 +1,10 @@
-from paths_nhd import condensed_nhd_path, navigator_path
+from paths_nhd import condensed_nhd_path, navigator_path, navigator_archive_path
+import read_nhd
 import numpy as np
+import pandas as pd
+import json
 import os
+import zlib
 
 
 def create_dir(outfile):
@@ -9,17 +13,100 @@ def create_dir(outfile):
         os.makedirs(directory)
 
 
-def condensed_nhd(run_id, region, reach_table, lake_table=None, out_dir=None):
+def condensed_nhd(run_id, region, reach_table, lake_table=None, out_dir=None, cache_key=None):
     out_dir = condensed_nhd_path if out_dir is None else out_dir
-    create_dir(condensed_nhd_path)
+    dtypes = read_nhd.field_dtypes(name_field='internal_name')
     for feature_type, table in (('reach', reach_table), ('waterbody', lake_table)):
         if table is not None:
             out_path = out_dir.format(run_id, region, feature_type)
-            table.to_csv(out_path, index=None)
+            columnar_table(out_path, table, dtypes, {'cache_key': cache_key})
 
 
-def navigator_file(region, paths, times, length, path_map, conversion):
-    create_dir(navigator_path)
-    outfile = navigator_path.format(region)
-    np.savez_compressed(outfile, paths=paths, time=times, length=length, path_map=path_map,
-                        alias_index=conversion)
+def columnar_table(out_dir, table, dtypes=None, attributes=None):
+    """
+    Write a table as a directory of uncompressed .npy files, one per column, which can be memory-mapped individually
+    :param out_dir: Output directory (str)
+    :param table: Table to write (df)
+    :param dtypes: Data types indexed by field name. See enforce_dtype for fields that aren't included (dict)
+    :param attributes: Additional values to store in the header, such as a cache key (dict)
+    """
+    dtypes = {} if dtypes is None else dtypes
+    columns = {field: enforce_dtype(table[field], dtypes.get(field)) for field in table.columns}
+    header = {'n_rows': len(table)}
+    header.update({} if attributes is None else attributes)
+    array_directory(out_dir, columns, header)
+
+
+def array_directory(out_dir, arrays, attributes=None):
+    """
+    Write arrays to a directory as uncompressed .npy files, which can be memory-mapped and shared between processes.
+    The header, which lists the data type, shape and CRC-32 checksum of each array, is written last so that a partly
+    written directory is never read.
+    :param out_dir: Output directory (str)
+    :param arrays: Arrays indexed by name (dict)
+    :param attributes: Additional values to store in the header (dict)
+    """
+    header_path = os.path.join(out_dir, 'header.json')
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    header = {'version': 1, 'arrays': {}}
+    header.update({} if attributes is None else attributes)
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        np.save(os.path.join(out_dir, name + '.npy'), values)
+        header['arrays'][name] = [values.dtype.str, list(values.shape), zlib.crc32(values.data.cast('B'))]
+    with open(header_path, 'w') as f:
+        json.dump(header, f, indent=1)
+
+
+def enforce_dtype(values, dtype=None):
+    """
+    Convert a column to a compact data type. If no type is given, 64-bit floats become float32, 64-bit integers
+    become int32 where they fit, and text becomes fixed-width unicode. Missing values in integer fields are
+    set to 0, the NHD Plus convention for a missing ID.
+    :param values: Column values (pd.Series)
+    :param dtype: Data type (np.dtype)
+    :return: Converted values (np.array)
+    """
+    if dtype is None:
+        if pd.api.types.is_float_dtype(values):
+            dtype = np.float32
+        elif pd.api.types.is_integer_dtype(values):
+            limits = np.iinfo(np.int32)
+            in_range = values.empty or (values.min() >= limits.min and values.max() <= limits.max)
+            dtype = np.int32 if in_range else values.dtype
+        elif pd.api.types.is_bool_dtype(values):
+            dtype = np.bool_
+        else:
+            return values.fillna('').astype(str).to_numpy(dtype=str)
+    if np.dtype(dtype).kind in 'iu':
+        values = values.fillna(0)
+    return values.to_numpy().astype(dtype)
+
+
+def navigator_file(region, paths, times, length, path_offsets, path_map, index, parents, conversion, sorted_reaches,
+                   reach_order, out_path=None, compress=False, cache_key=None, exits=None):
+    """
+    Write the arrays for a Navigator. By default the arrays are written uncompressed to a directory so that they can
+    be memory-mapped. Compressed files are smaller and intended for archiving, but must be read in full.
+    :param region: NHD Hydroregion id (str)
+    :param out_path: Output path, formatted with the region (str)
+    :param compress: Write a single compressed .npz file instead of a directory (bool)
+    :param cache_key: Key identifying the source data, stored in the header of a directory (str)
+    :param exits: Reach IDs of reaches that drain into another region, and the reaches they drain to (tuple)
+    """
+    exit_from, exit_to = (np.zeros(0, dtype=np.int32),) * 2 if exits is None else exits
+    arrays = {'paths': paths.astype(np.int32), 'time': times.astype(np.float32), 'length': length.astype(np.float32),
+              'path_offsets': path_offsets.astype(np.int64), 'path_map': path_map.astype(np.int32),
+              'upstream_index': index.astype(np.int32), 'parents': parents.astype(np.int32),
+              'alias_index': conversion, 'sorted_reaches': sorted_reaches, 'reach_order': reach_order.astype(np.int32),
+              'exit_from': exit_from, 'exit_to': exit_to}
+    if compress:
+        out_path = navigator_archive_path if out_path is None else out_path
+        create_dir(out_path)
+        np.savez_compressed(out_path.format(region), **arrays)
+    else:
+        out_path = navigator_path if out_path is None else out_path
+        array_directory(out_path.format(region), arrays, {'region': region, 'cache_key': cache_key})
@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+
+# Modules in nhd import each other by name, as they do when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nhd'))
+
+
+def trace_arrays(nhd_table):
+    """
+    Build navigator arrays from a condensed reach table in memory, as build_nhd does for a region
+    :param nhd_table: Condensed NHD reach table (df)
+    :return: Arrays indexed by name, as in a navigator file (dict)
+    """
+    from navigator import rapid_trace, map_paths, upstream_index, downstream_index, reach_index
+    from process_nhd import prepare_network
+    nodes, times, dists, outlets, conversion = prepare_network(nhd_table)
+    paths, times, dists, path_offsets, path_starts = rapid_trace(nodes, outlets, times, dists, conversion)
+    path_map = map_paths(paths, path_offsets, path_starts)
+    sorted_reaches, reach_order = reach_index(conversion)
+    return {'paths': paths, 'time': times, 'length': dists, 'path_offsets': path_offsets, 'path_map': path_map,
+            'upstream_index': upstream_index(paths, path_offsets, path_map),
+            'parents': downstream_index(paths, path_offsets, path_map), 'alias_index': conversion,
+            'sorted_reaches': sorted_reaches, 'reach_order': reach_order}
+
+
+@pytest.fixture(scope='session')
+def synthetic_table():
+    from synthetic_nhd import synthetic_nhd
+    return synthetic_nhd(5000, n_outlets=5, seed=1)
+
+
+@pytest.fixture(scope='session')
+def synthetic_navigator(synthetic_table):
+    from navigator import Navigator
+    return Navigator('test', arrays=trace_arrays(synthetic_table))
+
+
+@pytest.fixture(scope='session')
+def build_navigator():
+    from navigator import Navigator
+    return lambda nhd_table: Navigator('test', arrays=trace_arrays(nhd_table))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    Redirect the output paths in paths_nhd to a temporary directory, including the copies imported by other modules
+    :return: Temporary data directory (path)
+    """
+    import paths_nhd
+    nhd_dir = os.path.dirname(os.path.abspath(paths_nhd.__file__))
+    modules = [module for module in list(sys.modules.values())
+               if os.path.dirname(os.path.abspath(getattr(module, '__file__', None) or '')) == nhd_dir]
+    local_dir = paths_nhd.local_dir
+    for name, value in vars(paths_nhd).copy().items():
+        if isinstance(value, str) and value.startswith(local_dir):
+            redirected = str(tmp_path) + value[len(local_dir):]
+            for module in modules:
+                if getattr(module, name, None) == value:
+                    monkeypatch.setattr(module, name, redirected)
+    return tmp_path
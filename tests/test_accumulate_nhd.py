@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from accumulate_nhd import accumulate, accumulate_upstream, topological_levels
+
+
+def reach_table(rows):
+    """
+    Build a condensed reach table from (comid, tocomid, divergence, area) rows. Reach 1 is the outlet
+    """
+    table = pd.DataFrame(rows, columns=['comid', 'tocomid', 'divergence', 'area'])
+    table['stream_calc'] = np.where(table.divergence == 2, 0, 1)
+    table['fcode'] = 46006
+    table['hydroseq'] = table.comid.astype(float)
+    table['terminal_path'] = 1.
+    table['travel_time'] = 1.
+    table['lengthkm'] = 1.
+    return table
+
+
+def test_topological_levels_put_headwaters_first():
+    # 2 and 3 drain to 1, 4 drains to 2
+    nodes = np.array([[-1, 0], [0, 1], [0, 2], [1, 3]])
+    order, level_bounds = topological_levels(nodes, 4)
+    assert level_bounds.tolist() == [0, 2, 3, 4]
+    assert set(order[:2]) == {2, 3} and order.tolist()[2:] == [1, 0]
+
+
+def test_accumulate_sum_max_and_mean():
+    nodes = np.array([[-1, 0], [0, 1], [0, 2], [1, 3]])
+    values = np.array([1., 2., 3., 4.])
+    assert accumulate(nodes, values).tolist() == [10., 6., 3., 4.]
+    assert accumulate(nodes, values, 'max').tolist() == [4., 4., 3., 4.]
+    mean = accumulate(nodes, values, 'mean', weights=np.array([1., 1., 1., 2.]))
+    assert np.allclose(mean, [(1 + 2 + 3 + 8) / 5., (2 + 8) / 3., 3., 4.])
+
+
+def test_accumulate_upstream_with_repeated_reaches():
+    # Reach 3 splits into 2 (main path) and 4 (minor path), which rejoins at 1. Reach 5 has an exact duplicate row,
+    # which is kept, so values have to be taken by alias rather than by row
+    table = reach_table([(1, 0, 0, 1.), (2, 1, 1, 2.), (3, 2, 0, 3.), (3, 4, 0, 3.), (4, 1, 2, 4.), (5, 3, 0, 5.),
+                         (5, 3, 0, 5.)])
+    accumulated = accumulate_upstream(table, ['area'])
+    assert accumulated.index.is_unique
+    assert accumulated.area.to_dict() == {1: 15., 2: 10., 3: 8., 4: 4., 5: 5.}
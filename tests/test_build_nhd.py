@@ -0,0 +1,116 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import build_nhd
+import process_nhd
+import read_nhd
+import write_nhd
+from conftest import trace_arrays
+from navigator import Navigator
+from params_nhd import erom_months
+from synthetic_nhd import synthetic_nhd
+
+navigator_fields = ('paths', 'time', 'length', 'path_offsets', 'path_map', 'upstream_index', 'parents', 'alias_index',
+                    'sorted_reaches', 'reach_order')
+
+# Reaches 11 and 12 are in waterbody 900, which drains out through 12. Waterbody 901 has no lentic reaches
+network = pd.DataFrame({'comid': [11, 12, 13, 14, 15], 'tocomid': [12, 13, 0, 13, 0], 'divergence': 0,
+                        'stream_calc': 1, 'fcode': 46006, 'hydroseq': [5., 4., 1., 3., 2.],
+                        'terminal_path': [1., 1., 1., 1., 2.], 'travel_time': 0.5, 'lengthkm': 1.})
+
+
+class LenticFields(object):
+    """ The lentic fields from fields_and_qc.csv, which identify_waterbody_outlets carries over for each outlet """
+
+    def refresh(self):
+        pass
+
+    def expand(self, *args):
+        pass
+
+    def fetch(self, field_set):
+        return ['comid', 'wb_comid', 'hydroseq', 'q_ma']
+
+
+@pytest.fixture
+def hydro_sources(data_dir, monkeypatch):
+    # Reach 15 has no EROM record, and only January, February and mean annual flows are available
+    reach_table = pd.DataFrame({'comid': [14, 12, 11, 13], 'hydroseq': [3., 4., 5., 1.], 'wb_comid': [0, 900, 900, 0],
+                                'q_01': [1., 2., 3., 4.], 'q_02': [5., 6., 7., 8.], 'q_ma': [10., 20., 30., 40.],
+                                'v_ma': [0.1, 0.2, 0.3, 0.4]})
+    m3_per_cfs_day = 0.0283168 * 86400.
+    lake_table = pd.DataFrame({'wb_comid': [900, 901], 'volume': [60. * m3_per_cfs_day, 1000.], 'area': [5., 6.]})
+    write_nhd.navigator_file('test', *(trace_arrays(network)[name] for name in navigator_fields), cache_key='nav')
+    monkeypatch.setattr(build_nhd, 'condense_key', lambda *args: 'hydro')
+    monkeypatch.setattr(build_nhd, 'condense_nhd', lambda *args: (reach_table, lake_table))
+    monkeypatch.setattr(read_nhd, 'field_dtypes', lambda *args, **kwargs: {})
+    monkeypatch.setattr(process_nhd, 'fields', LenticFields())
+
+
+def test_hydro_files_in_alias_order(hydro_sources, monkeypatch):
+    build_nhd.build_hydro_files('test')
+    conversion = Navigator('test').alias_to_reach
+    aliases = np.argsort(conversion)
+    assert conversion[aliases].tolist() == [11, 12, 13, 14, 15]
+
+    flows = read_nhd.flow_file('test')
+    assert read_nhd.columnar_header(build_nhd.flow_file_path.format('test'))['months'] == erom_months
+    q = flows['q'][aliases]
+    np.testing.assert_array_equal(q[:4, [0, 1, 12]], [[3., 7., 30.], [2., 6., 20.], [4., 8., 40.], [1., 5., 10.]])
+    assert np.isnan(q[:, 2:12]).all() and np.isnan(q[4]).all()
+    np.testing.assert_allclose(flows['v'][aliases, 12], [0.3, 0.2, 0.4, 0.1, np.nan])
+    assert np.isnan(flows['v'][:, :12]).all()
+
+    # Only the outlet of waterbody 900, the lentic reach with the lowest hydroseq, has lake values. Its residence
+    # time is its volume over its mean annual flow of 20 cfs, in days
+    lakes = read_nhd.lake_file('test')
+    assert lakes['wb_comid'][aliases].tolist() == [0, 900, 0, 0, 0]
+    np.testing.assert_allclose(lakes['flow'][aliases], [np.nan, 20., np.nan, np.nan, np.nan])
+    np.testing.assert_allclose(lakes['area'][aliases], [np.nan, 5., np.nan, np.nan, np.nan])
+    np.testing.assert_allclose(lakes['residence_time'][aliases], [np.nan, 3., np.nan, np.nan, np.nan], rtol=1e-6)
+
+    # The files are current until the navigator changes
+    array_directory = write_nhd.array_directory
+    monkeypatch.setattr(write_nhd, 'array_directory', None)
+    build_nhd.build_hydro_files('test')
+    monkeypatch.setattr(write_nhd, 'array_directory', array_directory)
+    write_nhd.navigator_file('test', *(trace_arrays(network)[name] for name in navigator_fields), cache_key='new')
+    build_nhd.build_hydro_files('test')
+    assert read_nhd.columnar_header(build_nhd.lake_file_path.format('test'))['navigator_key'] == 'new'
+
+
+def test_interrupted_build_resumes(data_dir, monkeypatch):
+    nhd_table = synthetic_nhd(2000, n_outlets=3, seed=4)
+    condensed = []
+    monkeypatch.setattr(build_nhd, 'condense_key', lambda *args: 'key')
+    monkeypatch.setattr(build_nhd, 'condense_nhd', lambda *args, **kwargs: condensed.append(1) or (nhd_table, None))
+    monkeypatch.setattr(read_nhd, 'field_dtypes', lambda *args, **kwargs: {})
+
+    # Fail while writing the navigator, after every other stage has been saved
+    navigator_file = write_nhd.navigator_file
+
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(write_nhd, 'navigator_file', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        build_nhd.build_navigator('test')
+    assert read_nhd.columnar_header(build_nhd.navigator_path.format('test')) is None
+
+    monkeypatch.setattr(write_nhd, 'navigator_file', navigator_file)
+    build_nhd.build_navigator('test')
+    with open(build_nhd.build_report_path.format('test')) as f:
+        stages = json.load(f)['stages']
+    assert [stage['stage'] for stage in stages if stage.get('skipped')] == \
+           ['condense_nhd', 'prepare_network', 'validate_nhd', 'rapid_trace', 'map_paths', 'index_paths']
+    assert [stage['stage'] for stage in stages if not stage.get('skipped')] == ['navigator_file']
+    assert len(condensed) == 1
+    assert not any(os.path.exists(build_nhd.navigator_stage_path.format('test', stage))
+                   for stage in ('unpack', 'trace', 'map'))
+
+    resumed = Navigator('test').arrays()
+    for name, values in trace_arrays(nhd_table).items():
+        np.testing.assert_array_equal(resumed[name], values)
@@ -0,0 +1,265 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def walk_down(nav, alias):
+    path = []
+    while alias >= 0:
+        path.append(alias)
+        alias = nav.parents[alias]
+    return path
+
+
+def test_downstream_watersheds_follow_parents(synthetic_navigator):
+    nav = synthetic_navigator
+    queries = np.random.default_rng(0).choice(nav.alias_to_reach, 300)
+    queries = np.append(queries, -1)
+    reaches, offsets, times, lengths = nav.downstream_watersheds(queries, return_times=True, return_lengths=True)
+    assert offsets[-1] - offsets[-2] == 0
+    for i, alias in enumerate(nav.aliases(queries[:-1])):
+        path = walk_down(nav, alias)
+        assert reaches[offsets[i]:offsets[i + 1]].tolist() == nav.alias_to_reach[path].tolist()
+        positions = nav.index[path, 0]
+        assert np.allclose(times[offsets[i]:offsets[i + 1]], nav.times[positions[0]] - nav.times[positions])
+        assert np.allclose(lengths[offsets[i]:offsets[i + 1]], nav.lengths[positions[0]] - nav.lengths[positions])
+
+
+def test_downstream_watershed_matches_batch(synthetic_navigator):
+    nav = synthetic_navigator
+    reach = nav.alias_to_reach[nav.paths[-1]]
+    path, times = nav.downstream_watershed(reach, return_times=True)
+    reaches, offsets, batch_times = nav.downstream_watersheds([reach], return_times=True)
+    assert path.tolist() == reaches.tolist() and np.array_equal(times, batch_times)
+    assert path[0] == reach and nav.parents[nav.aliases([path[-1]])[0]] == -1
+    missing, warning = nav.downstream_watershed(-5, return_warning=True)
+    assert missing.size == 0 and warning is not None
+
+
+def test_pair_sites_with_no_sites_on_one_side(synthetic_navigator, tmp_path):
+    nav = synthetic_navigator
+    stations = pd.DataFrame({'site_id': ['s1', 's2'], 'comid': nav.alias_to_reach[nav.paths[:2]]})
+    intakes = pd.DataFrame({'site_id': np.zeros(0, dtype=object), 'comid': np.zeros(0, dtype=np.int64)})
+    columns = ['station_id', 'intake_id', 'direction', 'days', 'distance']
+    for args in ((stations, intakes), (intakes, stations), (intakes, intakes)):
+        pairs = nav.pair_sites(*args)
+        assert pairs.empty and pairs.columns.tolist() == columns
+    out_file = tmp_path / 'pairs.csv'
+    nav.pair_sites(stations, intakes, out_file=str(out_file))
+    assert pd.read_csv(out_file).columns.tolist() == columns
+
+
+def test_pair_sites_matches_travel_times(synthetic_navigator):
+    nav = synthetic_navigator
+    comids = np.random.default_rng(2).choice(nav.alias_to_reach, 60)
+    stations = pd.DataFrame({'site_id': np.arange(30), 'comid': comids[:30]})
+    intakes = pd.DataFrame({'site_id': np.arange(30), 'comid': comids[30:]})
+    pairs = nav.pair_sites(stations, intakes)
+    times, _ = nav.travel_times(np.repeat(intakes.comid.values, 30), np.tile(stations.comid.values, 30))
+    expected = {(s, i) for i, s, t in zip(np.repeat(np.arange(30), 30), np.tile(np.arange(30), 30), times)
+                if not np.isnan(t)}
+    assert set(zip(pairs.station_id, pairs.intake_id)) == expected
+
+
+def test_extents_bound_upstream_blocks(synthetic_navigator):
+    nav = synthetic_navigator
+    depths = nav.map[nav.paths, 2]
+    for alias in np.random.default_rng(3).choice(nav.paths, 200):
+        start, end = nav.index[alias]
+        for extent, values in zip(nav.extents, (nav.times, nav.lengths, depths)):
+            assert extent[start] == values[start:end].max()
+
+
+def test_upstream_watersheds_are_relative(synthetic_navigator):
+    nav = synthetic_navigator
+    queries = np.random.default_rng(4).choice(nav.alias_to_reach, 100)
+    reaches, offsets, times, lengths = nav.upstream_watersheds(queries, return_times=True, return_lengths=True)
+    for i, query in enumerate(queries):
+        single = nav.upstream_watershed(query, return_times=True, return_lengths=True)
+        batch = (reaches, times, lengths)
+        for single_values, batch_values in zip(single, batch):
+            assert single_values.dtype == batch_values.dtype
+            np.testing.assert_array_equal(single_values, batch_values[offsets[i]:offsets[i + 1]])
+        assert single[0][0] == query and single[1][0] == 0 and single[2][0] == 0
+        assert (single[1] >= 0).all() and (single[2] >= 0).all()
+
+
+def test_bounded_watersheds_match_filtered(synthetic_navigator):
+    nav = synthetic_navigator
+    queries = np.append(np.random.default_rng(5).choice(nav.alias_to_reach, 200), -1)
+    reaches, offsets, times, lengths = nav.upstream_watersheds(queries, return_times=True, return_lengths=True)
+    depths = nav.map[nav.aliases(reaches), 2] - np.repeat(nav.map[nav.aliases(queries), 2], np.diff(offsets))
+    for limits in ({'max_days': 0.5}, {'max_length': 20000.}, {'max_depth': 10},
+                   {'max_days': 2., 'max_depth': 50}, {'max_days': 1e6}):
+        within = np.ones(reaches.size, dtype=bool)
+        for values, name in ((times, 'max_days'), (lengths, 'max_length'), (depths, 'max_depth')):
+            if name in limits:
+                within &= values <= limits[name]
+        bounded, bounded_offsets, bounded_times = nav.upstream_watersheds(queries, return_times=True, **limits)
+        np.testing.assert_array_equal(bounded, reaches[within])
+        np.testing.assert_array_equal(bounded_times, times[within])
+        np.testing.assert_array_equal(np.diff(bounded_offsets), np.bincount(
+            np.repeat(np.arange(queries.size), np.diff(offsets))[within], minlength=queries.size))
+        for i in range(0, queries.size, 20):
+            for direct_size in (0, 2 ** 18):
+                single = nav.upstream_watershed(queries[i], direct_size=direct_size, **limits)
+                np.testing.assert_array_equal(single, bounded[bounded_offsets[i]:bounded_offsets[i + 1]])
+        union = nav.upstream_watersheds(queries, output='union', **limits)
+        np.testing.assert_array_equal(np.sort(union), np.unique(reaches[within]))
+
+
+def test_registry_passes_limits(synthetic_navigator):
+    from shared_nhd import NavigatorRegistry
+    nav = synthetic_navigator
+    registry = NavigatorRegistry()
+    registry.navigators['test'] = nav
+    reach = nav.alias_to_reach[nav.paths[0]]
+    full = registry.upstream_watershed('test', reach)
+    bounded = registry.upstream_watershed('test', reach, max_depth=3)
+    np.testing.assert_array_equal(bounded, nav.upstream_watershed(reach, max_depth=3))
+    assert bounded.size < full.size
+
+
+@pytest.mark.parametrize('direct_size', [0, 16])
+def test_scanned_blocks_match_direct(synthetic_navigator, direct_size):
+    nav = synthetic_navigator
+    aliases = np.random.default_rng(6).choice(nav.paths, 200)
+    starts, ends = nav.index[aliases].T
+    for limits in ((0.5, None, None), (None, 20000., None), (None, None, 10), (2., None, 50), (1e6, None, None)):
+        direct = nav.bounded_blocks(starts, ends, *limits)
+        scanned = nav.bounded_blocks(starts, ends, *limits, window=4, direct_size=direct_size, batch_size=256)
+        for expected, result in zip(direct, scanned):
+            np.testing.assert_array_equal(expected, result)
+
+
+def test_trace_follows_links(synthetic_table):
+    from navigator import rapid_trace, map_paths, downstream_index, adjacency_index
+    from process_nhd import prepare_network
+    nodes, times, dists, outlets, conversion = prepare_network(synthetic_table)
+    offsets, neighbours = adjacency_index(nodes, conversion.size)
+    for node in np.random.default_rng(7).choice(conversion.size, 100):
+        expected = nodes[(nodes[:, 0] == node), 1]
+        assert neighbours[offsets[node]:offsets[node + 1]].tolist() == expected.tolist()
+
+    paths, path_times, path_lengths, path_offsets, path_starts = \
+        rapid_trace(nodes, outlets, times, dists, conversion)
+    assert np.array_equal(np.sort(paths), np.arange(conversion.size))
+    parents = downstream_index(paths, path_offsets, map_paths(paths, path_offsets, path_starts))
+    assert np.array_equal(np.sort(paths[parents[paths] < 0]), np.sort(outlets))
+    links = set(map(tuple, nodes.tolist()))
+    assert all((parents[node], node) in links for node in paths[parents[paths] >= 0])
+
+    # Cumulative times and lengths grow by each reach's own time and length
+    positions = np.zeros(conversion.size, dtype=np.int64)
+    positions[paths] = np.arange(paths.size)
+    upstream = paths[parents[paths] >= 0]
+    for cumulative, values in ((path_times, times), (path_lengths, dists)):
+        steps = cumulative[positions[upstream]] - cumulative[positions[parents[upstream]]]
+        np.testing.assert_allclose(steps, values[upstream], rtol=1e-4, atol=1e-5)
+
+
+def test_trace_spills_paths(synthetic_table, tmp_path):
+    from navigator import rapid_trace, PathWriter
+    from process_nhd import prepare_network
+    nodes, times, dists, outlets, conversion = prepare_network(synthetic_table)
+    in_memory = rapid_trace(nodes, outlets, times, dists, conversion)
+    writer = PathWriter(chunk_size=100, memory_budget=1000, spill_dir=str(tmp_path))
+    spilled = rapid_trace(nodes, outlets, times, dists, conversion, writer)
+    assert writer.spilled and isinstance(spilled[0], np.memmap)
+    for expected, result in zip(in_memory, spilled):
+        np.testing.assert_array_equal(expected, result)
+    del spilled
+    writer.cleanup()
+    assert not list(tmp_path.iterdir())
+
+
+def test_upstream_blocks_match_parents(synthetic_navigator):
+    nav = synthetic_navigator
+    downstream = {}
+    for alias in nav.paths:
+        downstream[alias] = walk_down(nav, alias)
+    for alias in np.random.default_rng(8).choice(nav.paths, 200):
+        start, end = nav.index[alias]
+        expected = sorted(upstream for upstream, path in downstream.items() if alias in path)
+        assert nav.paths[start] == alias and sorted(nav.paths[start:end]) == expected
+        assert nav.map[alias, 2] == len(downstream[alias]) - 1
+        assert (nav.map[nav.paths[start:end], 2] > nav.map[alias, 2]).sum() == end - start - 1
+
+
+def test_reach_index_matches_dict(synthetic_navigator):
+    nav = synthetic_navigator
+    lookup = {reach: alias for alias, reach in enumerate(nav.alias_to_reach)}
+    queries = np.concatenate((np.random.default_rng(9).choice(nav.alias_to_reach, 500),
+                              [nav.alias_to_reach.min() - 1, nav.alias_to_reach.max() + 1, 0, -1]))
+    np.testing.assert_array_equal(nav.aliases(queries), [lookup.get(reach, -1) for reach in queries])
+    assert nav.contains(queries).tolist() == [reach in lookup for reach in queries]
+    aliases = np.arange(-2, nav.alias_to_reach.size + 2)
+    np.testing.assert_array_equal(nav.aliases(aliases, 'alias'),
+                                  np.where((aliases >= 0) & (aliases < nav.alias_to_reach.size), aliases, -1))
+
+
+def test_national_navigator_matches_single_region(synthetic_table, synthetic_navigator, tmp_path):
+    from conftest import trace_arrays
+    from navigator import NationalNavigator
+    from process_nhd import prepare_network
+    import write_nhd
+    nav = synthetic_navigator
+
+    # Split the network at a reach with a few hundred reaches upstream, which becomes an exit of the upstream region
+    sizes = nav.index[:, 1] - nav.index[:, 0]
+    split = np.flatnonzero((sizes > 200) & (sizes < 1000) & (nav.parents >= 0))[0]
+    upstream = nav.alias_to_reach[nav.upstream_watershed(split, 'alias')]
+    regions = {'up': synthetic_table[synthetic_table.comid.isin(upstream)],
+               'down': synthetic_table[~synthetic_table.comid.isin(upstream)]}
+    out_path = str(tmp_path / 'nav{}')
+    for region, table in regions.items():
+        arrays = trace_arrays(table)
+        exits = prepare_network(table, True)[5]
+        write_nhd.navigator_file(region, *arrays.values(), out_path=out_path, exits=exits)
+    national = NationalNavigator(['up', 'down'], out_path)
+    assert national.exits['up'].exit_from.tolist() == [nav.alias_to_reach[split]]
+
+    for alias in (nav.parents[split], nav.outlets([split], 'alias')[0], split):
+        reach = nav.alias_to_reach[alias]
+        expected = nav.upstream_watershed(reach, return_times=True, return_lengths=True)
+        result = national.upstream_watershed(reach, return_times=True, return_lengths=True)
+        expected_order, result_order = np.argsort(expected[0]), np.argsort(result[0])
+        np.testing.assert_array_equal(result[0][result_order], expected[0][expected_order])
+        for result_values, expected_values in zip(result[1:], expected[1:]):
+            np.testing.assert_allclose(result_values[result_order], expected_values[expected_order], rtol=1e-4,
+                                       atol=1e-4)
+
+    headwater = nav.alias_to_reach[nav.paths[nav.index[split, 1] - 1]]
+    expected = nav.downstream_watershed(headwater, return_times=True, return_lengths=True)
+    result = national.downstream_watershed(headwater, return_times=True, return_lengths=True)
+    np.testing.assert_array_equal(result[0], expected[0])
+    for result_values, expected_values in zip(result[1:], expected[1:]):
+        np.testing.assert_allclose(result_values, expected_values, rtol=1e-4, atol=1e-4)
+
+
+def test_partition_watersheds_match_brute_force(synthetic_navigator):
+    nav = synthetic_navigator
+    rng = np.random.default_rng(10)
+    aliases = rng.choice(nav.paths, 40)
+    aliases = np.concatenate((aliases, nav.parents[aliases[:20]], aliases[:3]))
+    aliases = aliases[aliases >= 0]
+    queries = np.append(nav.alias_to_reach[aliases], -1)
+    reaches, offsets, nesting, times = nav.partition_watersheds(queries, return_times=True)
+
+    watersheds = [set(nav.upstream_watershed(query).tolist()) for query in queries]
+    first = {}
+    for i, query in enumerate(queries[:-1]):
+        first.setdefault(query, i)
+    for i, query in enumerate(queries):
+        partition = reaches[offsets[i]:offsets[i + 1]]
+        if query == -1 or first[query] != i:
+            assert partition.size == 0 and nesting[i] == (-1 if query == -1 else first[query])
+            continue
+        inner = [j for j in first.values() if queries[j] != query and queries[j] in watersheds[i]]
+        expected = watersheds[i].difference(*(watersheds[j] for j in inner))
+        assert sorted(partition.tolist()) == sorted(expected)
+        outer = [j for j in first.values() if queries[j] != query and query in watersheds[j]]
+        assert nesting[i] == (min(outer, key=lambda j: len(watersheds[j])) if outer else -1)
+        full, full_times = nav.upstream_watershed(query, return_times=True)
+        lookup = dict(zip(full.tolist(), full_times.tolist()))
+        np.testing.assert_allclose(times[offsets[i]:offsets[i + 1]], [lookup[reach] for reach in partition])
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from navigator import process_nhd, unpack_nhd
+from process_nhd import prepare_network
+from validate_nhd import check_network
+from synthetic_nhd import synthetic_nhd
+
+
+def edited_table(seed):
+    """ A synthetic table with region exits, coastal reaches and a blank reach, which has no ties at divergences """
+    table = synthetic_nhd(3000, n_outlets=3, divergence_fraction=0.05, seed=seed)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(table), 30, replace=False)
+    table.loc[table.index[rows[:10]], 'tocomid'] = 9000000 + np.arange(10)
+    table.loc[table.index[rows[10:20]], 'fcode'] = 56600
+    table.loc[table.index[rows[20]], 'comid'] = 0
+    return table
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_prepare_network_matches_process_nhd(seed):
+    table = edited_table(seed)
+    nodes, times, dists, outlets, conversion, exits = prepare_network(table, True)
+    processed = process_nhd(table.copy())
+    legacy_nodes, legacy_times, legacy_dists, legacy_outlets, legacy_conversion = unpack_nhd(processed)
+
+    np.testing.assert_array_equal(conversion, legacy_conversion)
+    np.testing.assert_array_equal(nodes, legacy_nodes)
+    np.testing.assert_allclose(times, legacy_times)
+    np.testing.assert_allclose(dists, legacy_dists)
+    np.testing.assert_array_equal(np.sort(outlets), np.sort(legacy_outlets))
+    legacy_exits = processed[processed.exit_comid > 0]
+    assert sorted(zip(*exits)) == sorted(zip(legacy_exits.comid, legacy_exits.exit_comid))
+    assert len(exits[0]) > 0
+
+
+def test_minor_divergence_exits_are_outlets():
+    # Two minor divergence paths in this table drain out of the region, and nothing in the region drains to them
+    table = edited_table(0)
+    minor = table[(table.divergence == 2) & ~table.tocomid.isin(table.comid)].comid.values
+    assert minor.size == 2
+    nodes, times, dists, outlets, conversion, (exit_from, exit_to) = prepare_network(table, True)
+    assert np.isin(minor, conversion[outlets]).all() and np.isin(minor, exit_from).all()
+    _, _, validation = check_network(nodes, outlets, conversion)
+    assert validation['valid']
@@ -0,0 +1,34 @@
+import json
+import time
+import numpy as np
+import pytest
+
+from profile_nhd import BuildProfile, MemorySampler, current_memory
+
+
+@pytest.mark.skipif(current_memory() is None, reason="Memory can't be measured on this platform")
+def test_stage_memory_is_measured_within_the_stage(tmp_path):
+    profile = BuildProfile("Test")
+    with profile.stage('allocate', 1):
+        values = np.ones(2 ** 25)  # 256 MB
+        time.sleep(0.3)
+        del values
+    with profile.stage('idle'):
+        time.sleep(0.2)
+    allocate, idle = profile.stages
+    assert allocate['peak_increase_mb'] > 200
+    assert idle['peak_memory_mb'] < allocate['peak_memory_mb'] - 200
+    assert idle['peak_increase_mb'] < 50
+    assert idle['process_peak_memory_mb'] >= allocate['peak_memory_mb'] - 1
+
+    out_path = tmp_path / 'profile.json'
+    profile.write(str(out_path), region='test')
+    with open(out_path) as f:
+        written = json.load(f)
+    assert [stage['stage'] for stage in written['stages']] == ['allocate', 'idle'] and written['region'] == 'test'
+
+
+def test_memory_sampler_stops():
+    with MemorySampler(interval=0.01) as memory:
+        time.sleep(0.05)
+    assert memory._thread is None or not memory._thread.is_alive()
@@ -0,0 +1,77 @@
+import struct
+import numpy as np
+import pandas as pd
+import pytest
+
+from read_nhd import dbf_columns, dbf_record_count, field_dtypes
+
+
+def write_dbf(dbf_path, fields, records, deleted=()):
+    """
+    Write a minimal dBASE table
+    :param fields: Name, type, width and decimal count of each field (list)
+    :param records: Field values of each record, as text (list)
+    :param deleted: Indices of records marked as deleted (list)
+    """
+    descriptors = b''.join(name.upper().encode().ljust(11, b'\x00') + field_type.encode() + b'\x00' * 4 +
+                           bytes([width, decimals]) + b'\x00' * 14 for name, field_type, width, decimals in fields)
+    record_length = 1 + sum(width for _, _, width, _ in fields)
+    header = struct.pack('<4BIHH20x', 3, 120, 1, 1, len(records), 32 + len(descriptors) + 1, record_length)
+    rows = b''
+    for i, record in enumerate(records):
+        rows += b'*' if i in deleted else b' '
+        for (_, field_type, width, _), value in zip(fields, record):
+            value = value.encode('latin-1')
+            rows += value.ljust(width) if field_type in 'CL' else value.rjust(width)
+    with open(dbf_path, 'wb') as f:
+        f.write(header + descriptors + b'\x0D' + rows + b'\x1A')
+
+
+fields = [('COMID', 'N', 9, 0), ('QA_MA', 'N', 12, 3), ('StreamOrde', 'N', 4, 0), ('GNIS_NAME', 'C', 20, 0),
+          ('InNetwork', 'L', 1, 0)]
+records = [('101', '1.500', '1', 'Big Creek', 'T'),
+           ('102', '', '2', '', 'F'),
+           ('103', '3.250', '', 'Rivière Noire', 'y'),
+           ('104', '4.000', '3', 'Deleted', 'T')]
+
+
+@pytest.fixture
+def dbf_path(tmp_path):
+    path = str(tmp_path / 'table.dbf')
+    write_dbf(path, fields, records, deleted=[3])
+    return path
+
+
+def test_default_types(dbf_path):
+    assert dbf_record_count(dbf_path) == 4
+    columns = dbf_columns(dbf_path)
+    assert list(columns) == ['comid', 'qa_ma', 'streamorde', 'gnis_name', 'innetwork']
+
+    # Deleted records are left out, and whole-number fields with blanks are read as floats with NaN
+    assert columns['comid'].dtype == np.int64 and columns['comid'].tolist() == [101, 102, 103]
+    assert columns['qa_ma'].dtype == np.float64
+    np.testing.assert_array_equal(columns['qa_ma'], [1.5, np.nan, 3.25])
+    assert columns['streamorde'].dtype == np.float64
+    np.testing.assert_array_equal(columns['streamorde'], [1., 2., np.nan])
+    assert columns['gnis_name'].tolist() == ['Big Creek', '', 'Rivière Noire']
+    assert columns['innetwork'].dtype == bool and columns['innetwork'].tolist() == [True, False, True]
+
+
+def test_selected_fields_and_dtypes(dbf_path, tmp_path):
+    fields_path = str(tmp_path / 'fields_and_qc.csv')
+    pd.DataFrame({'external_name': ['COMID', 'QA_MA', 'StreamOrde', 'GNIS_NAME'],
+                  'internal_name': ['comid', 'q', 'stream_order', 'gnis_name'],
+                  'data_type': ['np.int32', 'np.float32', 'np.int16', 'object'],
+                  'monthly': [0, 1, 0, 0]}).to_csv(fields_path, index=False)
+    dtypes = field_dtypes(fields_path)
+    assert dtypes == {'comid': np.int32, 'qa_ma': np.float32, 'streamorde': np.int16}
+    internal = field_dtypes(fields_path, name_field='internal_name')
+    assert internal['q_01'] == internal['q_ma'] == np.float32 and 'gnis_name' not in internal
+
+    # Field names are case-insensitive. Blanks in integer fields are 0, since integers have no NaN
+    columns = dbf_columns(dbf_path, ['StreamOrde', 'QA_MA', 'comid'], dtypes)
+    assert list(columns) == ['streamorde', 'qa_ma', 'comid']
+    assert columns['comid'].dtype == np.int32 and columns['streamorde'].dtype == np.int16
+    assert columns['streamorde'].tolist() == [1, 2, 0]
+    assert columns['qa_ma'].dtype == np.float32
+    np.testing.assert_array_equal(columns['qa_ma'], np.array([1.5, np.nan, 3.25], dtype=np.float32))
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from routing_nhd import routing_network, travel_lags, route
+from synthetic_nhd import synthetic_nhd
+
+
+def test_divergence_fractions():
+    # Reach 1 splits between 2 and 3, and 2 has a DivFrac. Reach 6 splits evenly, with no DivFrac on either branch
+    table = pd.DataFrame({'comid': [1, 1, 2, 3, 4, 5, 6, 6],
+                          'tocomid': [2, 3, 4, 4, 0, 4, 1, 5],
+                          'div_frac': [np.nan, np.nan, 0.7, np.nan, 1., np.nan, np.nan, np.nan],
+                          'travel_time': [0.6, 0.6, 0.6, 0.9, 0.5, 0.2, 0.1, 0.1]})
+    nodes, weights, conversion = routing_network(table)
+    links = {(conversion[up], conversion[down]): weight for (down, up), weight in zip(nodes, weights)}
+    expected = {(1, 2): 0.7, (1, 3): 0.3, (2, 4): 1., (3, 4): 1., (5, 4): 1., (6, 1): 0.5, (6, 5): 0.5}
+    assert links.keys() == expected.keys()
+    for link, weight in expected.items():
+        assert np.isclose(links[link], weight)
+
+    # Fractions that sum past 1 are scaled down
+    table.loc[table.comid == 3, 'div_frac'] = 0.5
+    nodes, weights, conversion = routing_network(table)
+    totals = np.bincount(nodes[:, 1], weights, minlength=conversion.size)
+    assert np.allclose(totals[np.isin(np.arange(conversion.size), nodes[:, 1])], 1.)
+
+
+def brute_force_route(nodes, weights, values, lags):
+    """ Route one day at a time with dense matrices, solving for the same-day connections """
+    n_nodes, n_days = values.shape
+    matrices = {}
+    for (down, up), weight, lag in zip(nodes, weights, lags):
+        matrices.setdefault(lag, np.zeros((n_nodes, n_nodes)))[down, up] += weight
+    same_day = np.eye(n_nodes) - matrices.pop(0, np.zeros((n_nodes, n_nodes)))
+    routed = np.zeros((n_nodes, n_days))
+    for day in range(n_days):
+        inflow = values[:, day].astype(np.float64)
+        for lag, matrix in matrices.items():
+            if day >= lag:
+                inflow = inflow + matrix @ routed[:, day - lag]
+        routed[:, day] = np.linalg.solve(same_day, inflow)
+    return routed
+
+
+def test_route_matches_brute_force():
+    table = synthetic_nhd(200, divergence_fraction=0.1, seed=3)
+    table['travel_time'] *= 20
+    nodes, weights, lags, conversion = routing_network(table, lag=True)
+    assert lags.max() > 1 and (lags >= 0).all()
+    values = np.random.default_rng(0).random((conversion.size, 40)).astype(np.float32)
+    expected = brute_force_route(nodes, weights, values, lags)
+    for block_size in (7, 40):
+        np.testing.assert_allclose(route(nodes, weights, values, lags, block_size), expected, rtol=1e-4)
+
+    # Without lags, everything arrives on the same day and the total is conserved at the outlets
+    routed = route(nodes, weights, values)
+    outlets = np.setdiff1d(np.arange(conversion.size), nodes[:, 1])
+    np.testing.assert_allclose(routed[outlets].sum(0), values.sum(0), rtol=1e-4)
+
+
+def test_lags_accumulate_along_short_reaches():
+    # Ten reaches of 0.3 days each: rounding each reach would give no lag, but the chain takes 3 days
+    nodes = np.column_stack((np.arange(-1, 9), np.arange(10))).astype(np.int32)[1:]
+    lags = travel_lags(nodes, np.ones(9, dtype=np.float32), np.full(10, 0.3))
+    assert lags.sum() == 3 and set(lags.tolist()) == {0, 1}
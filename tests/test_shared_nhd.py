@@ -0,0 +1,93 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+import write_nhd
+from shared_nhd import NavigatorRegistry, ResultCache, attach_block
+
+navigator_fields = ('paths', 'time', 'length', 'path_offsets', 'path_map', 'upstream_index', 'parents', 'alias_index',
+                    'sorted_reaches', 'reach_order')
+
+# Attach to a shared region from an independent interpreter and query it. Stopping the resource tracker runs its
+# exit cleanup before the process exits, so any block still registered with it is unlinked by then
+attach_script = """
+import sys
+from multiprocessing import resource_tracker
+from shared_nhd import NavigatorRegistry, ResultCache, attach_block
+registry = NavigatorRegistry(sys.argv[1], specs=eval(sys.argv[2]))
+print(registry.upstream_watershed('test', int(sys.argv[3])).size)
+registry.close()
+resource_tracker._resource_tracker._stop()
+"""
+
+
+@pytest.fixture
+def registry(synthetic_navigator, tmp_path):
+    arrays = synthetic_navigator.arrays()
+    out_path = str(tmp_path / 'nav{}')
+    write_nhd.navigator_file('test', *(arrays[name] for name in navigator_fields), out_path=out_path)
+    registry = NavigatorRegistry(out_path)
+    registry.share(['test'])
+    yield registry
+    registry.close()
+
+
+def test_worker_exit_keeps_shared_region(registry, synthetic_navigator):
+    reach = synthetic_navigator.alias_to_reach[synthetic_navigator.paths[0]]
+    expected = synthetic_navigator.upstream_watershed(reach)
+    env = dict(os.environ)
+    nhd_dir = os.path.dirname(sys.modules['shared_nhd'].__file__)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (nhd_dir, env.get('PYTHONPATH'))))
+    worker = subprocess.run([sys.executable, '-c', attach_script, registry.path, repr(registry.specs), str(reach)],
+                            env=env, capture_output=True, text=True)
+    assert worker.returncode == 0, worker.stderr
+    assert int(worker.stdout) == expected.size
+    assert 'leaked' not in worker.stderr
+
+    # The blocks still exist after the worker exits, and the owner reads the same watershed
+    for block_name, _, _ in registry.specs['test'].values():
+        attach_block(block_name).close()
+    np.testing.assert_array_equal(registry.upstream_watershed('test', reach), expected)
+
+
+def test_workers_share_lookup_tables(registry, synthetic_navigator):
+    navigator = registry.navigator('test')
+    assert navigator._ancestors is not None and navigator._extents is not None
+    assert not navigator.ancestors.flags.writeable
+    np.testing.assert_array_equal(navigator.ancestors, synthetic_navigator.ancestors)
+    for shared, built in zip(navigator.extents, synthetic_navigator.extents):
+        assert not shared.flags.writeable
+        np.testing.assert_array_equal(shared, built)
+    reach = synthetic_navigator.alias_to_reach[synthetic_navigator.paths[0]]
+    np.testing.assert_array_equal(registry.upstream_watershed('test', reach, max_depth=5),
+                                  synthetic_navigator.upstream_watershed(reach, max_depth=5))
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ResultCache(max_bytes=3 * 80)
+    for key in 'abc':
+        cache.put(key, np.zeros(10))
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(10))
+    assert list(cache.results) == ['c', 'a', 'd']
+    assert cache.get('b') is None
+
+    # Replacing a result frees its old size and makes it the most recent, and a result larger than the cache isn't
+    # kept
+    cache.put('c', np.zeros(5))
+    cache.put('e', np.zeros(40))
+    cache.put('f', [np.zeros(10), np.zeros(5)])
+    assert list(cache.results) == ['d', 'c', 'f'] and cache.nbytes == 80 + 40 + 120
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 2, 'entries': 3, 'bytes': 240}
+
+
+def test_cached_results_are_read_only(registry, synthetic_navigator):
+    reach = synthetic_navigator.alias_to_reach[synthetic_navigator.paths[0]]
+    reaches, times = registry.upstream_watershed('test', reach, return_times=True)
+    assert registry.upstream_watershed('test', reach, return_times=True)[0] is reaches
+    assert registry.cache.stats()['hits'] == 1 and registry.cache.stats()['misses'] == 1
+    for result in (reaches, times):
+        with pytest.raises(ValueError):
+            result[0] = 0
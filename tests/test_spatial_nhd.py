@@ -0,0 +1,127 @@
+import struct
+import numpy as np
+import pytest
+
+import spatial_nhd
+from spatial_nhd import SpatialIndex, build_index, read_shapes, snap_points
+
+# A 4 x 3 grid of square catchments 0.1 degrees across, the first with a square hole in the middle
+x0, y0, size, nx, ny = -90., 40., 0.1, 4, 3
+
+
+def write_shapefile(shp_path, shape_type, shapes, ids, id_field):
+    """
+    Write a minimal shapefile and its .dbf table
+    :param shape_type: 3 for polylines, 5 for polygons (int)
+    :param shapes: Parts of each shape as arrays of [x, y] vertices, or None for a null shape (list)
+    :param ids: ID of each shape (list)
+    :param id_field: Name of the ID field (str)
+    """
+    records = []
+    for number, parts in enumerate(shapes, 1):
+        if parts is None:
+            content = struct.pack('<i', 0)
+        else:
+            points = np.concatenate(parts).astype(np.float64)
+            starts = np.cumsum([0] + [len(part) for part in parts[:-1]]).astype(np.int32)
+            content = struct.pack('<i4d2i', shape_type, *points.min(0), *points.max(0), len(parts), len(points)) + \
+                starts.tobytes() + points.tobytes()
+        records.append(struct.pack('>2i', number, len(content) // 2) + content)
+    body = b''.join(records)
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, (100 + len(body)) // 2) + \
+        struct.pack('<2i8d', 1000, shape_type, *([0.] * 8))
+    with open(shp_path, 'wb') as f:
+        f.write(header + body)
+
+    descriptor = id_field.upper().encode().ljust(11, b'\x00') + b'N' + b'\x00' * 4 + bytes([12, 0]) + b'\x00' * 14
+    header = struct.pack('<4BIHH20x', 3, 120, 1, 1, len(ids), 32 + 32 + 1, 1 + 12) + descriptor + b'\x0D'
+    rows = b''.join(b' ' + str(i).rjust(12).encode() for i in ids)
+    with open(shp_path[:-4] + '.dbf', 'wb') as f:
+        f.write(header + rows + b'\x1A')
+
+
+def square(x, y, width):
+    return np.array([[x, y], [x, y + width], [x + width, y + width], [x + width, y], [x, y]])
+
+
+@pytest.fixture(scope='module')
+def indexes(tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp('spatial')
+    catchments = [[square(x0 + i * size, y0 + j * size, size)] for j in range(ny) for i in range(nx)]
+    catchments[0].append(square(x0 + size / 4, y0 + size / 4, size / 2)[::-1])
+    catchments.insert(5, None)
+    catchment_ids = [1000 + i for i in range(len(catchments))]
+    write_shapefile(str(out_dir / 'catchment.shp'), 5, catchments, catchment_ids, 'featureid')
+
+    # A flowline along the middle of each row of catchments, in two parts for the first row
+    flowlines = [[np.array([[x0, y], [x0 + nx * size, y]])] for y in y0 + size * (np.arange(ny) + 0.5)]
+    flowlines[0].append(np.array([[x0, y0], [x0, y0 + size]]))
+    write_shapefile(str(out_dir / 'flowline.shp'), 3, flowlines, [1, 2, 3], 'comid')
+    for name, id_field in (('catchment', 'featureid'), ('flowline', 'comid')):
+        build_index(str(out_dir / (name + '.shp')), str(out_dir / (name + 's{}').format('test')), id_field)
+    return out_dir, catchment_ids
+
+
+def test_read_shapes(indexes):
+    out_dir, catchment_ids = indexes
+    x, y, edges, edge_offsets, boxes = read_shapes(str(out_dir / 'catchment.shp'))
+    n_edges = np.diff(edge_offsets)
+    assert n_edges[0] == 8 and n_edges[5] == 0 and (np.delete(n_edges, [0, 5]) == 4).all()
+    assert np.isinf(boxes[5]).all()
+    np.testing.assert_allclose(boxes[1], [x0 + size, y0, x0 + 2 * size, y0 + size])
+
+
+def expected_catchment(lon, lat, catchment_ids):
+    i, j = np.floor((lon - x0) / size).astype(int), np.floor((lat - y0) / size).astype(int)
+    inside = (i >= 0) & (i < nx) & (j >= 0) & (j < ny)
+    shapes = j * nx + i
+    shapes = np.where(shapes >= 5, shapes + 1, shapes)
+    in_hole = (np.abs(lon - (x0 + size / 2)) < size / 4) & (np.abs(lat - (y0 + size / 2)) < size / 4)
+    return np.where(inside & ~in_hole, np.array(catchment_ids)[np.where(inside, shapes, 0)], -1)
+
+
+def test_within_matches_grid(indexes):
+    out_dir, catchment_ids = indexes
+    index = SpatialIndex(str(out_dir / 'catchmentstest'))
+    rng = np.random.default_rng(0)
+    lon = x0 - 0.05 + rng.random(2000) * (nx * size + 0.1)
+    lat = y0 - 0.05 + rng.random(2000) * (ny * size + 0.1)
+    shapes = index.within(lon, lat, batch_size=64)
+    found = np.where(shapes >= 0, index.ids[np.maximum(shapes, 0)], -1)
+    np.testing.assert_array_equal(found, expected_catchment(lon, lat, catchment_ids))
+
+
+def test_nearest_matches_brute_force(indexes):
+    out_dir, _ = indexes
+    index = SpatialIndex(str(out_dir / 'flowlinestest'))
+    rng = np.random.default_rng(1)
+    lon = x0 - 0.05 + rng.random(500) * (nx * size + 0.1)
+    lat = y0 - 0.05 + rng.random(500) * (ny * size + 0.1)
+    shapes, distances = index.nearest(lon, lat, max_distance=5., batch_size=16)
+
+    scale = np.cos(np.radians(lat))
+    all_distances = np.full((lon.size, index.ids.size), np.inf)
+    for shape in range(index.ids.size):
+        for edge in index.edges[index.edge_offsets[shape]:index.edge_offsets[shape + 1]]:
+            ax, ay = (index.x[edge] - lon) * scale, index.y[edge] - lat
+            dx, dy = (index.x[edge + 1] - index.x[edge]) * scale, index.y[edge + 1] - index.y[edge]
+            t = np.clip(-(ax * dx + ay * dy) / (dx * dx + dy * dy), 0., 1.)
+            edge_distances = np.hypot(ax + t * dx, ay + t * dy) * spatial_nhd.km_per_degree
+            all_distances[:, shape] = np.minimum(all_distances[:, shape], edge_distances)
+    nearest = all_distances.min(1)
+    close = nearest <= 5.
+    np.testing.assert_array_equal(shapes[close], all_distances.argmin(1)[close])
+    np.testing.assert_allclose(distances[close], nearest[close])
+    assert (shapes[~close] == -1).all() and np.isnan(distances[~close]).all()
+
+
+def test_snap_points(indexes, monkeypatch):
+    out_dir, catchment_ids = indexes
+    monkeypatch.setattr(spatial_nhd, 'catchment_index_path', str(out_dir / 'catchments{}'))
+    monkeypatch.setattr(spatial_nhd, 'flowline_index_path', str(out_dir / 'flowlines{}'))
+    lon = np.array([x0 + 0.15, x0 + size / 2, x0 - 0.001, x0 - 1.])
+    lat = np.array([y0 + 0.05, y0 + size / 2, y0 + 0.05, y0])
+    assert snap_points('test', lat, lon).tolist() == [1001, 0, 0, 0]
+    comids, distances = snap_points('test', lat, lon, fallback=True, return_distance=True)
+    assert comids.tolist() == [1001, 1, 1, 0]
+    assert distances[0] == 0 and 0 < distances[2] < 0.1 and np.isnan(distances[3])
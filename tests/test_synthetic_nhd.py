@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from process_nhd import prepare_network
+from synthetic_nhd import synthetic_nhd
+from update_nhd import network_outlets
+from validate_nhd import validate_network
+
+
+@pytest.mark.parametrize('n_reaches, n_outlets, size_sigma', [(30000, 30, 1.5), (20000, 200, 1.), (5000, 5, 0.5)])
+def test_networks_match_parameters(n_reaches, n_outlets, size_sigma):
+    table = synthetic_nhd(n_reaches, n_outlets, size_sigma=size_sigma, seed=3)
+    nodes, _, _, outlets, conversion = prepare_network(table)
+    assert validate_network(nodes, outlets, conversion)['valid']
+    assert outlets.size == n_outlets
+
+    # Network sizes, counted from the outlet each reach drains to, include divergence branches
+    sizes = np.bincount(network_outlets(nodes, conversion.size))[outlets]
+    assert sizes.sum() == conversion.size
+    assert sizes.max() < 0.8 * conversion.size
+    if n_outlets >= 30:
+        assert abs(np.log(sizes).std() - size_sigma) < 0.35 * size_sigma
+
+
+def test_default_outlets():
+    table = synthetic_nhd(30000, seed=0)
+    _, _, _, outlets, _ = prepare_network(table)
+    assert outlets.size == 30
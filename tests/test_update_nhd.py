@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from navigator import Navigator
+from synthetic_nhd import synthetic_nhd
+from update_nhd import update_navigator
+
+array_names = ('paths', 'time', 'length', 'path_offsets', 'path_map', 'upstream_index', 'parents', 'alias_index',
+               'sorted_reaches', 'reach_order')
+
+
+def edit_table(nhd_table, seed=0):
+    """ Reroute a reach into another network, remove a headwater reach and add a new one """
+    rng = np.random.default_rng(seed)
+    table = nhd_table.copy()
+    outlets = table.comid.values[~np.isin(table.tocomid.values, table.comid.values)]
+    headwaters = np.setdiff1d(table.comid.values, table.tocomid.values)
+    headwater = headwaters[rng.integers(headwaters.size)]
+    table = table[table.comid != headwater]
+    moved = table.comid.values[rng.integers(len(table))]
+    table.loc[table.comid == moved, 'tocomid'] = outlets[outlets != moved][0]
+    new_reach = table.iloc[[0]].copy()
+    new_reach['comid'], new_reach['tocomid'] = table.comid.max() + 1, table.comid.values[len(table) // 2]
+    return pd.concat([table, new_reach], ignore_index=True)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_update_matches_rebuild(build_navigator, seed):
+    old_table = synthetic_nhd(3000, n_outlets=4, seed=seed)
+    new_table = edit_table(old_table, seed)
+    arrays, _, _ = update_navigator(build_navigator(old_table), old_table, new_table)
+    updated = Navigator('test', arrays=dict(zip(array_names, arrays)))
+    rebuilt = build_navigator(new_table)
+    for reach_id in np.unique(new_table.comid.values):
+        updated_reaches, updated_times = updated.upstream_watershed(reach_id, return_times=True)
+        rebuilt_reaches, rebuilt_times = rebuilt.upstream_watershed(reach_id, return_times=True)
+        updated_order, rebuilt_order = np.argsort(updated_reaches), np.argsort(rebuilt_reaches)
+        np.testing.assert_array_equal(updated_reaches[updated_order], rebuilt_reaches[rebuilt_order])
+        np.testing.assert_allclose(updated_times[updated_order], rebuilt_times[rebuilt_order])
+
+
+def test_update_removes_spilled_paths(build_navigator, tmp_path):
+    old_table = synthetic_nhd(3000, n_outlets=4, seed=0)
+    spill_dir = str(tmp_path / 'spill')
+    update_navigator(build_navigator(old_table), old_table, edit_table(old_table), memory_budget=0,
+                     spill_dir=spill_dir)
+    assert os.path.isdir(spill_dir)
+    assert os.listdir(spill_dir) == []
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from navigator import NetworkError, rapid_trace
+from validate_nhd import network_issues, check_network, validate_network
+
+# Two networks draining to reaches 0 and 5
+valid_nodes = np.array([[-1, 0], [0, 1], [1, 2], [1, 3], [3, 4], [-1, 5], [5, 6]], dtype=np.int32)
+valid_outlets = np.array([0, 5], dtype=np.int32)
+conversion = np.arange(100, 110)
+
+
+def issues_of(nodes, outlets=valid_outlets, n_nodes=7):
+    issues, _ = network_issues(np.asarray(nodes, dtype=np.int32), outlets, n_nodes)
+    return {issue: nodes.tolist() for issue, nodes in issues.items() if nodes.size}
+
+
+def trace(nodes, outlets):
+    n_nodes = int(nodes[:, 1].max()) + 1
+    paths, _, _, _, _ = rapid_trace(nodes, outlets, np.ones(n_nodes), np.ones(n_nodes), conversion[:n_nodes])
+    return np.sort(paths)
+
+
+def test_valid_network():
+    assert issues_of(valid_nodes) == {}
+    assert validate_network(valid_nodes, valid_outlets, conversion[:7])['valid']
+
+
+def test_duplicate_link_is_not_multiple_downstream():
+    nodes = np.vstack((valid_nodes, [[3, 4]]))
+    assert issues_of(nodes) == {'duplicate_links': [4]}
+
+
+def test_multiple_downstream():
+    nodes = np.vstack((valid_nodes, [[6, 4], [6, 4]]))
+    assert issues_of(nodes) == {'duplicate_links': [4], 'multiple_downstream': [4]}
+
+
+def test_cycles_and_dangling():
+    nodes = np.vstack((valid_nodes, [[8, 7], [7, 8], [7, 9], [-1, 10]]))
+    issues = issues_of(nodes, n_nodes=11)
+    assert issues['cycles'] == [7, 8]
+    assert issues['uncovered'] == [7, 8, 9, 10]
+    assert issues['dangling'] == [10]
+
+
+def test_check_network_raise():
+    nodes = np.vstack((valid_nodes, [[3, 4]]))
+    with pytest.raises(NetworkError):
+        check_network(nodes, valid_outlets, conversion[:7])
+
+
+def test_check_network_skip():
+    nodes = np.vstack((valid_nodes, [[3, 4]]))
+    nodes, outlets, validation = check_network(nodes, valid_outlets, conversion[:7], 'skip')
+    assert outlets.tolist() == [5]
+    assert validation['skipped_outlets'] == [100]
+    assert validation['skipped_reaches'] == 5
+    np.testing.assert_array_equal(trace(nodes, outlets), [5, 6])
+
+
+def test_check_network_repair():
+    nodes = np.vstack((valid_nodes, [[3, 4], [6, 2], [8, 7], [7, 8]]))
+    nodes, outlets, validation = check_network(nodes, valid_outlets, conversion[:9], 'repair')
+    assert validation['cut_links'] == [107]
+    assert validate_network(nodes, outlets, conversion[:9])['valid']
+    np.testing.assert_array_equal(trace(nodes, outlets), np.arange(9))
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import read_nhd
+import write_nhd
+from navigator import Navigator
+
+navigator_fields = ('paths', 'time', 'length', 'path_offsets', 'path_map', 'upstream_index', 'parents', 'alias_index',
+                    'sorted_reaches', 'reach_order')
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_navigator_file_round_trip(synthetic_navigator, tmp_path, compress):
+    arrays = synthetic_navigator.arrays()
+    out_path = str(tmp_path / ('nav{}.npz' if compress else 'nav{}'))
+    write_nhd.navigator_file('test', *(arrays[name] for name in navigator_fields), out_path=out_path,
+                             compress=compress, cache_key='key')
+    if not compress:
+        header = read_nhd.columnar_header(out_path.format('test'))
+        assert header['region'] == 'test' and header['cache_key'] == 'key'
+        for values in read_nhd.columnar_arrays(out_path.format('test'), verify=True).values():
+            assert isinstance(values, np.memmap)
+    loaded = Navigator('test', out_path.format('test'))
+    for name, values in loaded.arrays().items():
+        np.testing.assert_array_equal(values, arrays[name])
+    reach = synthetic_navigator.alias_to_reach[synthetic_navigator.paths[0]]
+    np.testing.assert_array_equal(loaded.upstream_watershed(reach), synthetic_navigator.upstream_watershed(reach))
+
+
+def test_checksum_detects_corruption(tmp_path):
+    table_dir = str(tmp_path / 'table')
+    write_nhd.array_directory(table_dir, {'values': np.arange(1000, dtype=np.int32)})
+    array_path = os.path.join(table_dir, 'values.npy')
+    with open(array_path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\x01')
+    assert read_nhd.columnar_arrays(table_dir)['values'][-1] != 999
+    with pytest.raises(ValueError):
+        read_nhd.columnar_arrays(table_dir, verify=True)
+
+
+def test_columnar_table_round_trip(tmp_path):
+    table = pd.DataFrame({'comid': np.array([5, 3, 2 ** 40]), 'travel_time': [0.5, np.nan, 1.],
+                          'gnis_name': ['a', None, 'c'], 'flag': [True, False, True]})
+    table_dir = str(tmp_path / 'table')
+    write_nhd.columnar_table(table_dir, table, attributes={'cache_key': 'key'})
+    header = read_nhd.columnar_header(table_dir)
+    assert header['n_rows'] == 3 and header['cache_key'] == 'key'
+    result = read_nhd.columnar_table(table_dir)
+    assert result.comid.dtype == np.int64 and result.travel_time.dtype == np.float32
+    assert result.gnis_name.tolist() == ['a', '', 'c'] and result.flag.tolist() == [True, False, True]
+
+    # A directory without its header is treated as unwritten
+    os.remove(os.path.join(table_dir, 'header.json'))
+    assert read_nhd.columnar_header(table_dir) is None